@@ -1,128 +1,232 @@
-﻿import glob
-import linecache
+﻿import fnmatch
+import functools
+import glob
+import io
 import numpy as np
 import os
 import pandas as pd
-import re
-import requests
 import shutil
 import subprocess
 import sys 
-from bs4 import BeautifulSoup
-from ftplib import FTP
-from obspy import read, UTCDateTime
-from obspy.io.sac import SACTrace
+from obspy import read, Stream, UTCDateTime
+import cwbReport
+import envelopePyramid
+import intensityGrid
+import library
+import metrics
+import ntuArchive
+import pgaEngine
+import sacWriter
+import stationCatalog
+import waveformCache
+
+DATA_DIR = '/home/palert/data'
+WEB_DIR = '/var/www/html/palert/pga/staticpga'
+
+def stage(method=None, key=None):
+    # measures the stage (see metrics) and records it as finished in the event store, if any;
+    # key(*args, **kwargs) tells apart the stages of a method that runs more than once per event
+    if method is None:
+        return functools.partial(stage, key=key)
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with metrics.span(method.__name__, eqNo=self.parameters['EarthquakeNo']):
+            result = method(self, *args, **kwargs)
+        if self.store is not None:
+            name = method.__name__ if key is None else f'{method.__name__}[{key(*args, **kwargs)}]'
+            self.store.recordStage(self.parameters['EarthquakeNo'], name)
+        return result
+    return wrapper
 
 class Earthquake():
-    def __init__(self, url):
+    EXCLUDED_STATIONS = ['A*', 'B*', 'CHGB*', 'HGSD*', 'FUSB*', 'KMNB*', 'LATB*', 'LYUB*', 'MASB*', 'MATB*', 'NACB*', 'NNSB*', 'PHUB*', 'RLNB*', 'SBCB*', 'SSLB*', 'SXI1*', 'TATO*', 'TDCB*', 'TPUB*', 'TWGB*', 'TWKB*', 'VWDT*', 'VWUC*', 'WARB*', 'WFSB*', 'WUSB*', 'YD07*', 'YHNB*', 'YULB*', 'YOJ*']
+    
+    def __init__(self, url, store=None, dataDir=DATA_DIR, webDir=WEB_DIR, report=None, allowStations=None, denyStations=None, workers=1):
         self.__url = url
-        self.__parameters = self.__obtainEqParameters()
+        self.store = store
+        self.dataDir = dataDir
+        self.webDir = webDir
+        # station name globs: only allowed (all if None) and not denied stations are ever loaded
+        self.allowStations = allowStations
+        self.denyStations = self.EXCLUDED_STATIONS if denyStations is None else denyStations
+        self.__stationList = None
+        # processes used to write and patch sac files
+        self.workers = workers
+        self.__stationInfoSaved = set()
+        self.streams = {}
+        self.rawStream = None
+        self.__sharedSource = None
+        self.__accumPGAs = None
+        self.__parameters = self.__obtainEqParameters(report)
         self.__dir = self.__obtainDir()
         self.__obtainFoldersName()
         
-    def __obtainEqParameters(self):
+    def __obtainEqParameters(self, report):
+        if report is None:
+            report = cwbReport.fetchReport(self.__url)
         parameters = {}
-        if not os.path.exists("tmp"):
-            os.makedirs("tmp")
-        req = requests.get(self.__url)
-        with open(f'tmp/tmp.txt', 'w') as eqReport:
-            eqReport.write(req.content.decode('utf-8'))
-        lineNum = 0
-        with open(f'tmp/tmp.txt', 'r') as eqReport:
-            for line in eqReport:
-                lineNum += 1
-                if re.search('eqReportBoxBg', line):
-                    break
-                    
-        self.__eqNo = int(linecache.getline(f'tmp/tmp.txt', lineNum+3).split()[-1])
+        self.__eqNo = report.eqNo
         parameters['EarthquakeNo'] = self.__eqNo
         
-        year = int(linecache.getline(f'tmp/tmp.txt', lineNum+5)[60:64])        
-        month = int(linecache.getline(f'tmp/tmp.txt', lineNum+5)[54:56])
-        date = int(linecache.getline(f'tmp/tmp.txt', lineNum+5)[57:59])
-        hour = int(linecache.getline(f'tmp/tmp.txt', lineNum+5)[65:67])
-        minute = int(linecache.getline(f'tmp/tmp.txt', lineNum+5)[68:70])
-        second = float(linecache.getline(f'tmp/tmp.txt', lineNum+5)[71:75])
-        originTimeStringUTC = f"{year}-{month:02}-{date:02}T{hour:02}:{minute:02}:{second}+08"
-        self.__originTimeUTC = UTCDateTime(originTimeStringUTC)        
+        self.__originTimeUTC = report.originTimeUTC
         parameters['OriginTimeUTC'] = self.__originTimeUTC
         
-        self.__latitude = float(linecache.getline(f'tmp/tmp.txt', lineNum+7)[17:22])
+        self.__latitude = report.latitude
         self.__latitudeUnit = 'Degree(N)'
-        self.__longitude = float(linecache.getline(f'tmp/tmp.txt', lineNum+7)[24:30])
+        self.__longitude = report.longitude
         self.__longitudeUnit = 'Degree(E)'
-        self.__depth = float(linecache.getline(f'tmp/tmp.txt', lineNum+9)[15:20])
+        self.__depth = report.depth
         self.__depthUnit = 'km'
         parameters['Hypocenter'] = [self.__latitude, self.__latitudeUnit, self.__longitude, self.__longitudeUnit, self.__depth, self.__depthUnit]
         
-        self.__magnitude = float(linecache.getline(f'tmp/tmp.txt', lineNum+11)[22:25])
+        self.__magnitude = report.magnitude
         parameters['Magnitude(ML)'] = self.__magnitude
-        
-        shutil.rmtree("tmp")
         return parameters
     
     def __obtainDir(self):
-        dir = f'/home/palert/data/SAC/{self.__originTimeUTC.year}{self.__originTimeUTC.month:02d}'
+        dir = f'{self.dataDir}/SAC/{self.__originTimeUTC.year}{self.__originTimeUTC.month:02d}'
         if not os.path.exists(dir):
             os.makedirs(dir)
         return dir
     
     def __obtainFoldersName(self):
-        datetime2minAgo = self.__originTimeUTC - 120
-        self.folder2minAgo = datetime2minAgo.strftime('%Y%m%d_%H%M%S') + '_MAN'
-        ftpNTU = FTP()
-        ftpNTU.connect('140.112.65.220', 2121)  # IP, port
-        ftpNTU.login()  # user, password
-        ftpNTU.cwd(f'events/{self.__originTimeUTC.year}{self.__originTimeUTC.month:02d}')
-        if f'{self.folder2minAgo}.tar.bz2' not in ftpNTU.nlst():
-            datetime2minAgo = self.__originTimeUTC - 120 + 1
-            self.folder2minAgo = datetime2minAgo.strftime('%Y%m%d_%H%M%S') + '_MAN'
-            if f'{self.folder2minAgo}.tar.bz2' not in ftpNTU.nlst():
-                datetime2minAgo = self.__originTimeUTC - 120 - 1
-                self.folder2minAgo = datetime2minAgo.strftime('%Y%m%d_%H%M%S') + '_MAN'
-                if f'{self.folder2minAgo}.tar.bz2' not in ftpNTU.nlst():
-                    sys.exit('This event doesn\'t exit in NTU server.')
-        ftpNTU.quit()
+        index = ntuArchive.getIndex(f'{self.dataDir}/ntuArchiveIndex.json')
+        month = f'{self.__originTimeUTC.year}{self.__originTimeUTC.month:02d}'
+        self.folder2minAgo = index.nearest(self.__originTimeUTC - 120, tolerance=1, month=month)
+        if self.folder2minAgo is None:
+            sys.exit('This event doesn\'t exit in NTU server.')
+        datetime2minAgo = UTCDateTime.strptime(self.folder2minAgo[:15], '%Y%m%d_%H%M%S')
         datetime20secAgo = datetime2minAgo + 100
         self.folder20secAgo = datetime20secAgo.strftime('%Y%m%d_%H%M%S') + '_MAN'
 
-    def downloadData(self):
-        ftpNTU = FTP()
-        ftpNTU.connect('***.***.***.***', 2121)  # IP, port
-        ftpNTU.login()  # user, password
-        ftpNTU.cwd(f'events/{self.__originTimeUTC.year}{self.__originTimeUTC.month:02d}')
+    @stage
+    def downloadData(self, streaming=True, inMemory=False, archivePath=None):
+        # archivePath: the archive already downloaded (e.g. by asyncFetch), read instead of the ftp server
+        if streaming:
+            self.__downloadDataStreaming(inMemory, archivePath)
+            return
         bz2FileName = f'{self.folder2minAgo}.tar.bz2'
         print('Preparing data. Please be patient...')
-        localfile = open(f'{self.__dir}/' + bz2FileName, 'wb')
-        ftpNTU.retrbinary('RETR ' + bz2FileName, localfile.write)
-        localfile.close()
-        ftpNTU.quit()
+        with ntuArchive.getPool().connection() as ftpNTU:
+            ftpNTU.cwd(f'events/{self.__originTimeUTC.year}{self.__originTimeUTC.month:02d}')
+            localfile = open(f'{self.__dir}/' + bz2FileName, 'wb')
+            ftpNTU.retrbinary('RETR ' + bz2FileName, localfile.write)
+            localfile.close()
+        metrics.count('bytesDownloaded', os.path.getsize(f'{self.__dir}/' + bz2FileName))
         os.system(f'tar -C {self.__dir} -jxvf {self.__dir}/{bz2FileName}')
         os.remove(f'{self.__dir}/{bz2FileName}')
         if not os.path.exists(f'{self.__dir}/{self.folder20secAgo}'):
             os.makedirs(f'{self.__dir}/{self.folder20secAgo}')
         os.system(f'cp {self.__dir}/{self.folder2minAgo}/* {self.__dir}/{self.folder20secAgo}')            
     
+    def __downloadDataStreaming(self, inMemory, archivePath=None):
+        # The archive is decompressed while it is being received and the traces
+        # are kept once, shared by both processData windows instead of a cp.
+        bz2FileName = f'{self.folder2minAgo}.tar.bz2'
+        print('Preparing data. Please be patient...')
+        if archivePath is not None:
+            members = ntuArchive.extractLocalArchive(archivePath, None if inMemory else self.__dir)
+        else:
+            with ntuArchive.getPool().connection() as ftpNTU:
+                ftpNTU.cwd(f'events/{self.__originTimeUTC.year}{self.__originTimeUTC.month:02d}')
+                members = ntuArchive.extractArchive(ftpNTU, bz2FileName, None if inMemory else self.__dir)
+        if inMemory:
+            self.rawStream = Stream()
+            for name, content in sorted(members.items()):
+                if not fnmatch.fnmatch(os.path.basename(name), '*TW*'):
+                    continue
+                if self.selectStation(read(io.BytesIO(content), format='SAC', headonly=True)[0].stats.station):
+                    self.rawStream += read(io.BytesIO(content), format='SAC')
+        else:
+            self.rawStream = None
+            # the denied stations go at once, they are never read and the scripts glob *TW*
+            self.__removeDeselected(f'{self.__dir}/{self.folder2minAgo}')
+        self.__sharedSource = f'{self.__dir}/{self.folder2minAgo}'
+        for folder in [self.folder2minAgo, self.folder20secAgo]:
+            if not os.path.exists(f'{self.__dir}/{folder}'):
+                os.makedirs(f'{self.__dir}/{folder}')
+    
+    def selectStation(self, sta):
+        if self.allowStations is not None and not any(fnmatch.fnmatch(sta, pattern) for pattern in self.allowStations):
+            return False
+        return not any(fnmatch.fnmatch(sta, pattern) for pattern in self.denyStations)
+    
+    @staticmethod
+    def indexTraces(folder):
+        # header-only pass over the sac files of a folder
+        rows = []
+        for file in sorted(glob.glob(f'{folder}/*TW*')):
+            for tr in read(file, headonly=True):
+                rows.append([file, tr.stats.station, tr.stats.channel, tr.stats.starttime, tr.stats.endtime])
+        return pd.DataFrame(rows, columns=['file', 'station', 'channel', 'starttime', 'endtime'])
+    
+    def __selected(self, index):
+        return index['station'].map(self.selectStation).astype(bool)
+
+    def __removeDeselected(self, folder):
+        index = self.indexTraces(folder)
+        for file in index.loc[~self.__selected(index), 'file'].unique():
+            os.remove(file)
+
+    def __readSelected(self, folder, removeOthers=False):
+        index = self.indexTraces(folder)
+        selected = self.__selected(index)
+        if removeOthers:
+            for file in index.loc[~selected, 'file'].unique():
+                os.remove(file)
+        st = Stream()
+        for file in index.loc[selected, 'file'].unique():
+            st += read(file)
+        return st
+    
+    def __loadRawStream(self):
+        if self.rawStream is None:
+            self.rawStream = self.__readSelected(self.__sharedSource)
+        return self.rawStream
+    
+    def __readStationList(self):
+        if self.__stationList is None:
+            self.__stationList = self.catalog.to_dataframe()
+        return self.__stationList
+    
+    @property
+    def catalog(self):
+        # shared by every event of the process, read again only if stalist.txt changes
+        return stationCatalog.getCatalog(f'{self.dataDir}/stalist.txt')
+    
+    @stage(key=lambda dir2Process, diffStartime, diffEndtime: f'{diffStartime:g},{diffEndtime:g}')
     def processData(self, dir2Process, diffStartime, diffEndtime):
         print(f'Process data in {dir2Process}...')
-        os.chdir(dir2Process)
-        
-        os.system('rm -f A* B* CHGB* HGSD* FUSB* KMNB* LATB* LYUB* MASB* MATB* NACB* NNSB* PHUB* RLNB* SBCB* SSLB* SXI1* TATO* TDCB* TPUB* TWGB* TWKB* VWDT* VWUC* WARB* WFSB* WUSB* YD07* YHNB* YULB* YOJ*')
-        
-        st = read('*TW*')
+        if self.__sharedSource is None and not glob.glob(f'{dir2Process}/*TW*'):
+            # downloaded by an earlier run in streaming mode: the traces are only in folder2minAgo
+            self.__sharedSource = f'{self.__dir}/{self.folder2minAgo}'
+        if self.__sharedSource is None:
+            st = self.__readSelected(dir2Process, removeOthers=True)
+        else:
+            st = self.__loadRawStream().copy()
         self.sync(st)
-        self.cutWaveform(st, self.__originTimeUTC + diffStartime, self.__originTimeUTC + diffEndtime)
-        
-        for file in list(glob.glob('*TW*')):
-            sac = SACTrace.read(file)
-            sac.o = self.__originTimeUTC
-            sac.iztype = 'io'
-            sac.evla = self.__latitude
-            sac.evlo = self.__longitude
-            sac.evdp = self.__depth
-            sac.mag = self.__magnitude
-            sac.write(file)
-        os.chdir('/home/palert/data')
+        # event and station headers go into the one write of every cut trace
+        headers = {'o': self.__originTimeUTC, 'iztype': 'io', 'evla': self.__latitude, 'evlo': self.__longitude, 'evdp': self.__depth, 'mag': self.__magnitude}
+        catalog = self.catalog
+        stationHeaders = {sta: {'stla': stla, 'stlo': stlo} for sta, stla, stlo in zip(catalog.names, catalog.latitude, catalog.longitude)}
+        self.cutWaveform(st, self.__originTimeUTC + diffStartime, self.__originTimeUTC + diffEndtime, dir2Process, headers, stationHeaders, self.workers)
+        self.__stationInfoSaved.add(dir2Process)
+        self.streams[dir2Process] = st
+        waveformCache.WaveformCache.create(f'{dir2Process}/waveforms', st)
+    
+    @stage
+    def buildEnvelopes(self, dir2Process=None):
+        # min/max zoom levels of every trace of a processed window for the web pages
+        dir2Process = dir2Process or f'{self.__dir}/{self.folder2minAgo}'
+        cache = waveformCache.WaveformCache(f'{dir2Process}/waveforms')
+        files = envelopePyramid.writePyramid(f'{dir2Process}/envelopes', cache.stations, cache.data, cache.starttime, cache.delta)
+        originTime = self.__originTimeUTC.strftime('%Y%m%d%H%M%S')
+        for directory in [f'{self.webDir}/{originTime}.envelopes', f'{self.webDir}/{self.__originTimeUTC.year}/{originTime}.envelopes']:
+            os.makedirs(directory, exist_ok=True)
+            # index.json is published last, so it never points at missing levels
+            for file in files:
+                library.publishFile(file, f'{directory}/{os.path.basename(file)}')
     
     @staticmethod
     def sync(st):
@@ -131,114 +235,193 @@ class Earthquake():
         st.trim(maxstart, minend)
     
     @staticmethod    
-    def cutWaveform(st, starttime, endtime):        
+    def cutWaveform(st, starttime, endtime, outputDir='.', headers=None, stationHeaders=None, workers=1):        
         for tr in st:
-            filename = f'{tr.stats.station}.{tr.stats.channel}.{tr.stats.network}.{tr.stats.location}'
             tr.trim(starttime, endtime)
-            tr.write(filename, format="SAC")
+        sacWriter.writeTraces(st, outputDir, headers, stationHeaders, workers)
     
-    def getPGAsDataframe(self):
+    @stage
+    def getPGAsDataframe(self, engine='numpy', parity=False):
         print(f'Get pgas dataframe...')
-        self.df = pd.read_csv('stalist.txt', sep=" ",header=None)
-        self.df.columns =['staName', 'staLatitude', 'staLongitude']
-        self.df['PGAsMaxInENZ'] = 0
-        self.df['intensity'] = 0
-        self.df['PGAsResultantOfENZ'] = 0
-        self.df['PGAsResultantOfEN'] = 0
+        self.df = self.__readStationList().copy()
         
-        os.chdir(f'{self.__dir}/{self.folder20secAgo}')
-        for i, row in self.df.iterrows():
-            p = subprocess.Popen(["/home/palert/data/rdsac2", row['staName']], stdout=subprocess.PIPE)
-            pgas = p.communicate()[0].decode("utf-8").split()
-            self.df.loc[i, 'PGAsMaxInENZ'] = float(pgas[0])
-            self.df.loc[i, 'intensity'] = float(pgas[1])
-            self.df.loc[i, 'PGAsResultantOfENZ'] = float(pgas[2])
-            self.df.loc[i, 'PGAsResultantOfEN'] = float(pgas[3])
-        os.chdir('../../../')        
+        workDir = f'{self.__dir}/{self.folder20secAgo}'
+        if engine == 'rdsac2':
+            pgas = pgaEngine.rdsac2PGAs(self.df['staName'], workDir, f'{self.dataDir}/rdsac2')
+        else:
+            data = self.__loadWaveforms(workDir)[0]
+            pgas = pgaEngine.pgaFrame(self.df['staName'], pgaEngine.computePGAs(data))
+            if parity:
+                mismatches = pgaEngine.checkParity(pgas, pgaEngine.rdsac2PGAs(self.df['staName'], workDir, f'{self.dataDir}/rdsac2'))
+                print(f'{len(mismatches)} of {len(pgas)} stations differ from rdsac2.')
+                if len(mismatches):
+                    print(mismatches)
+        self.df[pgaEngine.PGA_COLUMNS] = pgas[pgaEngine.PGA_COLUMNS].to_numpy()
+        self.df['epicentralDistance'], self.df['azimuth'] = stationCatalog.distanceAzimuth(self.__latitude, self.__longitude, self.df['staLatitude'], self.df['staLongitude'])
+    
+    def compareCwb(self, cwbEvent, maxDistance=5.0):
+        # PGAs of the CWB stations of the report next to the nearest P-alert stations
+        return stationCatalog.comparePGAs(cwbEvent, self.df, self.catalog, maxDistance)
+
+    def __loadWaveforms(self, workDir):
+        # from memory, else from the waveform cache of processData, else from the sac files
+        st = self.streams.get(workDir)
+        if st is not None:
+            return pgaEngine.streamToArray(st, self.df['staName'])
+        if waveformCache.WaveformCache.exists(f'{workDir}/waveforms'):
+            return waveformCache.WaveformCache(f'{workDir}/waveforms').select(self.df['staName'])
+        return pgaEngine.streamToArray(read(f'{workDir}/*TW*'), self.df['staName'])
 
     def getPGAsFilename(self):
         fileTime = self.__originTimeUTC.strftime('%Y%m%d%H%M%S')
         self.__filePGAs = f'{self.__dir}/{self.folder20secAgo}/{fileTime}PGAs.txt'
         self.__filePGAs_1 = f'{self.__dir}/{self.folder20secAgo}/{fileTime}PGAs_1.txt'
+        self.__filePGAsSidecar = f'{self.__dir}/{self.folder20secAgo}/{fileTime}PGAs.npz'
     
+    @stage
     def getPGAsFile(self):        
-        os.chdir(f'{self.__dir}/{self.folder20secAgo}')
         print(f'Get {self.__filePGAs}...')
         
-        f = open(self.__filePGAs, "w")
-        
         originTimehhmmss = self.__originTimeUTC.strftime('%H%M%S')
-        f.write(f'{self.__originTimeUTC.year} {self.__originTimeUTC.month:02} {self.__originTimeUTC.day:02} {originTimehhmmss} {self.__latitude} {self.__longitude} {self.__depth} {self.__magnitude}\n')
+        header = f'{self.__originTimeUTC.year} {self.__originTimeUTC.month:02} {self.__originTimeUTC.day:02} {originTimehhmmss} {self.__latitude} {self.__longitude} {self.__depth} {self.__magnitude}\n'
         
-        for i in range(len(self.df)):
-            if self.df.loc[i, 'PGAsMaxInENZ'] > 0:
-                f.write(f"{self.df.loc[i, 'staName']} {self.df.loc[i, 'staLatitude']:.6f} {self.df.loc[i, 'staLongitude']:.6f} {self.df.loc[i, 'PGAsMaxInENZ']} {self.df.loc[i, 'intensity']} {self.df.loc[i, 'PGAsResultantOfENZ']} {self.df.loc[i, 'PGAsResultantOfEN']}\n")
+        df = self.df[self.df['PGAsMaxInENZ'] > 0]
+        lines = df['staName'].astype(str).str.cat([pd.Series(np.char.mod('%.6f', df['staLatitude'].to_numpy()), index=df.index),
+                                                   pd.Series(np.char.mod('%.6f', df['staLongitude'].to_numpy()), index=df.index),
+                                                   *[df[column].astype(str) for column in pgaEngine.PGA_COLUMNS]], sep=' ')
+        content = header + ''.join(lines + '\n')
+        library.atomicWrite(self.__filePGAs, content)
+        # PGAs_1.txt is the input of gmt.csh, which may edit it: a copy of its own
+        library.atomicWrite(self.__filePGAs_1, content)
+        self.__writePGAsSidecar(df)
         
-        f.close()
-        
-        shutil.copyfile(self.__filePGAs, self.__filePGAs_1)
-        if not os.path.exists(f'/var/www/html/palert/pga/staticpga/{self.__originTimeUTC.year}'):
-            os.makedirs(f'/var/www/html/palert/pga/staticpga/{self.__originTimeUTC.year}')
-        shutil.copy(self.__filePGAs, '/var/www/html/palert/pga/staticpga/', follow_symlinks=True)
-        shutil.copy(self.__filePGAs_1, '/var/www/html/palert/pga/staticpga/', follow_symlinks=True)
-        shutil.copy(self.__filePGAs, f'/var/www/html/palert/pga/staticpga/{self.__originTimeUTC.year}', follow_symlinks=True)
-        shutil.copy(self.__filePGAs_1, f'/var/www/html/palert/pga/staticpga/{self.__originTimeUTC.year}', follow_symlinks=True)
-        
-        os.chdir('/home/palert/data/')        
+        if not os.path.exists(f'{self.webDir}/{self.__originTimeUTC.year}'):
+            os.makedirs(f'{self.webDir}/{self.__originTimeUTC.year}')
+        # the web PGAs_1.txt links PGAs.txt, the table as written, as the copy did
+        for file, name in [(self.__filePGAs, self.__filePGAs), (self.__filePGAs, self.__filePGAs_1), (self.__filePGAsSidecar, self.__filePGAsSidecar)]:
+            library.publishFile(file, f'{self.webDir}/{os.path.basename(name)}')
+            library.publishFile(file, f'{self.webDir}/{self.__originTimeUTC.year}/{os.path.basename(name)}')
+    
+    def __writePGAsSidecar(self, df):
+        # the PGA table for the website as arrays, same rows as the text file
+        buffer = io.BytesIO()
+        np.savez(buffer,
+                 originTime=np.array(self.__originTimeUTC.timestamp),
+                 hypocenter=np.array([self.__latitude, self.__longitude, self.__depth]),
+                 magnitude=np.array(self.__magnitude),
+                 staName=df['staName'].to_numpy(dtype=str),
+                 staLatitude=df['staLatitude'].to_numpy(dtype=np.float64),
+                 staLongitude=df['staLongitude'].to_numpy(dtype=np.float64),
+                 **{column: df[column].to_numpy(dtype=np.float32) for column in pgaEngine.PGA_COLUMNS})
+        library.atomicWrite(self.__filePGAsSidecar, buffer.getvalue())
         
+    @stage
     def saveStaInfo2Sac(self):
-        os.chdir(f'{self.__dir}/{self.folder20secAgo}')
+        workDir = f'{self.__dir}/{self.folder20secAgo}'
+        if workDir in self.__stationInfoSaved:
+            print(f'Station information was saved by processData.')
+            return
         print(f'Save station informtation to sac files...')
-        for sta in list(self.df.index):
+        fileHeaders = {}
+        for row in self.df.itertuples():
             for comp in ['E', 'N', 'Z']:
-                file = f'{sta}.HL{comp}.TW.--'
+                file = f'{workDir}/{row.staName}.HL{comp}.TW.--'
                 if os.path.exists(file):
-                    sac = SACTrace.read(file)
-                    sac.stla = self.df.loc[sta, 'staLatitude']
-                    sac.stlo = self.df.loc[sta, 'staLongitude']
-                    sac.write(file)
-        os.chdir('../../../')
+                    fileHeaders[file] = {'stla': row.staLatitude, 'stlo': row.staLongitude}
+        sacWriter.patchHeaders(list(fileHeaders), fileHeaders=fileHeaders, workers=self.workers)
+    
+    @stage
+    def contourMulti(self, native=False):
+        if not native:
+            subprocess.run(f'csh {self.dataDir}/contour_multi.csh', shell=True, cwd=f'{self.__dir}/{self.folder20secAgo}')
+            return
+        # intensity grid and contours of the PGA file, without gmt
+        intensity = np.where(self.df['PGAsMaxInENZ'] > 0, self.df['intensity'], np.nan)
+        files = intensityGrid.writeProducts(self.__filePGAs[:-len('.txt')], self.__intensityGrid(), intensity)
+        for file in files:
+            library.publishFile(file, f'{self.webDir}/{os.path.basename(file)}')
+            library.publishFile(file, f'{self.webDir}/{self.__originTimeUTC.year}/{os.path.basename(file)}')
     
-    def contourMulti(self):
-        os.chdir(f'{self.__dir}/{self.folder20secAgo}')
-        subprocess.run('csh /home/palert/data/contour_multi.csh', shell=True)
-        os.chdir('../../../')
+    def __intensityGrid(self):
+        # the weights only depend on stalist.txt, so they are cached under dataDir
+        return intensityGrid.getGrid(self.df['staLatitude'], self.df['staLongitude'], f'{self.dataDir}/grids')
         
-    def accum3sPGAs(self):
+    @stage
+    def accum3sPGAs(self, incremental=True, windowLength=3, windowCount=40):
         originTime = self.__originTimeUTC.strftime('%Y%m%d%H%M%S')
-        os.chdir(f'{self.__dir}/{self.folder20secAgo}')
-        if not os.path.exists("accum"):
-            os.makedirs("accum")
-        os.chdir("accum")
-        for i in range(1,41):
-            os.system('cp ../*TW.-- ./')
-            print(f'cut 0-{3 * i}')
-            st = read('*TW*')
+        if incremental:
+            self.__accumPGAsIncremental(windowLength, windowCount)
+        else:
+            self.__accumPGAsByCutting(windowLength, windowCount)
+        accumDir = f'{self.__dir}/{self.folder20secAgo}/accum'
+        # published file by file, so a reprocessed event replaces its frames
+        for directory in [f'{self.webDir}/{originTime}.accum', f'{self.webDir}/{self.__originTimeUTC.year}/{originTime}.accum']:
+            os.makedirs(directory, exist_ok=True)
+            for file in sorted(glob.glob(f'{accumDir}/*')):
+                if os.path.isfile(file):
+                    library.publishFile(file, f'{directory}/{os.path.basename(file)}')
+    
+    def __accumPGAsIncremental(self, windowLength, windowCount):
+        workDir = f'{self.__dir}/{self.folder20secAgo}'
+        if not os.path.exists(f'{workDir}/accum'):
+            os.makedirs(f'{workDir}/accum')
+        print(f'accumulate PGAs of {windowCount} windows of {windowLength} s')
+        data, starttime, delta = self.__loadWaveforms(workDir)
+        endtimes, pgas = pgaEngine.accumPGAs(data, starttime, delta, self.__originTimeUTC - 20, windowLength, windowCount)
+        self.__accumPGAs = pgas
+        for i, (endtime, windowPGAs) in enumerate(zip(endtimes, pgas), 1):
+            pgaEngine.writeAccumFrame(f'{workDir}/accum/PGAs_{i:02}', endtime, self.df['staName'], self.df['staLatitude'], self.df['staLongitude'], windowPGAs)
+    
+    def __accumPGAsByCutting(self, windowLength, windowCount):
+        workDir = f'{self.__dir}/{self.folder20secAgo}'
+        accumDir = f'{workDir}/accum'
+        if not os.path.exists(accumDir):
+            os.makedirs(accumDir)
+        for i in range(1, windowCount + 1):
+            for file in glob.glob(f'{workDir}/*TW.--'):
+                shutil.copy(file, accumDir)
+            print(f'cut 0-{windowLength * i}')
+            st = read(f'{accumDir}/*TW*')
             starttime = self.__originTimeUTC - 20
-            endtime = starttime + 3 * i
-            self.cutWaveform(st, starttime, endtime)
+            endtime = starttime + windowLength * i
+            self.cutWaveform(st, starttime, endtime, accumDir, workers=self.workers)
             
-            PGAout = f'PGAs_{i:02}'
-            with open(PGAout, 'w') as f:
-                f.write(f"{endtime.strftime('%Y %m %d %H%M%S')}\n")
-                
-                for index, row in self.df.iterrows():
-                    p = subprocess.Popen(["/home/palert/data/rdsac2", row['staName']], stdout=subprocess.PIPE)
-                    pgas = [*map(float, p.communicate()[0].decode("utf-8").split())]
-                    f.write(f"{row['staName']} {row['staLatitude']:.6f} {row['staLongitude']:.6f} {pgas[0]:.3f} {pgas[1]:.2f} {pgas[2]:.3f} {pgas[3]:.3f}\n")
-        os.system('rm -rf *TW*')
-        os.chdir('../')
-        shutil.copytree('accum', f'/var/www/html/palert/pga/staticpga/{originTime}.accum')
-        shutil.copytree('accum', f'/var/www/html/palert/pga/staticpga/{self.__originTimeUTC.year}/{originTime}.accum')
-        os.chdir('/home/palert/data/')
+            PGAout = f'{accumDir}/PGAs_{i:02}'
+            lines = [f"{endtime.strftime('%Y %m %d %H%M%S')}\n"]
+            for index, row in self.df.iterrows():
+                p = subprocess.Popen([f"{self.dataDir}/rdsac2", row['staName']], stdout=subprocess.PIPE, cwd=accumDir)
+                pgas = [*map(float, p.communicate()[0].decode("utf-8").split())]
+                lines.append(f"{row['staName']} {row['staLatitude']:.6f} {row['staLongitude']:.6f} {pgas[0]:.3f} {pgas[1]:.2f} {pgas[2]:.3f} {pgas[3]:.3f}\n")
+            # the frames are published as links, so never rewritten in place
+            library.atomicWrite(PGAout, ''.join(lines))
+        for file in glob.glob(f'{accumDir}/*TW*'):
+            os.remove(file)
      
-    def accum3sPGAsPlot(self):
-        os.chdir(f'{self.__dir}/{self.folder20secAgo}')
+    @stage
+    def accum3sPGAsPlot(self, native=False):
+        if native:
+            self.__accumGrids()
+            return
         inputfile = self.__filePGAs_1.split('/')[-1]
-        subprocess.run('csh /home/palert/data/gmt.csh', shell=True, input=inputfile, encoding='ascii')
-        # subprocess.run('csh /home/palert/data/gmt_bk.csh', shell=True)
-        os.chdir('/home/palert/data/')
+        subprocess.run(f'csh {self.dataDir}/gmt.csh', shell=True, input=inputfile, encoding='ascii', cwd=f'{self.__dir}/{self.folder20secAgo}')
+        # subprocess.run(f'csh {self.dataDir}/gmt_bk.csh', shell=True)
 
+    def __accumGrids(self):
+        # all frames are gridded by one sparse product with the cached weights
+        accumDir = f'{self.__dir}/{self.folder20secAgo}/accum'
+        originTime = self.__originTimeUTC.strftime('%Y%m%d%H%M%S')
+        if self.__accumPGAs is not None:
+            pgas = self.__accumPGAs
+        else:
+            frames = sorted(glob.glob(f'{accumDir}/PGAs_[0-9][0-9]'))
+            pgas = np.stack([np.loadtxt(frame, skiprows=1, usecols=(3, 4, 5, 6), ndmin=2) for frame in frames])
+        intensity = np.where(pgas[:, :, 0] > 0, pgas[:, :, 1], np.nan).T
+        names = [f'{accumDir}/PGAs_{i:02}' for i in range(1, len(pgas) + 1)]
+        files = intensityGrid.writeProducts(names, self.__intensityGrid(), intensity)
+        for file in files:
+            library.publishFile(file, f'{self.webDir}/{originTime}.accum/{os.path.basename(file)}')
+            library.publishFile(file, f'{self.webDir}/{self.__originTimeUTC.year}/{originTime}.accum/{os.path.basename(file)}')
+    
     def passFiles2tesis(self):
         # 這部分可能要再跟其芳確認一下 (from NTU_xml.csh)
         return
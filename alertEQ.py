@@ -2,37 +2,317 @@
 # chaoyi 2021.10.05
 #
 # to monitor the CWB opendata platform for latest earthquake report
+#
+# Run from cron, most polls find nothing new: requests, zipfile and
+# (through library) numpy, pandas and obspy are only imported once a new
+# payload or a new event shows up.
 
+import argparse
+import eventStore
+import io
+import json
 import library
+import metrics
 import os
-import pandas as pd
-import xml.etree.ElementTree as ET
-import wget
-
-
-def main():
-    xmlDir = 'xml'
-    os.chdir(xmlDir)
-
-    cwbOpendataApi = "opendataapi?dataid=E-A0015-001&authorizationkey=CWB-BFBE0988-4DB7-47A8-AE56-3D82EFBFDF6E"
-    library.removeFile(cwbOpendataApi)
-    zipfile = "download.zip"
-    downloadXMLfiles(cwbOpendataApi, zipfile)
-
-    xmlFolder = 'xmlfiles'
-    library.unzipFile(zipfile, xmlFolder)
-
-    for xmlfile in sorted(os.listdir(xmlFolder)):
-        eqid = getEqid(f"{xmlFolder}/{xmlfile}")
-        lastestEqid = getLatestEqid()
-        print('Latest Event: ', lastestEqid, 'This Event: ', eqid)
-        if eqid > lastestEqid:
-            eqParameters = {}
-            library.getEqParameters(eqParameters, f"{xmlFolder}/{xmlfile}")
-            print(eqParameters)
-            df = library.getCwbStationInfo(f"{xmlFolder}/{xmlfile}")
-            print(df)
-     
+import re
+import time
+
+CWB_OPENDATA_API = "opendataapi?dataid=E-A0015-001&authorizationkey=CWB-BFBE0988-4DB7-47A8-AE56-3D82EFBFDF6E"
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='monitor the CWB opendata platform for latest earthquake report')
+    parser.add_argument('--watch', action='store_true', help='keep polling instead of checking once')
+    parser.add_argument('--interval', type=float, default=1.0, help='seconds between two polls in watch mode')
+    parser.add_argument('--url', default=CWB_OPENDATA_API, help='the opendata api, a url or a path of opendata.cwb.gov.tw')
+    parser.add_argument('--xml-dir', default='xml', help='working directory (latest.EQ, the poll state)')
+    parser.add_argument('--state', default='poll.json', help='validators of the last payload, kept between two checks')
+    parser.add_argument('--metrics-json', help='append one json line per poll and stage to this file')
+    parser.add_argument('--metrics-prom', help='keep the totals in this Prometheus text file')
+    parser.add_argument('--profile-dir', help='write a cProfile dump of every poll and stage here')
+    args = parser.parse_args(argv)
+    metrics.configure(args.metrics_json, args.metrics_prom, args.profile_dir)
+
+    os.chdir(args.xml_dir)
+    if args.watch:
+        watch(args.url, args.interval)
+        return
+    pollOnce(args.url, args.state)
+
+
+def opendataUrl(cwbOpendataApi):
+    # a full url (e.g. of a local stand-in) or a path of the opendata platform
+    if cwbOpendataApi.startswith('http'):
+        return cwbOpendataApi
+    return f"https://opendata.cwb.gov.tw/{cwbOpendataApi}"
+
+
+def pollOnce(cwbOpendataApi, statePath='poll.json', store=None):
+    """
+    function pollOnce( cwbOpendataApi, statePath='poll.json', store=None )
+    
+    Module     : json
+              
+    Description: to check the opendata zip once, e.g. from cron. The validators
+                 (ETag/Last-Modified and hash) of the last payload are kept in
+                 statePath, so an unchanged zip costs one conditional request
+                 with urllib. They are saved only once the new events are
+                 processed, so a failed run is retried by the next one.
+                 
+    Parameters : cwbOpendataApi, str (see opendataUrl)
+                 statePath, str (json file)
+                 store, eventStore.EventStore (default the shared one)
+    
+    Return     : the events read from the zip, list of library.CwbEvent
+    
+    Examples of sage:
+        >> pollOnce(CWB_OPENDATA_API, 'poll.json')
+    """
+    validators = {}
+    if os.path.isfile(statePath):
+        with open(statePath) as f:
+            validators = json.load(f)
+    events = poll(None, opendataUrl(cwbOpendataApi), validators, set(), store or eventStore.EventStore())
+    library.atomicWrite(statePath, json.dumps(validators))
+    return events
+
+
+def processNewEvents(store, events, archive=None, changed=None):
+    """
+    function processNewEvents( store, events, archive=None, changed=None )
+    
+    Module     : eventStore
+                 reportArchive
+              
+    Description: to process the events not yet in the event store, in one query
+                 for all of them. latest.EQ, if present, still marks every eq id
+                 up to it as done. The reports that are new or revised are added
+                 to the report archive first, in one append, and the months
+                 appended to are compacted once their part files pile up.
+                 
+    Parameters : store, eventStore.EventStore
+                 events, list of library.CwbEvent
+                 archive, reportArchive.ReportArchive (default the one at PALERT_REPORT_ARCHIVE)
+                 changed, list of library.CwbEvent (the new or revised reports,
+                          default the events not processed yet)
+    
+    Examples of sage:
+        >> processNewEvents(eventStore.EventStore(), [library.parseCwbXml(xmlfile)])
+    """
+    floor = getLatestEqid() if os.path.isfile('latest.EQ') else None
+    newEqids = set(store.newEqids([event.eqNo for event in events], floor))
+    if changed is None:
+        changed = [event for event in events if event.eqNo in newEqids]
+    if changed:
+        import reportArchive
+        archive = archive or reportArchive.ReportArchive()
+        archive.append(changed)
+        archive.compact([reportArchive.monthOf(event.originTimeUTC) for event in changed], reportArchive.COMPACT_PARTS)
+    for event in events:
+        print('This Event: ', event.eqNo, 'New' if event.eqNo in newEqids else 'Processed')
+        if event.eqNo in newEqids:
+            store.recordEvent(event, status='received')
+            processEvent(event)
+            store.markStatus(event.eqNo, 'processed')
+            newEqids.discard(event.eqNo)
+
+
+def processEvent(event):
+    """
+    function processEvent( event )
+    
+    Description: to handle a new eq report.
+                 
+    Parameters : event, library.CwbEvent
+    
+    Examples of sage:
+        >> processEvent(library.parseCwbXml(xmlfile))
+    """
+    print(event.parameters)
+    print(event.to_dataframe())
+
+
+def watch(cwbOpendataApi, interval=1.0):
+    """
+    function watch( cwbOpendataApi, interval=1.0 )
+    
+    Module     : requests
+                 zipfile
+              
+    Description: to keep polling the CWB opendata api over one http session.
+                 Unchanged payloads are skipped (ETag/Last-Modified or content
+                 hash) and only new xml files are read, straight from the zip
+                 in memory. A poll that fails is logged and retried.
+                 
+    Parameters : cwbOpendataApi, str (see opendataUrl)
+                 interval, float (seconds between two polls)
+    
+    Examples of sage:
+        >> watch(CWB_OPENDATA_API, 1.0)
+    """
+    import requests
+    session = requests.Session()
+    validators = {}
+    seenMembers = set()
+    store = eventStore.EventStore()
+    while True:
+        # the validators only take a payload that was processed, so a failed
+        # poll (e.g. the store locked by a backfill) is tried again at the next
+        try:
+            poll(session, opendataUrl(cwbOpendataApi), validators, seenMembers, store)
+        except Exception as error:
+            print(f'Polling failed: {error!r}')
+        time.sleep(interval)
+
+
+def poll(session, url, validators, seenMembers, store):
+    """
+    function poll( session, url, validators, seenMembers, store )
+    
+    Module     : zipfile
+              
+    Description: to check the opendata zip once and process the new events of
+                 the xml files not seen before, as one metrics span. Files named
+                 after an eq id already processed are not parsed, unless their
+                 content changed (a revised report, archived again). A payload that
+                 is not a zip is downloaded again at the next poll, an xml file
+                 that cannot be parsed is read again once the payload changes.
+                 
+    Parameters : session, requests.Session or None (urllib)
+                 url, str (the opendata api)
+                 validators, dict (see fetchIfChanged)
+                 seenMembers, set ((name, CRC-32) of the files already read, updated in place)
+                 store, eventStore.EventStore
+    
+    Return     : the events read from the new xml files, list of library.CwbEvent
+    
+    Examples of sage:
+        >> events = poll(requests.Session(), url, {}, set(), eventStore.EventStore())
+    """
+    events = []
+    with metrics.span('poll') as record:
+        # the validators and member names are recorded only once read, so a
+        # truncated payload is downloaded again and a bad file tried again
+        fresh = dict(validators)
+        try:
+            content = fetchIfChanged(session, url, fresh)
+        except OSError as error:
+            # requests.RequestException and urllib.error.URLError are both OSError
+            print('Polling failed:', error)
+            content = None
+        record['changed'] = content is not None
+        if content is None:
+            validators.update(fresh)
+            return events
+        import zipfile
+        try:
+            with zipfile.ZipFile(io.BytesIO(content)) as zf:
+                # a file is new or revised by its name and the CRC-32 of the zip
+                # directory, so unchanged files are not even decompressed
+                crcs = {info.filename: info.CRC for info in zf.infolist() if (info.filename, info.CRC) not in seenMembers}
+                names = sorted(name for name in crcs if name.endswith('.xml'))
+                changedNames = set(store.changedReports({name: crcs[name] for name in names}))
+                unprocessed = set(unprocessedMembers(store, names))
+                changed, archived, failed = [], {}, set()
+                for name in names:
+                    if name not in changedNames and name not in unprocessed:
+                        continue
+                    try:
+                        with zf.open(name) as xmlfile:
+                            event = library.parseCwbXml(xmlfile)
+                    except Exception as error:
+                        # e.g. xml.etree.ElementTree.ParseError, zlib.error
+                        print(f'{name} is not readable: {error!r}')
+                        failed.add(name)
+                        continue
+                    events.append(event)
+                    if name in changedNames:
+                        changed.append(event)
+                        archived[name] = crcs[name]
+        except zipfile.BadZipFile as error:
+            print('Polling failed, the payload is not a zip:', error)
+            record['changed'] = False
+            return events
+        record['events'] = len(events)
+        processNewEvents(store, events, changed=changed)
+        store.recordReports(archived)
+        seenMembers.update((name, crc) for name, crc in crcs.items() if name not in failed)
+        validators.update(fresh)
+    return events
+
+
+def unprocessedMembers(store, names):
+    # eq ids read from the file names (CWB-EQ110091-2021-0901-062756.xml) spare
+    # parsing the reports already processed; files not named so are kept
+    floor = getLatestEqid() if os.path.isfile('latest.EQ') else None
+    eqids = {}
+    for name in names:
+        match = re.match(r'CWB-EQ(\d+)\D', os.path.basename(name))
+        eqids[name] = int(match.group(1)) if match else None
+    newEqids = set(store.newEqids([eqid for eqid in eqids.values() if eqid is not None], floor))
+    members = []
+    for name, eqid in eqids.items():
+        if eqid is None or eqid in newEqids:
+            members.append(name)
+        else:
+            print('This Event: ', eqid, 'Processed')
+    return members
+
+
+def fetchIfChanged(session, url, validators, timeout=10):
+    """
+    function fetchIfChanged( session, url, validators, timeout=10 )
+    
+    Module     : hashlib
+                 requests or urllib
+              
+    Description: to download url only if it changed since the last call.
+                 validators keeps the ETag, Last-Modified and sha1 of the last
+                 payload and is updated in place.
+                 
+    Parameters : session, requests.Session, or None to use urllib (no requests import)
+                 url, str
+                 validators, dict (empty at the first call)
+                 timeout, float (seconds)
+    
+    Return     : the payload, bytes, or None if it did not change
+    
+    Examples of sage:
+        >> validators = {}
+        >> content = fetchIfChanged(requests.Session(), url, validators)
+    """
+    headers = {}
+    if 'etag' in validators:
+        headers['If-None-Match'] = validators['etag']
+    if 'lastModified' in validators:
+        headers['If-Modified-Since'] = validators['lastModified']
+    if session is None:
+        import urllib.error
+        import urllib.request
+        try:
+            with urllib.request.urlopen(urllib.request.Request(url, headers=headers), timeout=timeout) as response:
+                content, responseHeaders = response.read(), response.headers
+        except urllib.error.HTTPError as error:
+            if error.code == 304:
+                return None
+            raise
+    else:
+        response = session.get(url, headers=headers, timeout=timeout)
+        if response.status_code == 304:
+            return None
+        response.raise_for_status()
+        content, responseHeaders = response.content, response.headers
+    import hashlib
+    metrics.count('bytesDownloaded', len(content))
+    for key, header in [('etag', 'ETag'), ('lastModified', 'Last-Modified')]:
+        if header in responseHeaders:
+            validators[key] = responseHeaders[header]
+    digest = hashlib.sha1(content).hexdigest()
+    if validators.get('sha1') == digest:
+        return None
+    validators['sha1'] = digest
+    return content
+
 
 def downloadXMLfiles(cwbOpendataApi, filename):
     """
@@ -41,10 +321,10 @@ def downloadXMLfiles(cwbOpendataApi, filename):
     Author: Chaoyi Chen
     Date: Fall 2021
     
-    Module     : os
-                 wget
+    Module     : asyncFetch
               
-    Description: to download xmlfiles with eq information from CWB opendata api.
+    Description: to download xmlfiles with eq information from CWB opendata api,
+                 with a deadline and retries.
                  
     Parameters : cwbOpendataApi, str
                  filename, str (output filename)
@@ -52,9 +332,11 @@ def downloadXMLfiles(cwbOpendataApi, filename):
     Examples of sage:
         >> downloadXMLfiles(cwbOpendataApi, zipfile)
     """
-    if os.path.isfile(filename):
-        os.remove(filename)
-    wget.download(f"https://opendata.cwb.gov.tw/{cwbOpendataApi}", out=filename)
+    import asyncFetch
+    import asyncio
+    fetcher = asyncFetch.Fetcher(concurrency=1)
+    response = asyncio.run(fetcher.get(opendataUrl(cwbOpendataApi)))
+    library.atomicWrite(filename, response.content)
 
 
 def getEqid(filename):
@@ -64,7 +346,7 @@ def getEqid(filename):
     Author: Chaoyi Chen
     Date: Fall 2021
     
-    Module     : ET (xml.etree.ElementTree)
+    Module     : library
               
     Description: to get the eq id number.
                  
@@ -78,11 +360,7 @@ def getEqid(filename):
         >> print(getEqid(f"{xmlFolder}/{xmlfile}"))
         110091
     """
-    tree = ET.parse(filename)
-    root = tree.getroot()
-    ns = {'d': root.tag.split('}')[0].strip('{')}
-    eqid = root.find('d:dataset/d:earthquake/d:earthquakeNo', ns).text
-    return int(eqid)
+    return library.parseCwbXml(filename).eqNo
 
 
 def getLatestEqid():
@@ -0,0 +1,407 @@
+# to fetch over the network with deadlines, retries and the fetches of many
+# events overlapping
+#
+# asyncio schedules the requests: every attempt runs under a semaphore, and a
+# request with all its retries (jittered exponential backoff) under a deadline.
+# The attempts use the clients the workflow already has, the shared requests
+# session of cwbReport and the ftp pool of ntuArchive, in worker threads. Their
+# socket timeout ends an attempt that stalls (no byte for timeout seconds), and
+# an attempt abandoned at the deadline stops at its next chunk, so a stalled
+# connection frees its thread as well.
+#
+# Archives are downloaded to <name>.part and resumed from its size (REST) by
+# the next attempt, or the next run.
+
+import asyncio
+import cwbReport
+import ftplib
+import metrics
+import ntuArchive
+import os
+import random
+import threading
+import time
+from typing import NamedTuple
+
+CHUNK_SIZE = 65536
+
+
+class Response(NamedTuple):
+    status: int
+    headers: dict  # case insensitive (requests.structures.CaseInsensitiveDict)
+    content: bytes
+
+
+class Abandoned(Exception):
+    """Raised in the thread of an attempt that was given up, at its next chunk."""
+
+
+def retryable(error):
+    """
+    function retryable( error )
+
+    Description: to tell transient errors (connection, timeout, 5xx, 429, ftp 4xx)
+                 from permanent ones (http 4xx, ftp 5xx such as a missing file,
+                 parsing errors), which are raised at once.
+
+    Parameters : error, BaseException
+
+    Return     : bool
+
+    Examples of sage:
+        >> print(retryable(ftplib.error_perm('550 no such file')))
+        False
+    """
+    if isinstance(error, Abandoned) or isinstance(error, ftplib.error_perm):
+        return False
+    status = getattr(getattr(error, 'response', None), 'status_code', None)
+    if status is not None and status < 500 and status != 429:
+        return False
+    return isinstance(error, (OSError, EOFError, ftplib.Error, asyncio.TimeoutError))
+
+
+class Fetcher():
+    """
+    class Fetcher
+
+    Module     : asyncio
+
+    Description: runs blocking fetches (the attempts) with at most concurrency of
+                 them at once. An attempt fails after timeout seconds without
+                 progress, a fetch gets deadline seconds in all from its first
+                 attempt (not counting the wait for a free slot), and a transient
+                 failure is retried after a random delay of up to backoff * 2**n
+                 seconds (at most maxBackoff), while attempts and time remain.
+
+    Examples of sage:
+        >> fetcher = Fetcher(concurrency=8, deadline=120)
+        >> report, archive = asyncio.run(fetcher.event(url, '/home/palert/data'))
+    """
+    def __init__(self, concurrency=8, timeout=30, deadline=120, attempts=5, backoff=0.5, maxBackoff=8.0,
+                 session=None, pool=None):
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.deadline = deadline
+        self.attempts = attempts
+        self.backoff = backoff
+        self.maxBackoff = maxBackoff
+        self.session = session
+        # the socket timeout of every ftp command and transfer is the attempt timeout
+        self.pool = pool or ntuArchive.FtpPool(size=concurrency, timeout=timeout)
+        self.__semaphore = (None, None)
+        self.__pathLocks = {}
+        self.__pathLocksLock = threading.Lock()
+
+    async def call(self, attempt, description='fetch', deadline=None):
+        """
+        function call( attempt, description='fetch', deadline=None )
+
+        Description: to run attempt(timeout, abandoned) in a worker thread until
+                     it succeeds, fails permanently or the deadline passes.
+                     timeout is the socket timeout the attempt should use;
+                     abandoned (threading.Event) is set when the attempt is given
+                     up, which should then raise Abandoned.
+
+        Parameters : attempt, callable
+                     description, str (for the errors)
+                     deadline, float (seconds, default self.deadline)
+
+        Return     : what attempt returns
+
+        Examples of sage:
+            >> names = await fetcher.call(lambda timeout, abandoned: index.names('202201'), 'listing')
+        """
+        # a semaphore belongs to one event loop, e.g. of one asyncio.run
+        loop = asyncio.get_running_loop()
+        if self.__semaphore[0] is not loop:
+            self.__semaphore = (loop, asyncio.Semaphore(self.concurrency))
+        semaphore = self.__semaphore[1]
+        # the deadline runs from the first attempt that gets a slot: time queued
+        # behind other fetches before it does not count, backoff and the waits
+        # for a slot between retries do
+        deadline = self.deadline if deadline is None else deadline
+        end = None
+        lastError = None
+        for n in range(self.attempts):
+            abandoned = threading.Event()
+            try:
+                async with semaphore:
+                    if end is None:
+                        end = time.monotonic() + deadline
+                    remaining = end - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    return await asyncio.wait_for(asyncio.to_thread(attempt, min(self.timeout, remaining), abandoned),
+                                                  remaining)
+            except BaseException as error:
+                abandoned.set()
+                if not isinstance(error, Exception) or not retryable(error):
+                    raise
+                lastError = error
+            delay = random.uniform(0, min(self.maxBackoff, self.backoff * 2 ** n))
+            if n == self.attempts - 1 or time.monotonic() + delay >= end:
+                break
+            print(f'{description} failed ({lastError!r}), retrying in {delay:.1f} s')
+            await asyncio.sleep(delay)
+        if lastError is None:
+            raise asyncio.TimeoutError(f'{description} had no time left before its deadline')
+        raise lastError
+
+    async def get(self, url, headers=None, deadline=None):
+        """
+        function get( url, headers=None, deadline=None )
+
+        Module     : requests
+
+        Description: to download url over the shared session of cwbReport. 304
+                     is returned as it is, the other errors are raised.
+
+        Parameters : url, str
+                     headers, dict
+                     deadline, float (seconds)
+
+        Return     : Response
+
+        Examples of sage:
+            >> html = (await fetcher.get(reportUrl)).content.decode('utf-8')
+        """
+        session = self.session or cwbReport.getSession()
+
+        def attempt(timeout, abandoned):
+            with session.get(url, headers=headers, timeout=timeout, stream=True) as response:
+                if response.status_code != 304:
+                    response.raise_for_status()
+                chunks = []
+                for chunk in response.iter_content(CHUNK_SIZE):
+                    if abandoned.is_set():
+                        raise Abandoned(url)
+                    metrics.count('bytesDownloaded', len(chunk))
+                    chunks.append(chunk)
+                return Response(response.status_code, response.headers, b''.join(chunks))
+
+        return await self.call(attempt, url, deadline)
+
+    async def getIfChanged(self, url, validators, deadline=None):
+        """
+        function getIfChanged( url, validators, deadline=None )
+
+        Description: alertEQ.fetchIfChanged over this fetcher, e.g. the opendata
+                     feed polled beside the events being fetched.
+
+        Parameters : url, str
+                     validators, dict (see alertEQ.fetchIfChanged)
+                     deadline, float (seconds)
+
+        Return     : the payload, bytes, or None if it did not change
+
+        Examples of sage:
+            >> content = await fetcher.getIfChanged(feedUrl, validators)
+        """
+        import hashlib
+        headers = {}
+        if 'etag' in validators:
+            headers['If-None-Match'] = validators['etag']
+        if 'lastModified' in validators:
+            headers['If-Modified-Since'] = validators['lastModified']
+        response = await self.get(url, headers, deadline)
+        if response.status == 304:
+            return None
+        for key, header in [('etag', 'ETag'), ('lastModified', 'Last-Modified')]:
+            if header in response.headers:
+                validators[key] = response.headers[header]
+        digest = hashlib.sha1(response.content).hexdigest()
+        if validators.get('sha1') == digest:
+            return None
+        validators['sha1'] = digest
+        return response.content
+
+    async def report(self, url, deadline=None):
+        # the eq parameters of a CWB earthquake report page, cwbReport.EqReport
+        response = await self.get(url, deadline=deadline)
+        return cwbReport.parseReport(response.content.decode('utf-8'))
+
+    async def archiveName(self, originTimeUTC, dataDir, deadline=None):
+        # the NTU archive starting 2 min before the origin, as NTUData finds it
+        index = ntuArchive.getIndex(f'{dataDir}/ntuArchiveIndex.json')
+        month = f'{originTimeUTC.year}{originTimeUTC.month:02d}'
+        return await self.call(lambda timeout, abandoned: index.nearest(originTimeUTC - 120, tolerance=1, month=month),
+                               f'events/{month} listing', deadline)
+
+    def __pathLock(self, path):
+        # an abandoned attempt may still be writing the part file the next one resumes
+        with self.__pathLocksLock:
+            return self.__pathLocks.setdefault(path, threading.Lock())
+
+    async def ftpDownload(self, remoteDir, remoteName, localPath, deadline=None):
+        """
+        function ftpDownload( remoteDir, remoteName, localPath, deadline=None )
+
+        Module     : ftplib
+
+        Description: to download a file of the NTU ftp server to localPath. The
+                     bytes go to localPath.part, which every attempt resumes from
+                     its size (REST), and which is renamed once it has the SIZE
+                     of the remote file. An existing localPath is not fetched again.
+
+        Parameters : remoteDir, str (e.g. events/202201)
+                     remoteName, str
+                     localPath, str
+                     deadline, float (seconds)
+
+        Return     : localPath
+
+        Examples of sage:
+            >> path = await fetcher.ftpDownload('events/202201', '20220107_211019_MAN.tar.bz2', 'archive.tar.bz2')
+        """
+        if os.path.exists(localPath):
+            return localPath
+        partPath = f'{localPath}.part'
+        os.makedirs(os.path.dirname(os.path.abspath(localPath)), exist_ok=True)
+
+        def attempt(timeout, abandoned):
+            with self.__pathLock(partPath), self.pool.connection() as ftp:
+                ftp.cwd(remoteDir)
+                ftp.voidcmd('TYPE I')
+                size = ftp.size(remoteName)
+                offset = os.path.getsize(partPath) if os.path.exists(partPath) else 0
+                if offset > size:
+                    offset = 0
+                if offset < size:
+                    with open(partPath, 'ab' if offset else 'wb') as f:
+                        def received(chunk):
+                            if abandoned.is_set():
+                                raise Abandoned(remoteName)
+                            metrics.count('bytesDownloaded', len(chunk))
+                            f.write(chunk)
+
+                        ftp.retrbinary(f'RETR {remoteName}', received, CHUNK_SIZE, rest=offset or None)
+                received = os.path.getsize(partPath)
+                if received != size:
+                    raise EOFError(f'{remoteName}: {received} of {size} bytes received')
+                os.replace(partPath, localPath)
+                return localPath
+
+        return await self.call(attempt, f'{remoteDir}/{remoteName}', deadline)
+
+    async def event(self, reportUrl, dataDir):
+        """
+        function event( reportUrl, dataDir )
+
+        Description: to fetch what an Earthquake needs from the network: the
+                     report page, then the NTU archive, downloaded under
+                     dataDir/SAC/YYYYMM like downloadData does.
+
+        Parameters : reportUrl, str
+                     dataDir, str
+
+        Return     : cwbReport.EqReport, the path of the archive
+
+        Examples of sage:
+            >> report, archive = await fetcher.event(url, '/home/palert/data')
+            >> event = NTUData.Earthquake(url, report=report)
+            >> event.downloadData(inMemory=True, archivePath=archive)
+        """
+        report = await self.report(reportUrl)
+        folder = await self.archiveName(report.originTimeUTC, dataDir)
+        if folder is None:
+            raise LookupError(f'{report.eqNo} has no archive on the NTU server.')
+        month = f'{report.originTimeUTC.year}{report.originTimeUTC.month:02d}'
+        path = await self.ftpDownload(f'events/{month}', f'{folder}.tar.bz2', f'{dataDir}/SAC/{month}/{folder}.tar.bz2')
+        return report, path
+
+    def close(self):
+        self.pool.close()
+
+
+class EventWindow():
+    """
+    class EventWindow
+
+    Module     : asyncio
+
+    Description: at most size events of fetchAll between the start of their
+                 fetch and release(), e.g. until another thread has read and
+                 removed their archive, so the downloads stay a bounded number
+                 of events ahead of the processing. release() may be called
+                 from any thread.
+
+    Examples of sage:
+        >> window = EventWindow(12)
+        >> asyncio.run(fetchAll(fetcher, urls, '/home/palert/data', onEvent=onEvent, window=window))
+        >> window.release()  # in the thread that removed an archive
+    """
+    def __init__(self, size):
+        self.size = size
+        self.__lock = threading.Lock()
+        self.__semaphore = (None, None)
+
+    async def acquire(self):
+        # a semaphore belongs to one event loop, e.g. of one asyncio.run
+        loop = asyncio.get_running_loop()
+        with self.__lock:
+            if self.__semaphore[0] is not loop:
+                self.__semaphore = (loop, asyncio.Semaphore(self.size))
+            semaphore = self.__semaphore[1]
+        await semaphore.acquire()
+
+    def release(self):
+        with self.__lock:
+            loop, semaphore = self.__semaphore
+        if loop is None:
+            return
+        try:
+            loop.call_soon_threadsafe(semaphore.release)
+        except RuntimeError:
+            # the loop has finished, nothing waits for the place any more
+            pass
+
+
+async def fetchAll(fetcher, reportUrls, dataDir, feedUrl=None, validators=None, onEvent=None, window=None):
+    """
+    function fetchAll( fetcher, reportUrls, dataDir, feedUrl=None, validators=None, onEvent=None, window=None )
+
+    Module     : asyncio
+
+    Description: to poll the opendata feed and fetch every event at the same
+                 time; the report pages, listings and archives of different
+                 events overlap, up to the concurrency of the fetcher.
+
+    Parameters : fetcher, Fetcher
+                 reportUrls, list of str
+                 dataDir, str
+                 feedUrl, str or None (the opendata api)
+                 validators, dict (see alertEQ.fetchIfChanged)
+                 onEvent, callable(url, result) called as soon as an event is
+                          fetched, result being (EqReport, archive path) or the error
+                 window, EventWindow or None (a fetched event keeps its place
+                         until window.release(), a failed one gives it back)
+
+    Return     : the feed payload (or None, or the error), and a dict of url -> result
+
+    Examples of sage:
+        >> feed, events = asyncio.run(fetchAll(Fetcher(), urls, '/home/palert/data', feedUrl, {}))
+    """
+    async def one(url):
+        if window is not None:
+            await window.acquire()
+        try:
+            result = await fetcher.event(url, dataDir)
+        except Exception as error:
+            result = error
+            if window is not None:
+                window.release()
+        if onEvent is not None:
+            onEvent(url, result)
+        return result
+
+    async def feed():
+        if feedUrl is None:
+            return None
+        try:
+            return await fetcher.getIfChanged(feedUrl, {} if validators is None else validators)
+        except Exception as error:
+            return error
+
+    reportUrls = list(reportUrls)
+    feedResult, *results = await asyncio.gather(feed(), *[one(url) for url in reportUrls])
+    return feedResult, dict(zip(reportUrls, results))
@@ -0,0 +1,226 @@
+# to reprocess many earthquake reports in one process
+#
+# The events go through four stages connected by bounded queues:
+#   download (asyncio)      : report pages, NTU folder lookups and archives of many
+#                             events at once (asyncFetch), the archives to disk, at
+#                             most fetchConcurrency + queueSize events ahead of fetch
+#   fetch    (threads)      : decompress the archive into memory
+#   process  (process pool) : cut both windows, envelopes, PGAs, PGA file, accumulated PGAs
+#   publish  (threads)      : contour and animation scripts, or the native grids
+#
+# NTUData and asyncFetch (obspy, pandas, ...) are imported by backfill, not by --help.
+
+import argparse
+import asyncio
+import metrics
+import multiprocessing
+import os
+import queue
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+CWB_REPORT_URL = 'https://scweb.cwb.gov.tw/en-us/earthquake/imgs'
+_DONE = object()
+
+
+def reportUrl(report):
+    """
+    function reportUrl( report )
+
+    Description: to get the url of a CWB earthquake report from its url or id.
+
+    Parameters : report, str (url or id of the report)
+
+    Return     : url, str
+
+    Examples of sage:
+        >> print(reportUrl('ee2022010805121947003'))
+        https://scweb.cwb.gov.tw/en-us/earthquake/imgs/ee2022010805121947003
+    """
+    if report.startswith('http'):
+        return report
+    return f'{CWB_REPORT_URL}/{report}'
+
+
+def fetchEvent(report, store=None, dataDir=None, webDir=None, fetched=None):
+    # fetched: the (cwbReport.EqReport, archive path) of asyncFetch, or None to
+    # fetch both here, with the same deadline, retries and resume
+    import NTUData
+    if fetched is None:
+        import asyncFetch
+        fetcher = asyncFetch.Fetcher(concurrency=1)
+        try:
+            fetched = asyncio.run(fetcher.event(reportUrl(report), dataDir or NTUData.DATA_DIR))
+        finally:
+            fetcher.close()
+    eqReport, archivePath = fetched
+    try:
+        event = NTUData.Earthquake(reportUrl(report), store, dataDir or NTUData.DATA_DIR, webDir or NTUData.WEB_DIR, report=eqReport)
+        event.downloadData(streaming=True, inMemory=True, archivePath=archivePath)
+    finally:
+        # read or not, the archive is not kept (a later run downloads it again)
+        os.remove(archivePath)
+    return event
+
+
+def processEvent(event):
+    # runs in a worker process; the waveforms are dropped before the event is sent back
+    event.processData(f'{event.dir}/{event.folder2minAgo}', -120, 480)
+    event.buildEnvelopes(f'{event.dir}/{event.folder2minAgo}')
+    event.processData(f'{event.dir}/{event.folder20secAgo}', -20, 100)
+    event.getPGAsDataframe()
+    event.getPGAsFilename()
+    event.getPGAsFile()
+    event.saveStaInfo2Sac()
+    event.accum3sPGAs()
+    event.rawStream = None
+    event.streams = {}
+    return event
+
+
+def publishEvent(event, nativeGrid=False):
+    event.contourMulti(nativeGrid)
+    event.accum3sPGAsPlot(nativeGrid)
+    return event
+
+
+def _stageWorker(inbox, outbox, work, results):
+    while True:
+        item = inbox.get()
+        if item is _DONE:
+            return
+        report, value = item
+        try:
+            value = work(value)
+        except (Exception, SystemExit) as error:
+            print(f'{report} failed: {error!r}')
+            results[report] = error
+            continue
+        if outbox is None:
+            results[report] = 'done'
+        else:
+            outbox.put((report, value))
+
+
+def _download(urls, dataDir, fetcher, outbox, results, window):
+    # report pages and archives of the events concurrently, each event handed
+    # on as soon as it is on disk; a new one starts when fetch releases the window
+    import asyncFetch
+
+    def onEvent(url, result):
+        if isinstance(result, Exception):
+            print(f'{urls[url]} failed: {result!r}')
+            results[urls[url]] = result
+        else:
+            outbox.put((urls[url], (urls[url], result)))
+
+    try:
+        asyncio.run(asyncFetch.fetchAll(fetcher, list(urls), dataDir, onEvent=onEvent, window=window))
+    finally:
+        fetcher.close()
+
+
+def backfill(reports, ioWorkers=4, cpuWorkers=None, queueSize=4, store=None,
+             dataDir=None, webDir=None, nativeGrid=False, fetchConcurrency=8):
+    """
+    function backfill( reports, ioWorkers=4, cpuWorkers=None, queueSize=4, store=None,
+                       dataDir=None, webDir=None, nativeGrid=False, fetchConcurrency=8 )
+
+    Module     : asyncio
+                 concurrent.futures
+                 queue
+                 threading
+
+    Description: to run many events through the Earthquake workflow at once. The
+                 downloads overlap on one event loop (asyncFetch), loading and
+                 publishing run on threads, cutting and PGAs on a process pool.
+                 At most fetchConcurrency + queueSize archives are downloading
+                 or waiting on disk, and at most queueSize events wait between
+                 two later stages in memory.
+
+    Parameters : reports, list of str (urls or ids of CWB earthquake reports)
+                 ioWorkers, int (threads for the fetch and publish stages)
+                 cpuWorkers, int (processes, default os.cpu_count())
+                 queueSize, int (events allowed to wait between two stages)
+                 store, eventStore.EventStore or None (to record finished stages)
+                 dataDir, webDir, str (see NTUData.Earthquake, default NTUData.DATA_DIR and WEB_DIR)
+                 nativeGrid, bool (grid and contour in python instead of the gmt scripts)
+                 fetchConcurrency, int (requests and transfers at the same time)
+
+    Return     : a dict of report -> 'done' or the exception that stopped it
+
+    Examples of sage:
+        >> print(backfill(['ee2022010805121947003', 'ee2022010901050646004']))
+    """
+    import asyncFetch
+    import NTUData
+    dataDir = dataDir or NTUData.DATA_DIR
+    cpuWorkers = cpuWorkers or os.cpu_count()
+    results = {}
+    pending = queue.Queue()
+    fetched = queue.Queue(queueSize)
+    processed = queue.Queue(queueSize)
+    window = asyncFetch.EventWindow(fetchConcurrency + queueSize)
+    downloader = threading.Thread(target=_download, daemon=True,
+                                  args=({reportUrl(report): report for report in reports}, dataDir,
+                                        asyncFetch.Fetcher(fetchConcurrency), pending, results, window))
+    downloader.start()
+
+    # forkserver, not fork: a fork while a thread of this process holds a lock
+    # (metrics counters, the ftp pool, the catalog or grid caches) would leave
+    # the worker waiting for it forever
+    with ProcessPoolExecutor(cpuWorkers, mp_context=multiprocessing.get_context('forkserver'),
+                             initializer=metrics.configureWorker, initargs=(metrics.workerSettings(),)) as pool:
+        def fetch(item):
+            try:
+                return fetchEvent(item[0], store, dataDir, webDir, item[1])
+            finally:
+                window.release()
+
+        stages = [(pending, fetched, fetch, ioWorkers),
+                  (fetched, processed, lambda event: pool.submit(processEvent, event).result(), cpuWorkers),
+                  (processed, None, lambda event: publishEvent(event, nativeGrid), ioWorkers)]
+        running = []
+        for inbox, outbox, work, workers in stages:
+            threads = [threading.Thread(target=_stageWorker, args=(inbox, outbox, work, results), daemon=True)
+                       for i in range(workers)]
+            for thread in threads:
+                thread.start()
+            running.append((inbox, threads))
+        # a stage is told to stop only once everything before it has finished
+        downloader.join()
+        for inbox, threads in running:
+            for thread in threads:
+                inbox.put(_DONE)
+            for thread in threads:
+                thread.join()
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='reprocess many CWB earthquake reports')
+    parser.add_argument('reports', nargs='*', help='urls or ids of CWB earthquake reports')
+    parser.add_argument('--file', help='a file with one report url or id per line')
+    parser.add_argument('--io-workers', type=int, default=4)
+    parser.add_argument('--cpu-workers', type=int, default=None)
+    parser.add_argument('--queue-size', type=int, default=4)
+    parser.add_argument('--fetch-concurrency', type=int, default=8, help='requests and ftp transfers at the same time')
+    parser.add_argument('--native-grid', action='store_true', help='grid and contour without gmt')
+    parser.add_argument('--metrics-json', help='append one json line per stage to this file')
+    parser.add_argument('--metrics-prom', help='keep the totals in this Prometheus text file')
+    parser.add_argument('--profile-dir', help='write a cProfile dump of every stage here')
+    args = parser.parse_args(argv)
+    metrics.configure(args.metrics_json, args.metrics_prom, args.profile_dir)
+
+    reports = list(args.reports)
+    if args.file:
+        with open(args.file) as f:
+            reports += [line.strip() for line in f if line.strip()]
+    results = backfill(reports, args.io_workers, args.cpu_workers, args.queue_size, nativeGrid=args.native_grid,
+                       fetchConcurrency=args.fetch_concurrency)
+    for report in reports:
+        print(report, results.get(report))
+
+
+if __name__ == "__main__":
+    main()
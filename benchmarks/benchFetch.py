@@ -0,0 +1,143 @@
+# to check the fetch layer (asyncFetch) against the local stand-ins of
+# mockServices.py, offline, and to time concurrent against one-at-a-time fetching
+#
+#   resume   : the data connection drops twice, the archive is resumed (REST)
+#   stall    : the server stops sending, the socket timeout ends the attempt
+#   deadline : the server always stalls, the fetch gives up at its deadline
+#   retry    : the report page answers 503 twice, then the page
+#   permanent: a missing report page (404) is not retried
+#   queued   : a fetch that waited behind others still gets its deadline and retries
+#   overlap  : the feed and every event at once, against one at a time
+#
+# Exits with 1 if a check fails.
+#
+# usage: python benchmarks/benchFetch.py --events 8 --delay 0.2
+
+import argparse
+import asyncio
+import filecmp
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import mockServices
+
+
+def check(name, condition, detail=''):
+    print(f"{'ok    ' if condition else 'FAILED'} {name:<10} {detail}")
+    return condition
+
+
+def main():
+    parser = argparse.ArgumentParser(description='check asyncFetch against the local stand-ins')
+    parser.add_argument('--events', type=int, default=8)
+    parser.add_argument('--stations', type=int, default=20)
+    parser.add_argument('--delay', type=float, default=0.2, help='seconds the http stand-in waits before every answer')
+    parser.add_argument('--cache-dir', default=os.path.join(tempfile.gettempdir(), 'palertBench'))
+    args = parser.parse_args()
+
+    from obspy import UTCDateTime
+    ftpRoot = f'{args.cache_dir}/ftp'
+    events = [mockServices.SyntheticEvent(args.stations, UTCDateTime(2022, 3, 1, 12) + k * 86400 + args.stations * 30,
+                                          eqNo=400000 + k, seconds=60)
+              for k in range(args.events)]
+    archives = [mockServices.ensureArchive(event, ftpRoot)[0] for event in events]
+    ftp = mockServices.FtpServer(ftpRoot, stallSeconds=5)
+    cwb = mockServices.CwbServer()
+    for event in events:
+        cwb.addEvent(event, 20)
+    # read when ntuArchive is imported
+    os.environ['PALERT_NTU_FTP_HOST'] = '127.0.0.1'
+    os.environ['PALERT_NTU_FTP_PORT'] = str(ftp.port)
+    import asyncFetch
+
+    workDir = tempfile.mkdtemp(prefix='benchFetch', dir=args.cache_dir)
+    remoteDir = f'events/{os.path.basename(os.path.dirname(archives[0]))}'
+    remoteName = os.path.basename(archives[0])
+    size = os.path.getsize(archives[0])
+    passed = True
+    try:
+        fetcher = asyncFetch.Fetcher(timeout=1, deadline=20, backoff=0.1)
+        ftp.faults = [('drop', size // 3), ('drop', size // 2)]
+        start = ftp.retrieved
+        path = asyncio.run(fetcher.ftpDownload(remoteDir, remoteName, f'{workDir}/resume.tar.bz2'))
+        passed &= check('resume', filecmp.cmp(path, archives[0], shallow=False) and ftp.retrieved - start == 3,
+                        f'{ftp.retrieved - start} transfers of {size} bytes')
+
+        ftp.faults = [('stall', size // 2)]
+        t = time.perf_counter()
+        path = asyncio.run(fetcher.ftpDownload(remoteDir, remoteName, f'{workDir}/stall.tar.bz2'))
+        passed &= check('stall', filecmp.cmp(path, archives[0], shallow=False), f'{time.perf_counter() - t:.1f} s')
+
+        ftp.faults = [('stall', 1000)] * 100
+        t = time.perf_counter()
+        try:
+            asyncio.run(fetcher.ftpDownload(remoteDir, remoteName, f'{workDir}/deadline.tar.bz2', deadline=3))
+            passed &= check('deadline', False, 'finished although the server stalls')
+        except Exception as error:
+            wall = time.perf_counter() - t
+            passed &= check('deadline', wall < 4.5, f'gave up after {wall:.1f} s: {error!r}')
+        ftp.faults = []
+
+        cwb.failures = 2
+        start = cwb.requests
+        report = asyncio.run(fetcher.report(cwb.reportUrl(events[0])))
+        passed &= check('retry', report.eqNo == events[0].eqNo and cwb.requests - start == 3,
+                        f'{cwb.requests - start} requests')
+
+        start = cwb.requests
+        try:
+            asyncio.run(fetcher.report(f'{cwb.url}/en-us/earthquake/imgs/missing'))
+            passed &= check('permanent', False, 'a missing page was returned')
+        except Exception as error:
+            passed &= check('permanent', cwb.requests - start == 1, f'{cwb.requests - start} request: {error!r}')
+        fetcher.close()
+
+        fetcher = asyncFetch.Fetcher(concurrency=1, deadline=1, backoff=0.1)
+        attempts = []
+
+        def attempt(timeout, abandoned):
+            attempts.append(timeout)
+            time.sleep(0.3)
+            if len(attempts) == 3:
+                raise ConnectionResetError('reset by the stand-in')
+            return len(attempts)
+
+        async def queued():
+            return await asyncio.gather(*[fetcher.call(attempt, f'queued {k}') for k in range(3)])
+
+        try:
+            results = asyncio.run(queued())
+            passed &= check('queued', len(attempts) == 4 and results[2] == 4,
+                            f'{len(attempts)} attempts for 3 fetches behind one slot')
+        except Exception as error:
+            passed &= check('queued', False, f'{len(attempts)} attempts, then {error!r}')
+        fetcher.close()
+
+        cwb.delay = args.delay
+        urls = [cwb.reportUrl(event) for event in events]
+        walls = {}
+        for concurrency in [1, 8]:
+            fetcher = asyncFetch.Fetcher(concurrency)
+            dataDir = f'{workDir}/concurrency{concurrency}'
+            os.makedirs(dataDir)
+            t = time.perf_counter()
+            feed, results = asyncio.run(asyncFetch.fetchAll(fetcher, urls, dataDir, cwb.feedUrl(), {}))
+            walls[concurrency] = time.perf_counter() - t
+            fetcher.close()
+            errors = [result for result in results.values() if isinstance(result, Exception)]
+            passed &= check(f'overlap {concurrency}', not errors and feed is not None and
+                            all(filecmp.cmp(result[1], archive, shallow=False)
+                                for result, archive in zip(results.values(), archives)),
+                            f'feed and {len(urls)} events in {walls[concurrency]:.2f} s {errors[:1]}')
+        print(f'\n{walls[1] / walls[8]:.1f}x faster with 8 at once ({args.delay} s per http answer)')
+    finally:
+        ftp.close()
+        cwb.close()
+    sys.exit(0 if passed else 1)
+
+
+if __name__ == "__main__":
+    main()
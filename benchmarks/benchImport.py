@@ -0,0 +1,111 @@
+# to keep the cron poll fast: a poll that finds no new event should cost little
+# more than the interpreter start
+#
+# `palert.py poll` is run against the local CWB stand-in of mockServices.py:
+# once to process the synthetic event, then repeatedly with the feed unchanged
+# (a 304). Those runs and `palert.py <command> --help` must not import any of
+# HEAVY_MODULES, and the median of the unchanged polls, less the start of a bare
+# interpreter, must stay within the budget. Exits with 1 otherwise, so it can
+# run before a deployment.
+#
+# The budget is loose on purpose: the poll imports urllib, argparse and sqlite3
+# (tens of ms), a heavy module alone (pandas, obspy) costs hundreds.
+#
+# usage: python benchmarks/benchImport.py
+#        python benchmarks/benchImport.py --budget 60 --repeat 20
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import mockServices
+
+REPO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+HEAVY_MODULES = ['numpy', 'pandas', 'obspy', 'scipy', 'matplotlib', 'requests', 'bs4', 'wget']
+
+
+def importTimes(stderr):
+    # cumulative microseconds of every module of a -X importtime run, and
+    # whether it was imported at the top level (not by another module)
+    modules = {}
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        selfTime, cumulative, name = line[len('import time:'):].split('|')
+        modules[name.strip()] = (int(cumulative), name[1:2] != ' ')
+    return modules
+
+
+def timePython(args, env=None):
+    t = time.perf_counter()
+    result = subprocess.run([sys.executable, *args], env=env, capture_output=True, text=True)
+    return time.perf_counter() - t, result
+
+
+def run(args, env, importtime=False):
+    wall, result = timePython([*(['-X', 'importtime'] if importtime else []), f'{REPO_DIR}/palert.py', *args], env)
+    if result.returncode != 0:
+        raise RuntimeError(f"{' '.join(args)} failed:\n{result.stdout}{result.stderr}")
+    return wall, result
+
+
+def heavyModules(stderr):
+    return sorted({name.split('.')[0] for name in importTimes(stderr)} & set(HEAVY_MODULES))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='check the start up cost of the cron poll')
+    parser.add_argument('--budget', type=float, default=100, help='milliseconds allowed for a poll without new event, beyond the interpreter start')
+    parser.add_argument('--repeat', type=int, default=10, help='unchanged polls timed')
+    parser.add_argument('--top', type=int, default=10, help='slowest imports printed')
+    args = parser.parse_args()
+
+    failures = []
+    cwb = mockServices.CwbServer()
+    workDir = tempfile.mkdtemp(prefix='benchImport')
+    env = {**os.environ, 'PALERT_EVENT_DB': f'{workDir}/events.db', 'PALERT_REPORT_ARCHIVE': f'{workDir}/reports'}
+    try:
+        from obspy import UTCDateTime
+        cwb.addEvent(mockServices.SyntheticEvent(20, UTCDateTime(2022, 1, 1, 12), eqNo=300001), 20)
+        pollArgs = ['poll', '--url', cwb.feedUrl(), '--xml-dir', workDir]
+        run(pollArgs, env)
+
+        for command in ['poll', 'process', 'backfill']:
+            wall, result = run([command, '--help'], env, importtime=True)
+            heavy = heavyModules(result.stderr)
+            print(f'{command} --help: {", ".join(heavy) or "no heavy module"}')
+            if heavy:
+                failures.append(f'{command} --help imports {", ".join(heavy)}')
+
+        wall, result = run(pollArgs, env, importtime=True)
+        heavy = heavyModules(result.stderr)
+        if heavy:
+            failures.append(f'the unchanged poll imports {", ".join(heavy)}')
+        modules = importTimes(result.stderr)
+        print(f'\nunchanged poll, {len(modules)} modules imported, slowest (cumulative ms):')
+        topLevel = [(name, cumulative) for name, (cumulative, top) in modules.items() if top]
+        for name, cumulative in sorted(topLevel, key=lambda item: -item[1])[:args.top]:
+            print(f'  {name:<24} {cumulative / 1000:>7.1f}')
+
+        walls = [run(pollArgs, env)[0] for i in range(args.repeat)]
+        interpreter = statistics.median([timePython(['-c', 'pass'])[0] for i in range(args.repeat)])
+    finally:
+        cwb.close()
+    median = statistics.median(walls) * 1000
+    overhead = median - interpreter * 1000
+    print(f'\nunchanged poll: median {median:.1f} ms, min {min(walls) * 1000:.1f} ms, '
+          f'{overhead:.1f} ms beyond the interpreter start ({interpreter * 1000:.1f} ms), budget {args.budget:.0f} ms')
+    if overhead > args.budget:
+        failures.append(f'the unchanged poll takes {overhead:.1f} ms beyond the interpreter start')
+    for failure in failures:
+        print('FAILED:', failure)
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,243 @@
+# to time the whole workflow offline, from the CWB poll to the published
+# products, at several station counts, and to compare two runs
+#
+# Synthetic events are served by the stand-ins of mockServices.py: the NTU
+# archives by a local ftp server, the opendata zip and the report pages by a
+# local http server. Every Earthquake stage and poll is measured by metrics.
+#
+# usage: python benchmarks/benchPipeline.py --stations 100 500 2000 --output today.json
+#        python benchmarks/benchPipeline.py --stations 100 500 --output today.json --baseline yesterday.json
+#        python benchmarks/benchPipeline.py --compare yesterday.json today.json
+
+import argparse
+import contextlib
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import mockServices
+
+REPO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+STAGES = ['poll', 'pollUnchanged', 'obtainEvent', 'downloadData', 'processData', 'buildEnvelopes', 'getPGAsDataframe',
+          'getPGAsFile', 'saveStaInfo2Sac', 'contourMulti', 'accum3sPGAs', 'accum3sPGAsPlot']
+MEASURES = ['wall', 'cpu', 'bytesDownloaded', 'filesRead', 'filesWritten', 'subprocesses']
+
+
+def syntheticEvents(stations, events, seconds, seed):
+    from obspy import UTCDateTime
+    # one event a day, shifted by the station count so every size has its own archives
+    return [mockServices.SyntheticEvent(stations, UTCDateTime(2022, 1, 1, 12) + k * 86400 + stations * 30,
+                                        eqNo=200000 + 10000 * k + stations, seconds=seconds, seed=seed)
+            for k in range(events)]
+
+
+def readSpans(path, offset):
+    if not os.path.exists(path):
+        return [], offset
+    with open(path) as f:
+        f.seek(offset)
+        spans = [json.loads(line) for line in f if line.strip()]
+        return spans, f.tell()
+
+
+def summarize(spans, events):
+    # mean per event of every stage (processData runs twice per event and is added up)
+    stages = {}
+    for record in spans:
+        name = record['span']
+        if name == 'poll' and not record.get('changed', True):
+            name = 'pollUnchanged'
+        stage = stages.setdefault(name, {**dict.fromkeys(MEASURES, 0), 'runs': 0, 'errors': 0, 'peakRss': 0})
+        stage['runs'] += 1
+        stage['errors'] += record['status'] != 'ok'
+        stage['peakRss'] = max(stage['peakRss'], record['peakRss'])
+        for measure in MEASURES:
+            stage[measure] += record[measure]
+    for name, stage in stages.items():
+        perEvent = 1 if name.startswith('poll') else max(events, 1)
+        for measure in MEASURES:
+            stage[measure] = round(stage[measure] / perEvent, 6)
+    return stages
+
+
+def runSize(stations, args, ftpRoot, cwb, runDir, metricsPath):
+    import alertEQ
+    import backfill
+    import eventStore
+    import metrics
+    import NTUData
+    import requests
+
+    sizeDir = f'{runDir}/n{stations}'
+    dataDir, webDir = f'{sizeDir}/data', f'{sizeDir}/web'
+    os.makedirs(dataDir, exist_ok=True)
+    os.makedirs(webDir, exist_ok=True)
+    events = syntheticEvents(stations, args.events, args.seconds, args.seed)
+    with open(f'{dataDir}/stalist.txt', 'w') as f:
+        f.write(events[0].stalist())
+
+    t = time.perf_counter()
+    generated = sum(mockServices.ensureArchive(event, ftpRoot)[1] for event in events)
+    generateTime = time.perf_counter() - t
+    for event in events:
+        cwb.addEvent(event, args.cwb_stations)
+
+    offset = os.path.getsize(metricsPath) if os.path.exists(metricsPath) else 0
+    latencies = []
+    cwd = os.getcwd()
+    with open(f'{sizeDir}/log.txt', 'w') as log, contextlib.redirect_stdout(log):
+        os.chdir(dataDir)
+        try:
+            session = requests.Session()
+            validators, seenMembers = {}, set()
+            store = eventStore.EventStore(f'{dataDir}/events.db')
+            alertEQ.poll(session, cwb.feedUrl(), validators, seenMembers, store)
+            alertEQ.poll(session, cwb.feedUrl(), validators, seenMembers, store)
+            for event in events:
+                t = time.perf_counter()
+                with metrics.span('obtainEvent', eqNo=event.eqNo):
+                    earthquake = NTUData.Earthquake(cwb.reportUrl(event), None, dataDir, webDir, workers=args.workers)
+                earthquake.downloadData(streaming=True, inMemory=True)
+                backfill.processEvent(earthquake)
+                backfill.publishEvent(earthquake, nativeGrid=True)
+                latencies.append(time.perf_counter() - t)
+        finally:
+            os.chdir(cwd)
+    spans, offset = readSpans(metricsPath, offset)
+    total = sum(latencies)
+    return {'stations': stations,
+            'events': len(events),
+            'seconds': args.seconds,
+            'archivesGenerated': generated,
+            'generateSeconds': round(generateTime, 3),
+            'latency': {'mean': round(total / len(latencies), 3), 'min': round(min(latencies), 3), 'max': round(max(latencies), 3)},
+            'throughput': {'eventsPerMinute': round(60 * len(latencies) / total, 3),
+                           'stationsPerSecond': round(stations * len(latencies) / total, 1)},
+            'stages': summarize(spans, len(events))}
+
+
+def gitCommit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_DIR, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def printReport(report):
+    print(f"commit {report['commit']}, {report['created']}")
+    for key, result in sorted(report['results'].items(), key=lambda item: int(item[0])):
+        print(f"\n{result['stations']} stations, {result['events']} event(s) of {result['seconds']} s: "
+              f"latency {result['latency']['mean']:.2f} s, {result['throughput']['eventsPerMinute']:.2f} events/min, "
+              f"{result['throughput']['stationsPerSecond']:.0f} stations/s")
+        print(f"{'stage':<18} {'wall (s)':>9} {'cpu (s)':>9} {'MB down':>8} {'read':>7} {'written':>8} {'procs':>6} {'peak MB':>8}")
+        for name in [*STAGES, *sorted(set(result['stages']) - set(STAGES))]:
+            stage = result['stages'].get(name)
+            if stage is None:
+                continue
+            print(f"{name:<18} {stage['wall']:>9.3f} {stage['cpu']:>9.3f} {stage['bytesDownloaded'] / 1e6:>8.2f} "
+                  f"{stage['filesRead']:>7.0f} {stage['filesWritten']:>8.0f} {stage['subprocesses']:>6.0f} {stage['peakRss'] / 1e6:>8.0f}")
+
+
+def compare(baseline, report, tolerance=10):
+    """
+    function compare( baseline, report, tolerance=10 )
+
+    Description: to print the latency and the wall time of every stage of two
+                 runs side by side, flagging changes beyond tolerance percent.
+
+    Parameters : baseline, report, dict (saved by --output)
+                 tolerance, float (percent)
+
+    Return     : the number of flagged regressions
+
+    Examples of sage:
+        >> compare(json.load(open('yesterday.json')), json.load(open('today.json')))
+    """
+    print(f"\n{baseline['commit']} ({baseline['created']}) -> {report['commit']} ({report['created']})")
+    regressions = 0
+    for key in sorted(set(baseline['results']) & set(report['results']), key=int):
+        old, new = baseline['results'][key], report['results'][key]
+        print(f"\n{key} stations {'':<8} {'before':>9} {'after':>9} {'change':>8}")
+        rows = [('latency', old['latency']['mean'], new['latency']['mean'])]
+        rows += [(name, old['stages'][name]['wall'], new['stages'][name]['wall'])
+                 for name in STAGES if name in old['stages'] and name in new['stages']]
+        for name, before, after in rows:
+            change = 100 * (after - before) / before if before else 0
+            flag = ''
+            if change > tolerance and after - before > 0.01:
+                flag = '  slower'
+                regressions += 1
+            elif change < -tolerance and before - after > 0.01:
+                flag = '  faster'
+            print(f"{name:<18} {before:>9.3f} {after:>9.3f} {change:>7.1f}%{flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='time the workflow end to end on synthetic events, offline')
+    parser.add_argument('--stations', type=int, nargs='+', default=[100, 500, 2000])
+    parser.add_argument('--events', type=int, default=1, help='events per station count')
+    parser.add_argument('--seconds', type=float, default=240, help='length of the archived traces, from 120 s before the origin')
+    parser.add_argument('--cwb-stations', type=int, default=150, help='eqStation rows of the xml')
+    parser.add_argument('--workers', type=int, default=1, help='threads writing the sac files')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--cache-dir', default=os.path.join(tempfile.gettempdir(), 'palertBench'),
+                        help='synthetic archives are kept here between runs')
+    parser.add_argument('--output', help='save the report (json)')
+    parser.add_argument('--baseline', help='a saved report to compare with')
+    parser.add_argument('--tolerance', type=float, default=10, help='percent change flagged by the comparison')
+    parser.add_argument('--compare', nargs=2, metavar=('BEFORE', 'AFTER'), help='only compare two saved reports')
+    args = parser.parse_args()
+
+    if args.compare:
+        reports = []
+        for path in args.compare:
+            with open(path) as f:
+                reports.append(json.load(f))
+        sys.exit(1 if compare(*reports, args.tolerance) else 0)
+
+    ftpRoot = f'{args.cache_dir}/ftp'
+    os.makedirs(ftpRoot, exist_ok=True)
+    ftp = mockServices.FtpServer(ftpRoot)
+    cwb = mockServices.CwbServer()
+    # read when ntuArchive is imported, so before anything of the repository
+    os.environ['PALERT_NTU_FTP_HOST'] = '127.0.0.1'
+    os.environ['PALERT_NTU_FTP_PORT'] = str(ftp.port)
+    import metrics
+
+    runDir = tempfile.mkdtemp(prefix='run', dir=args.cache_dir)
+    os.environ['PALERT_REPORT_ARCHIVE'] = f'{runDir}/reports'
+    metricsPath = f'{runDir}/metrics.jsonl'
+    metrics.configure(jsonPath=metricsPath)
+    report = {'created': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+              'commit': gitCommit(),
+              'python': sys.version.split()[0],
+              'platform': platform.platform(),
+              'args': {key: value for key, value in vars(args).items() if key not in ['compare', 'output', 'baseline']},
+              'results': {}}
+    try:
+        for stations in args.stations:
+            print(f'{stations} stations...', flush=True)
+            report['results'][str(stations)] = runSize(stations, args, ftpRoot, cwb, runDir, metricsPath)
+    finally:
+        ftp.close()
+        cwb.close()
+    print(f'work files and logs in {runDir}')
+    printReport(report)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=1)
+    if args.baseline:
+        with open(args.baseline) as f:
+            sys.exit(1 if compare(json.load(f), report, args.tolerance) else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+# to measure how writing and patching the sac files of a event scale with
+# the number of worker threads of sacWriter
+#
+# usage: python benchmarks/benchSacWrite.py --stations 500 --seconds 120 --workers 1 2 4 8
+
+import argparse
+import glob
+import numpy as np
+import os
+import shutil
+import sys
+import tempfile
+import time
+from obspy import Stream, Trace, UTCDateTime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import sacWriter
+
+
+def syntheticStream(stations, seconds, samplingRate=100, seed=0):
+    """
+    function syntheticStream( stations, seconds, samplingRate=100, seed=0 )
+
+    Module     : np (numpy)
+
+    Description: to make a P-alert like stream, E/N/Z traces for every station.
+
+    Parameters : stations, int (number of stations)
+                 seconds, float (length of every trace)
+                 samplingRate, float (Hz)
+                 seed, int
+
+    Return     : obspy.Stream
+
+    Examples of sage:
+        >> st = syntheticStream(500, 120)
+    """
+    rng = np.random.default_rng(seed)
+    starttime = UTCDateTime(2022, 1, 7, 21, 12, 0)
+    npts = int(seconds * samplingRate)
+    st = Stream()
+    for i in range(stations):
+        for comp in 'ENZ':
+            st += Trace(rng.normal(0, 1, npts).astype(np.float32),
+                        header={'network': 'TW', 'station': f'S{i:03d}', 'location': '--',
+                                'channel': f'HL{comp}', 'starttime': starttime,
+                                'sampling_rate': samplingRate})
+    return st
+
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark sacWriter over worker counts')
+    parser.add_argument('--stations', type=int, default=500)
+    parser.add_argument('--seconds', type=float, default=120)
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--chunk-size', type=int, default=32)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    st = syntheticStream(args.stations, args.seconds)
+    headers = {'evla': 23.5, 'evlo': 121.4, 'evdp': 10.0, 'mag': 5.9}
+    stationHeaders = {tr.stats.station: {'stla': 24.0, 'stlo': 121.0} for tr in st}
+    print(f'{len(st)} traces of {args.seconds} s, thread pool, chunks of {args.chunk_size}')
+    print(f"{'workers':>8} {'write (s)':>10} {'speedup':>8} {'patch (s)':>10} {'speedup':>8}")
+    baseline = None
+    for workers in args.workers:
+        outputDir = tempfile.mkdtemp(prefix='benchSacWrite')
+        try:
+            writeTimes, patchTimes = [], []
+            for i in range(args.repeat):
+                t = time.perf_counter()
+                sacWriter.writeTraces(st, outputDir, headers, stationHeaders, workers, args.chunk_size)
+                writeTimes.append(time.perf_counter() - t)
+                t = time.perf_counter()
+                sacWriter.patchHeaders(glob.glob(f'{outputDir}/*TW*'), {'mag': 6.0}, None, workers, args.chunk_size)
+                patchTimes.append(time.perf_counter() - t)
+        finally:
+            shutil.rmtree(outputDir)
+        write, patch = min(writeTimes), min(patchTimes)
+        baseline = baseline or (write, patch)
+        print(f'{workers:>8} {write:>10.3f} {baseline[0] / write:>8.2f} {patch:>10.3f} {baseline[1] / patch:>8.2f}')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,486 @@
+# local stand-ins for the NTU ftp server and the CWB websites, and the
+# synthetic events they serve, so that the whole workflow runs offline
+#
+#   SyntheticEvent      : an earthquake with P-alert like stations and waveforms
+#   writeArchive        : its YYYYMMDD_HHMMSS_MAN.tar.bz2 of sac files
+#   cwbXml, reportHtml  : its CWB opendata xml and earthquake report page
+#   FtpServer           : anonymous read-only ftp (USER PASS PWD CWD TYPE PASV
+#                         EPSV NLST SIZE REST RETR NOOP QUIT) over a folder
+#   CwbServer           : http server of the opendata zip and the report pages
+#
+# Both servers can be told to fail (FtpServer.faults, CwbServer.failures) to
+# exercise the timeouts, retries and resumed transfers of asyncFetch.
+
+import http.server
+import io
+import json
+import numpy as np
+import os
+import socket
+import socketserver
+import tarfile
+import threading
+import time
+import zipfile
+import zlib
+from obspy import Trace
+
+
+class SyntheticEvent():
+    """
+    class SyntheticEvent
+
+    Module     : np (numpy)
+
+    Description: a made-up earthquake in Taiwan recorded by `stations` P-alert
+                 like stations, 100 Hz E/N/Z accelerations in gal starting 120 s
+                 before the origin time. The same arguments give the same event.
+
+    Examples of sage:
+        >> event = SyntheticEvent(500, UTCDateTime(2022, 1, 1, 12), eqNo=111001)
+        >> print(event.folder, len(event.stations))
+        20220101_115800_MAN 500
+    """
+    def __init__(self, stations, originTime, eqNo, seconds=240, samplingRate=100, seed=0):
+        rng = np.random.default_rng([seed, stations, eqNo])
+        self.originTime = originTime
+        self.eqNo = eqNo
+        self.seconds = seconds
+        self.samplingRate = samplingRate
+        self.seed = seed
+        self.latitude = round(float(rng.uniform(22.5, 24.8)), 2)
+        self.longitude = round(float(rng.uniform(120.5, 121.7)), 2)
+        self.depth = round(float(rng.uniform(5, 30)), 1)
+        self.magnitude = round(float(rng.uniform(4.5, 6.5)), 1)
+        # the stations do not depend on the event, only on their number
+        stationRng = np.random.default_rng([seed, stations])
+        self.stations = [f'S{i:04d}' for i in range(stations)]
+        self.staLatitude = np.round(stationRng.uniform(22.0, 25.3, stations), 6)
+        self.staLongitude = np.round(stationRng.uniform(120.1, 121.9, stations), 6)
+        self.starttime = originTime - 120
+        self.folder = self.starttime.strftime('%Y%m%d_%H%M%S') + '_MAN'
+
+    @property
+    def key(self):
+        return {'stations': len(self.stations), 'eqNo': self.eqNo, 'originTime': str(self.originTime),
+                'seconds': self.seconds, 'samplingRate': self.samplingRate, 'seed': self.seed}
+
+    def distances(self):
+        dlat = np.radians(self.staLatitude - self.latitude)
+        dlon = np.radians(self.staLongitude - self.longitude) * np.cos(np.radians(self.latitude))
+        return np.hypot(6371 * np.hypot(dlat, dlon), self.depth)
+
+    def waveforms(self, i, rng):
+        # noise, then a P and a stronger S arrival decaying with distance
+        npts = int(self.seconds * self.samplingRate)
+        t = np.arange(npts) / self.samplingRate - 120
+        distance = self.distances()[i]
+        pga = 10 ** (0.6 * self.magnitude - 1.5 * np.log10(distance + 10) + 0.5)
+        data = rng.normal(0, 0.05, (3, npts))
+        for arrival, scale, decay in [(distance / 6.0, 0.3, 3.0), (distance / 3.5, 1.0, 6.0)]:
+            shaking = t >= arrival
+            envelope = np.exp(-(t[shaking] - arrival) / decay)
+            data[:, shaking] += rng.normal(0, pga * scale / 3, (3, shaking.sum())) * envelope
+        # P-alert records gal with a small offset and a resolution of about 0.001
+        return np.round(data + rng.normal(0, 0.5, (3, 1)), 3).astype(np.float32)
+
+    def stalist(self):
+        return ''.join(f'{sta} {lat:.6f} {lon:.6f}\n' for sta, lat, lon in zip(self.stations, self.staLatitude, self.staLongitude))
+
+
+def writeArchive(event, path, compresslevel=6):
+    """
+    function writeArchive( event, path, compresslevel=6 )
+
+    Module     : tarfile
+
+    Description: to write the NTU archive of a SyntheticEvent, one sac file
+                 STA.HLx.TW.-- per trace in a folder named after its start.
+
+    Parameters : event, SyntheticEvent
+                 path, str (the .tar.bz2 to write)
+                 compresslevel, int (bz2 level)
+
+    Examples of sage:
+        >> writeArchive(event, f'ftp/events/202201/{event.folder}.tar.bz2')
+    """
+    rng = np.random.default_rng([event.seed, len(event.stations), event.eqNo, 1])
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with tarfile.open(f'{path}.tmp', 'w:bz2', compresslevel=compresslevel) as tar:
+        for i, sta in enumerate(event.stations):
+            for comp, data in zip('ENZ', event.waveforms(i, rng)):
+                tr = Trace(data, header={'network': 'TW', 'station': sta, 'location': '--', 'channel': f'HL{comp}',
+                                         'starttime': event.starttime, 'sampling_rate': event.samplingRate})
+                buffer = io.BytesIO()
+                tr.write(buffer, format='SAC')
+                info = tarfile.TarInfo(f'{event.folder}/{sta}.HL{comp}.TW.--')
+                info.size = buffer.tell()
+                buffer.seek(0)
+                tar.addfile(info, buffer)
+    os.replace(f'{path}.tmp', path)
+
+
+def ensureArchive(event, ftpRoot):
+    # the archive is only written again if the event changed
+    month = f'{event.originTime.year}{event.originTime.month:02d}'
+    path = f'{ftpRoot}/events/{month}/{event.folder}.tar.bz2'
+    keyPath = f'{ftpRoot}/keys/{event.folder}.json'
+    if os.path.exists(path) and os.path.exists(keyPath):
+        with open(keyPath) as f:
+            if json.load(f) == event.key:
+                return path, False
+    writeArchive(event, path)
+    os.makedirs(os.path.dirname(keyPath), exist_ok=True)
+    with open(keyPath, 'w') as f:
+        json.dump(event.key, f)
+    return path, True
+
+
+def cwbXml(event, cwbStations=150):
+    """
+    function cwbXml( event, cwbStations=150 )
+
+    Description: to write the CWB opendata xml of a SyntheticEvent, with CWB
+                 stations near some of the P-alert stations.
+
+    Parameters : event, SyntheticEvent
+                 cwbStations, int (eqStation rows)
+
+    Return     : xml, str
+
+    Examples of sage:
+        >> print(library.parseCwbXml(io.StringIO(cwbXml(event))).eqNo)
+        111001
+    """
+    rng = np.random.default_rng([event.seed, event.eqNo, 2])
+    rows = rng.choice(len(event.stations), min(cwbStations, len(event.stations)), replace=False)
+    local = (event.originTime + 8 * 3600).strftime('%Y-%m-%dT%H:%M:%S+08:00')
+    stations = []
+    for j, i in enumerate(sorted(rows)):
+        lat = event.staLatitude[i] + rng.normal(0, 0.005)
+        lon = event.staLongitude[i] + rng.normal(0, 0.005)
+        pgas = rng.uniform(0.5, 50, 3)
+        stations.append(f'<eqStation><pga><unit>gal</unit><ewComponent>{pgas[0]:.2f}</ewComponent>'
+                        f'<nsComponent>{pgas[1]:.2f}</nsComponent><vComponent>{pgas[2]:.2f}</vComponent></pga>'
+                        f'<stationName>C{j:03d}</stationName><stationCode>C{j:03d}</stationCode>'
+                        f'<stationLon>{lon:.4f}</stationLon><stationLat>{lat:.4f}</stationLat>'
+                        f'<distance>{event.distances()[i]:.1f}</distance><azimuth>{rng.uniform(0, 360):.1f}</azimuth>'
+                        f'<stationIntensity>{int(rng.integers(1, 5))}</stationIntensity></eqStation>')
+    return ('<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<cwbopendata xmlns="urn:cwb:gov:tw:cwbcommon:0.1">\n'
+            '<identifier>synthetic</identifier>\n<dataset>\n<earthquake>\n'
+            f'<earthquakeNo>{event.eqNo}</earthquakeNo>\n'
+            '<earthquakeInfo>\n'
+            f'<originTime>{local}</originTime>\n'
+            f'<depth unit="km">{event.depth}</depth>\n'
+            f'<epicenter><location>synthetic</location><epicenterLon unit="degree">{event.longitude}</epicenterLon>'
+            f'<epicenterLat unit="degree">{event.latitude}</epicenterLat></epicenter>\n'
+            f'<magnitude><magnitudeType>ML</magnitudeType><magnitudeValue>{event.magnitude}</magnitudeValue></magnitude>\n'
+            '</earthquakeInfo>\n'
+            '<intensity>\n<shakingArea><areaDesc>synthetic</areaDesc>\n'
+            + '\n'.join(stations) +
+            '\n</shakingArea>\n</intensity>\n</earthquake>\n</dataset>\n</cwbopendata>\n')
+
+
+def reportHtml(event):
+    """
+    function reportHtml( event )
+
+    Description: to write a CWB earthquake report page of a SyntheticEvent with
+                 the values at the line and column offsets read by
+                 cwbReport.parseReport.
+
+    Parameters : event, SyntheticEvent
+
+    Return     : html, str
+
+    Examples of sage:
+        >> print(cwbReport.parseReport(reportHtml(event)).eqNo)
+        111001
+    """
+    local = event.originTime + 8 * 3600
+    second = local.second + local.microsecond / 1e6
+    timeLine = f"{'<li>Origin Time (UTC+8)':<54}{local.month:02d}/{local.day:02d}/{local.year:04d} {local.hour:02d}:{local.minute:02d}:{second:04.1f}"
+    lines = ['<div class="eqReportBoxBg">',
+             '<ul>',
+             '<li>Earthquake report</li>',
+             f'<li>No. {event.eqNo}',
+             '</li>',
+             timeLine,
+             '</li>',
+             f"{'<li>Epicenter':<17}{event.latitude:5.2f}N {event.longitude:6.2f}E</li>",
+             '</li>',
+             f"{'<li>Depth':<15}{event.depth:5.1f} km</li>",
+             '</li>',
+             f"{'<li>Magnitude (ML)':<22}{event.magnitude:3.1f}</li>",
+             '</ul>',
+             '</div>']
+    return '<html>\n<body>\n' + '\n'.join(lines) + '\n</body>\n</html>\n'
+
+
+class _FtpHandler(socketserver.StreamRequestHandler):
+    def reply(self, line):
+        self.wfile.write(f'{line}\r\n'.encode())
+
+    def path(self, name):
+        # absolute path on the server and in the local folder, never above the root
+        virtual = os.path.normpath(os.path.join(self.cwd, name or '.')).replace('\\', '/')
+        if not virtual.startswith('/'):
+            virtual = '/' + virtual
+        return virtual, os.path.join(self.server.root, virtual.lstrip('/'))
+
+    def handle(self):
+        self.cwd = '/'
+        self.passive = None
+        self.rest = 0
+        self.reply('220 palert benchmark ftp')
+        for raw in self.rfile:
+            command, _, argument = raw.decode().strip().partition(' ')
+            command = command.upper()
+            handler = getattr(self, f'do_{command}', None)
+            if handler is None:
+                self.reply(f'502 {command} not implemented')
+                continue
+            if handler(argument) is False:
+                return
+
+    def do_USER(self, argument):
+        self.reply('331 any password')
+
+    def do_PASS(self, argument):
+        self.reply('230 logged in')
+
+    def do_PWD(self, argument):
+        self.reply(f'257 "{self.cwd}"')
+
+    def do_CWD(self, argument):
+        virtual, local = self.path(argument)
+        if not os.path.isdir(local):
+            self.reply(f'550 {argument}: no such folder')
+            return
+        self.cwd = virtual
+        self.reply('250 ok')
+
+    def do_TYPE(self, argument):
+        self.reply('200 ok')
+
+    def do_NOOP(self, argument):
+        self.reply('200 ok')
+
+    def do_QUIT(self, argument):
+        self.reply('221 bye')
+        return False
+
+    def __listen(self):
+        if self.passive is not None:
+            self.passive.close()
+        self.passive = socket.create_server((self.server.server_address[0], 0))
+        return self.passive.getsockname()[1]
+
+    def do_PASV(self, argument):
+        port = self.__listen()
+        host = self.server.server_address[0].replace('.', ',')
+        self.reply(f'227 Entering Passive Mode ({host},{port >> 8},{port & 255})')
+
+    def do_EPSV(self, argument):
+        self.reply(f'229 Entering Extended Passive Mode (|||{self.__listen()}|)')
+
+    def __transfer(self, send):
+        if self.passive is None:
+            self.reply('425 use PASV first')
+            return
+        self.reply('150 opening data connection')
+        connection, address = self.passive.accept()
+        self.passive.close()
+        self.passive = None
+        try:
+            send(connection)
+        except OSError:
+            self.reply('426 transfer aborted')
+            return
+        finally:
+            connection.close()
+        self.reply('226 transfer complete')
+
+    def do_NLST(self, argument):
+        virtual, local = self.path(argument)
+        if not os.path.isdir(local):
+            self.reply(f'550 {argument}: no such folder')
+            return
+        names = sorted(os.listdir(local))
+        prefix = f'{argument.rstrip("/")}/' if argument else ''
+        self.__transfer(lambda connection: connection.sendall(''.join(f'{prefix}{name}\r\n' for name in names).encode()))
+
+    def do_SIZE(self, argument):
+        virtual, local = self.path(argument)
+        if not os.path.isfile(local):
+            self.reply(f'550 {argument}: no such file')
+            return
+        self.reply(f'213 {os.path.getsize(local)}')
+
+    def do_REST(self, argument):
+        self.rest = int(argument)
+        self.reply(f'350 restarting at {self.rest}')
+
+    def do_RETR(self, argument):
+        virtual, local = self.path(argument)
+        offset, self.rest = self.rest, 0
+        if not os.path.isfile(local):
+            self.reply(f'550 {argument}: no such file')
+            return
+
+        fault = self.server.nextFault()
+
+        def send(connection):
+            sent = 0
+            with open(local, 'rb') as f:
+                f.seek(offset)
+                while True:
+                    chunk = f.read(self.server.blockSize)
+                    if not chunk:
+                        return
+                    if fault is not None and sent + len(chunk) > fault[1]:
+                        connection.sendall(chunk[:fault[1] - sent])
+                        if fault[0] == 'stall':
+                            time.sleep(self.server.stallSeconds)
+                        raise ConnectionAbortedError(f'{fault[0]} after {fault[1]} bytes')
+                    connection.sendall(chunk)
+                    sent += len(chunk)
+        self.__transfer(send)
+
+
+class FtpServer(socketserver.ThreadingTCPServer):
+    """
+    class FtpServer
+
+    Module     : socketserver
+
+    Description: a read-only anonymous ftp server over a local folder, enough for
+                 ftplib and ntuArchive (listing, cwd, passive binary downloads
+                 with REST). Started in a daemon thread. Every RETR takes the
+                 next of faults, if any: ('drop', n) closes the data connection
+                 after n bytes, ('stall', n) stops sending for stallSeconds first.
+
+    Examples of sage:
+        >> server = FtpServer('/tmp/palertBench/ftp')
+        >> server.faults = [('drop', 100000), ('stall', 200000)]
+        >> print(server.port)
+        >> server.close()
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, root, host='127.0.0.1', port=0, blockSize=65536, stallSeconds=30):
+        self.root = os.path.abspath(root)
+        self.blockSize = blockSize
+        self.stallSeconds = stallSeconds
+        self.faults = []
+        self.retrieved = 0
+        self.lock = threading.Lock()
+        super().__init__((host, port), _FtpHandler)
+        self.port = self.server_address[1]
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    def nextFault(self):
+        with self.lock:
+            self.retrieved += 1
+            return self.faults.pop(0) if self.faults else None
+
+    def close(self):
+        self.shutdown()
+        self.server_close()
+
+
+class CwbServer(http.server.ThreadingHTTPServer):
+    """
+    class CwbServer
+
+    Module     : http.server
+
+    Description: a local stand-in for the CWB websites. Serves the opendata zip
+                 of the xml of every added event at /opendataapi (with an ETag,
+                 304 if it did not change) and the report page of each event at
+                 /en-us/earthquake/imgs/ee<eqNo>. Started in a daemon thread.
+                 The next failures requests are answered 503, and every
+                 request waits delay seconds first.
+
+    Examples of sage:
+        >> server = CwbServer()
+        >> server.addEvent(event)
+        >> print(server.reportUrl(event))
+    """
+    daemon_threads = True
+
+    def __init__(self, host='127.0.0.1', port=0):
+        self.reports = {}
+        self.xmls = {}
+        self.feed = b''
+        self.etag = '"0"'
+        self.failures = 0
+        self.delay = 0
+        self.requests = 0
+        self.lock = threading.Lock()
+        super().__init__((host, port), _CwbHandler)
+        self.port = self.server_address[1]
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    @property
+    def url(self):
+        return f'http://{self.server_address[0]}:{self.port}'
+
+    def reportUrl(self, event):
+        return f'{self.url}/en-us/earthquake/imgs/ee{event.eqNo}'
+
+    def feedUrl(self):
+        return f'{self.url}/opendataapi?dataid=E-A0015-001'
+
+    def addEvent(self, event, cwbStations=150):
+        with self.lock:
+            self.reports[f'ee{event.eqNo}'] = reportHtml(event).encode()
+            self.xmls[f'CWB-EQ{event.eqNo}.xml'] = cwbXml(event, cwbStations).encode()
+            buffer = io.BytesIO()
+            with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as zf:
+                for name, content in sorted(self.xmls.items()):
+                    zf.writestr(name, content)
+            self.feed = buffer.getvalue()
+            # a revised report (the same eqNo added again) changes the etag too
+            self.etag = f'"{zlib.crc32(self.feed):08x}"'
+
+    def close(self):
+        self.shutdown()
+        self.server_close()
+
+
+class _CwbHandler(http.server.BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def send(self, status, content=b'', headers=None):
+        self.send_response(status)
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def do_GET(self):
+        server = self.server
+        path = self.path.split('?')[0]
+        time.sleep(server.delay)
+        with server.lock:
+            server.requests += 1
+            if server.failures > 0:
+                server.failures -= 1
+                self.send(503)
+                return
+            if path == '/opendataapi':
+                if self.headers.get('If-None-Match') == server.etag:
+                    self.send(304)
+                else:
+                    self.send(200, server.feed, {'Content-Type': 'application/zip', 'ETag': server.etag})
+                return
+            report = server.reports.get(path.rsplit('/', 1)[-1]) if path.startswith('/en-us/earthquake/imgs/') else None
+        if report is None:
+            self.send(404)
+        else:
+            self.send(200, report, {'Content-Type': 'text/html; charset=utf-8'})
@@ -0,0 +1,144 @@
+import io
+import metrics
+import requests
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from obspy import UTCDateTime
+from typing import NamedTuple
+
+
+REPORT_MARKER = 'eqReportBoxBg'
+
+_session = None
+_sessionLock = threading.Lock()
+
+
+class EqReport(NamedTuple):
+    eqNo: int
+    originTimeUTC: UTCDateTime
+    latitude: float
+    longitude: float
+    depth: float
+    magnitude: float
+
+
+def getSession(poolSize=16):
+    """
+    function getSession( poolSize=16 )
+
+    Module     : requests
+
+    Description: to get the http session shared by every report request, so the
+                 connections to the CWB website are pooled and kept alive.
+
+    Parameters : poolSize, int (connections kept per host, first call only)
+
+    Return     : requests.Session
+
+    Examples of sage:
+        >> session = getSession()
+    """
+    global _session
+    with _sessionLock:
+        if _session is None:
+            _session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=poolSize, pool_maxsize=poolSize)
+            _session.mount('https://', adapter)
+            _session.mount('http://', adapter)
+        return _session
+
+
+def parseReport(html):
+    """
+    function parseReport( html )
+
+    Description: to get the eq parameters from the html of a CWB earthquake report.
+                 The lines after the eqReportBoxBg line are read at the same
+                 offsets as before, but from memory instead of tmp/tmp.txt.
+
+    Parameters : html, str (the report page)
+
+    Return     : EqReport
+
+    Examples of sage:
+        >> report = parseReport(requests.get(url).content.decode('utf-8'))
+        >> print(report.eqNo, report.magnitude)
+    """
+    # same line splitting as reading the page back from a text file
+    lines = io.StringIO(html, newline=None).readlines()
+    for i, line in enumerate(lines):
+        if REPORT_MARKER in line:
+            break
+    else:
+        raise ValueError(f'{REPORT_MARKER} is not in the report.')
+
+    eqNo = int(lines[i + 3].split()[-1])
+
+    timeLine = lines[i + 5]
+    year = int(timeLine[60:64])
+    month = int(timeLine[54:56])
+    date = int(timeLine[57:59])
+    hour = int(timeLine[65:67])
+    minute = int(timeLine[68:70])
+    second = float(timeLine[71:75])
+    # seconds are added rather than formatted, "T05:12:5.0" is not a valid time
+    originTimeUTC = UTCDateTime(f"{year}-{month:02}-{date:02}T{hour:02}:{minute:02}:00+08") + second
+
+    latitude = float(lines[i + 7][17:22])
+    longitude = float(lines[i + 7][24:30])
+    depth = float(lines[i + 9][15:20])
+    magnitude = float(lines[i + 11][22:25])
+    return EqReport(eqNo, originTimeUTC, latitude, longitude, depth, magnitude)
+
+
+def fetchReport(url, session=None, timeout=30):
+    """
+    function fetchReport( url, session=None, timeout=30 )
+
+    Module     : requests
+
+    Description: to download and parse a CWB earthquake report.
+
+    Parameters : url, str
+                 session, requests.Session (default getSession())
+                 timeout, float (seconds)
+
+    Return     : EqReport
+
+    Examples of sage:
+        >> report = fetchReport("https://scweb.cwb.gov.tw/en-us/earthquake/imgs/ee2022010805121947003")
+    """
+    session = session or getSession()
+    response = session.get(url, timeout=timeout)
+    response.raise_for_status()
+    metrics.count('bytesDownloaded', len(response.content))
+    return parseReport(response.content.decode('utf-8'))
+
+
+def fetchReports(urls, maxWorkers=8, timeout=30):
+    """
+    function fetchReports( urls, maxWorkers=8, timeout=30 )
+
+    Module     : concurrent.futures
+
+    Description: to download and parse many CWB earthquake reports concurrently
+                 over the shared session.
+
+    Parameters : urls, list of str
+                 maxWorkers, int (reports fetched at the same time)
+                 timeout, float (seconds per report)
+
+    Return     : a dict of url -> EqReport, or the exception raised for that url
+
+    Examples of sage:
+        >> reports = fetchReports([url1, url2])
+    """
+    def fetch(url):
+        try:
+            return fetchReport(url, timeout=timeout)
+        except Exception as error:
+            return error
+
+    urls = list(urls)
+    with ThreadPoolExecutor(maxWorkers) as executor:
+        return dict(zip(urls, executor.map(fetch, urls)))
@@ -0,0 +1,151 @@
+import json
+import numpy as np
+import os
+import pgaEngine
+
+
+DTYPE = np.dtype('<i2')
+
+
+def minMax(data, binSize):
+    """
+    function minMax( data, binSize )
+
+    Module     : np (numpy)
+
+    Description: to reduce the last axis to the min and max of every binSize
+                 samples; the last bin is completed with the last sample.
+
+    Parameters : data, np.ndarray (..., samples) or a (mins, maxs) pair of a finer level
+                 binSize, int
+
+    Return     : mins, maxs, np.ndarray (..., bins)
+
+    Examples of sage:
+        >> mins, maxs = minMax(data, 4)
+        >> mins, maxs = minMax((mins, maxs), 4)
+    """
+    mins, maxs = data if isinstance(data, tuple) else (data, data)
+    bins = -(-mins.shape[-1] // binSize)
+    pad = [(0, 0)] * (mins.ndim - 1) + [(0, bins * binSize - mins.shape[-1])]
+    mins = np.pad(mins, pad, mode='edge').reshape(mins.shape[:-1] + (bins, binSize))
+    maxs = np.pad(maxs, pad, mode='edge').reshape(maxs.shape[:-1] + (bins, binSize))
+    return mins.min(axis=-1), maxs.max(axis=-1)
+
+
+def levelSizes(nSamples, baseBin=4, factor=4, minBins=64):
+    # samples per bin of every level, finest first, down to about minBins bins
+    sizes = [baseBin]
+    while -(-nSamples // (sizes[-1] * factor)) >= minBins:
+        sizes.append(sizes[-1] * factor)
+    return sizes
+
+
+def writePyramid(outputDir, staNames, data, starttime, delta, baseBin=4, factor=4, minBins=64, chunkSize=64, demean=True):
+    """
+    function writePyramid( outputDir, staNames, data, starttime, delta, baseBin=4, factor=4,
+                           minBins=64, chunkSize=64, demean=True )
+
+    Module     : np (numpy)
+
+    Description: to write min/max envelopes of every trace at several zoom levels
+                 for the web pages. Level k has baseBin * factor**k samples per
+                 bin. Each level is one file of little-endian int16, laid out as
+                 station x E/N/Z x bin x (min, max), so the envelope of a station
+                 and component is one contiguous byte range:
+                     offset = ((row * 3 + component) * bins + firstBin) * 4
+                 The values are counts of scales[row][component] gal. The stations,
+                 scales, timing and levels are in index.json, written last.
+
+    Parameters : outputDir, str
+                 staNames, list of str (one per row of data)
+                 data, np.ndarray or memory map (stations x E/N/Z x samples, see streamToArray)
+                 starttime, UTCDateTime (time of the first sample)
+                 delta, float (sample interval in seconds)
+                 baseBin, factor, int (samples per bin of the finest level, and between levels)
+                 minBins, int (the coarsest level has at least this many bins)
+                 chunkSize, int (stations read at once, bounds the memory used)
+                 demean, bool (remove the mean of each trace)
+
+    Return     : the written file names, index.json last
+
+    Examples of sage:
+        >> cache = WaveformCache('/home/palert/data/SAC/202201/20220107_211019_MAN/waveforms')
+        >> writePyramid('envelopes', cache.stations, cache.data, cache.starttime, cache.delta)
+    """
+    os.makedirs(outputDir, exist_ok=True)
+    nSamples = data.shape[-1]
+    sizes = levelSizes(nSamples, baseBin, factor, minBins) if nSamples else []
+    levels = [{'file': f'level{k}.bin', 'samplesPerBin': size, 'secondsPerBin': size * delta,
+               'bins': -(-nSamples // size)} for k, size in enumerate(sizes)]
+    files = [f'{outputDir}/{level["file"]}' for level in levels]
+    scales = np.zeros((data.shape[0], data.shape[1]))
+    handles = [open(f'{file}.tmp', 'wb') for file in files]
+    try:
+        for start in range(0, data.shape[0], chunkSize):
+            chunk = np.asarray(data[start:start + chunkSize], dtype=np.float64)
+            if demean and nSamples:
+                chunk = chunk - chunk.mean(axis=2, keepdims=True)
+            peak = np.abs(chunk).max(axis=2) if nSamples else np.zeros(chunk.shape[:2])
+            scale = np.where(peak > 0, peak / np.iinfo(DTYPE).max, 1.)
+            scales[start:start + chunkSize] = scale
+            envelope, previous = chunk, 1
+            for size, handle in zip(sizes, handles):
+                # every level is reduced from the one before it
+                envelope = minMax(envelope, size // previous)
+                previous = size
+                counts = np.stack(envelope, axis=-1) / scale[:, :, np.newaxis, np.newaxis]
+                handle.write(np.round(counts).astype(DTYPE).tobytes())
+    finally:
+        for handle in handles:
+            handle.close()
+    for file in files:
+        os.replace(f'{file}.tmp', file)
+
+    index = {'stations': list(staNames),
+             'components': list(pgaEngine.COMPONENTS),
+             'starttime': str(starttime) if starttime is not None else None,
+             'delta': delta,
+             'samples': nSamples,
+             'dtype': DTYPE.str,
+             'layout': ['station', 'component', 'bin', 'min/max'],
+             'levels': levels,
+             'scales': [[float(f'{value:.6g}') for value in row] for row in scales]}
+    with open(f'{outputDir}/index.json.tmp', 'w') as f:
+        json.dump(index, f, separators=(',', ':'))
+    os.replace(f'{outputDir}/index.json.tmp', f'{outputDir}/index.json')
+    return files + [f'{outputDir}/index.json']
+
+
+def readEnvelope(outputDir, sta, component, level=None, firstBin=0, lastBin=None):
+    """
+    function readEnvelope( outputDir, sta, component, level=None, firstBin=0, lastBin=None )
+
+    Module     : np (numpy)
+
+    Description: to read the envelope of one trace back, the way the web page
+                 does: the index, then one byte range of one level file.
+
+    Parameters : outputDir, str
+                 sta, str
+                 component, 'E', 'N' or 'Z'
+                 level, int (default the coarsest)
+                 firstBin, lastBin, int (bins to read, lastBin excluded)
+
+    Return     : mins, maxs, np.ndarray (gal)
+
+    Examples of sage:
+        >> mins, maxs = readEnvelope('envelopes', 'A001', 'Z', level=2)
+    """
+    with open(f'{outputDir}/index.json') as f:
+        index = json.load(f)
+    level = index['levels'][-1 if level is None else level]
+    row = index['stations'].index(sta)
+    column = index['components'].index(component)
+    lastBin = level['bins'] if lastBin is None else min(lastBin, level['bins'])
+    itemSize = 2 * np.dtype(index['dtype']).itemsize
+    with open(f"{outputDir}/{level['file']}", 'rb') as f:
+        f.seek(((row * len(index['components']) + column) * level['bins'] + firstBin) * itemSize)
+        counts = np.frombuffer(f.read((lastBin - firstBin) * itemSize), dtype=index['dtype']).reshape(-1, 2)
+    scale = index['scales'][row][column]
+    return counts[:, 0] * scale, counts[:, 1] * scale
@@ -0,0 +1,165 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+
+# pandas is imported by the methods that build dataframes, not by the poller
+
+DEFAULT_PATH = os.environ.get('PALERT_EVENT_DB', '/home/palert/data/events.db')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS events (
+    eqNo INTEGER PRIMARY KEY,
+    originTime TEXT,
+    originTimestamp REAL,
+    longitude REAL,
+    latitude REAL,
+    depth REAL,
+    magnitude REAL,
+    status TEXT NOT NULL,
+    updatedAt REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS eventsOriginTimestamp ON events (originTimestamp);
+CREATE TABLE IF NOT EXISTS stations (
+    eqNo INTEGER NOT NULL,
+    stationCode TEXT,
+    stationLon REAL,
+    stationLat REAL,
+    stationDist REAL,
+    stationAz REAL,
+    stationIntensity REAL,
+    stationPGAz REAL,
+    stationPGAns REAL,
+    stationPGAew REAL
+);
+CREATE INDEX IF NOT EXISTS stationsEqNo ON stations (eqNo);
+CREATE TABLE IF NOT EXISTS stages (
+    eqNo INTEGER NOT NULL,
+    stage TEXT NOT NULL,
+    finishedAt REAL NOT NULL,
+    PRIMARY KEY (eqNo, stage)
+);
+CREATE TABLE IF NOT EXISTS reports (
+    name TEXT PRIMARY KEY,
+    crc INTEGER NOT NULL,
+    archivedAt REAL NOT NULL
+);
+"""
+
+STATION_COLUMNS = ['stationCode', 'stationLon', 'stationLat', 'stationDist', 'stationAz',
+                   'stationIntensity', 'stationPGAz', 'stationPGAns', 'stationPGAew']
+
+
+class EventStore():
+    """
+    class EventStore
+
+    Module     : sqlite3
+
+    Description: the processed events (parameters, station tables, status) and
+                 the finished Earthquake stages, kept in one sqlite file that both
+                 alertEQ and NTUData use.
+
+    Examples of sage:
+        >> store = EventStore('events.db')
+        >> print(store.newEqids([110091, 110092]))
+        [110092]
+    """
+    def __init__(self, path=DEFAULT_PATH):
+        self.path = path
+        self.__lock = threading.Lock()
+        self.__connection = sqlite3.connect(path, check_same_thread=False)
+        with self.__connection:
+            self.__connection.executescript(SCHEMA)
+
+    def __getstate__(self):
+        # a pickled store (e.g. sent to a worker process) reopens the same file
+        return {'path': self.path}
+
+    def __setstate__(self, state):
+        self.__init__(state['path'])
+
+    def close(self):
+        self.__connection.close()
+
+    def newEqids(self, eqids, floor=None):
+        # one query for a whole zip; floor skips the ids at or below a legacy latest.EQ
+        query = ("SELECT DISTINCT ids.value FROM json_each(?) AS ids "
+                 "LEFT JOIN events ON events.eqNo = ids.value AND events.status = 'processed' "
+                 "WHERE events.eqNo IS NULL AND ids.value > ? ORDER BY ids.value")
+        with self.__lock:
+            rows = self.__connection.execute(query, (json.dumps([int(eqid) for eqid in eqids]),
+                                                     -1 if floor is None else floor)).fetchall()
+        return [row[0] for row in rows]
+
+    def changedReports(self, crcs):
+        # crcs: {xml file name: CRC-32 of its content}, e.g. from the zip directory;
+        # the names not in the report archive yet, or archived with another content
+        query = ("SELECT ids.key FROM json_each(?) AS ids "
+                 "LEFT JOIN reports ON reports.name = ids.key AND reports.crc = ids.value "
+                 "WHERE reports.name IS NULL ORDER BY ids.key")
+        with self.__lock:
+            rows = self.__connection.execute(query, (json.dumps(crcs),)).fetchall()
+        return [row[0] for row in rows]
+
+    def recordReports(self, crcs):
+        # the reports added to the report archive, see changedReports
+        archivedAt = time.time()
+        with self.__lock, self.__connection:
+            self.__connection.executemany("INSERT OR REPLACE INTO reports VALUES (?, ?, ?)",
+                                          [(name, crc, archivedAt) for name, crc in crcs.items()])
+
+    def recordEvent(self, event, status='received'):
+        # event is a library.CwbEvent; the row and its stations are replaced in one transaction
+        stations = event.to_dataframe()[STATION_COLUMNS]
+        stations.insert(0, 'eqNo', event.eqNo)
+        stations = stations.astype(object).where(stations.notna(), None)
+        with self.__lock, self.__connection:
+            self.__connection.execute(
+                "INSERT OR REPLACE INTO events VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (event.eqNo, str(event.originTimeUTC), float(event.originTimeUTC.timestamp),
+                 event.longitude, event.latitude, event.depth, event.magnitude, status, time.time()))
+            self.__connection.execute("DELETE FROM stations WHERE eqNo = ?", (event.eqNo,))
+            self.__connection.executemany(
+                f"INSERT INTO stations VALUES ({', '.join('?' * (len(STATION_COLUMNS) + 1))})",
+                stations.itertuples(index=False, name=None))
+
+    def markStatus(self, eqNo, status):
+        with self.__lock, self.__connection:
+            self.__connection.execute("UPDATE events SET status = ?, updatedAt = ? WHERE eqNo = ?",
+                                      (status, time.time(), eqNo))
+
+    def recordStage(self, eqNo, stage):
+        with self.__lock, self.__connection:
+            self.__connection.execute("INSERT OR REPLACE INTO stages VALUES (?, ?, ?)",
+                                      (eqNo, stage, time.time()))
+
+    def finishedStages(self, eqNo):
+        with self.__lock:
+            rows = self.__connection.execute("SELECT stage FROM stages WHERE eqNo = ? ORDER BY finishedAt",
+                                             (eqNo,)).fetchall()
+        return [row[0] for row in rows]
+
+    def events(self, starttime=None, endtime=None, firstEqid=None, lastEqid=None, status=None):
+        # range query for backfills, times are UTCDateTime and both ends are inclusive
+        conditions, values = [], []
+        for condition, value in [('originTimestamp >= ?', None if starttime is None else starttime.timestamp),
+                                 ('originTimestamp <= ?', None if endtime is None else endtime.timestamp),
+                                 ('eqNo >= ?', firstEqid),
+                                 ('eqNo <= ?', lastEqid),
+                                 ('status = ?', status)]:
+            if value is not None:
+                conditions.append(condition)
+                values.append(value)
+        import pandas as pd
+        where = f" WHERE {' AND '.join(conditions)}" if conditions else ''
+        with self.__lock:
+            return pd.read_sql_query(f"SELECT * FROM events{where} ORDER BY originTimestamp",
+                                     self.__connection, params=values)
+
+    def stations(self, eqNo):
+        import pandas as pd
+        with self.__lock:
+            return pd.read_sql_query("SELECT * FROM stations WHERE eqNo = ?", self.__connection,
+                                     params=(eqNo,))
@@ -0,0 +1,293 @@
+import hashlib
+import io
+import numpy as np
+import os
+import threading
+from scipy import sparse
+from scipy.spatial import cKDTree
+import library
+
+
+# lon min, lon max, lat min, lat max of the maps
+REGION = (119.0, 123.0, 21.5, 26.0)
+SPACING = 0.02
+INTENSITY_LEVELS = (1, 2, 3, 4, 5, 6, 7)
+
+_grids = {}
+_gridsLock = threading.Lock()
+
+
+class IdwGrid():
+    """
+    class IdwGrid
+
+    Module     : scipy.sparse
+                 scipy.spatial (cKDTree)
+
+    Description: inverse distance weighting of station values onto a regular
+                 lon/lat grid, from the neighbors nearest stations of every node
+                 that have a value (not NaN). The weights of the candidates
+                 nearest stations of every grid node are computed once for a
+                 station set and kept as a sparse nodes x stations matrix; a
+                 field is gridded by one sparse product with the nearest
+                 candidates that have a value, the same for all accumulated
+                 frames with the same stations. Only nodes that run out of
+                 candidates search the stations with a value again.
+
+    Examples of sage:
+        >> grid = IdwGrid(df['staLatitude'], df['staLongitude'])
+        >> intensity = grid.interpolate(df['intensity'])
+        >> print(intensity.shape == (len(grid.latitudes), len(grid.longitudes)))
+        True
+    """
+    def __init__(self, latitude, longitude, region=REGION, spacing=SPACING, power=2, neighbors=8, radius=0.5, candidates=32):
+        self.latitude = np.asarray(latitude, dtype=np.float64)
+        self.longitude = np.asarray(longitude, dtype=np.float64)
+        self.region = tuple(region)
+        self.spacing = spacing
+        self.power = power
+        self.neighbors = neighbors
+        # degrees of latitude, no station farther than this is used for a node
+        self.radius = radius
+        # stations kept per node, so stations without a value can be skipped
+        self.candidates = max(candidates, neighbors)
+        self.longitudes = np.arange(region[0], region[1] + spacing / 2, spacing)
+        self.latitudes = np.arange(region[2], region[3] + spacing / 2, spacing)
+        self.weights = None
+        self.__sorted = None
+
+    @property
+    def key(self):
+        # same stations and same options give the same weights
+        digest = hashlib.sha1()
+        digest.update(np.column_stack([self.latitude, self.longitude]).tobytes())
+        digest.update(repr((self.region, self.spacing, self.power, self.neighbors, self.radius, self.candidates)).encode())
+        return digest.hexdigest()
+
+    def __points(self):
+        # longitudes are shrunk by cos(latitude) so that distances are close to isotropic
+        scale = np.cos(np.radians((self.region[2] + self.region[3]) / 2))
+        gridLon, gridLat = np.meshgrid(self.longitudes, self.latitudes)
+        nodes = np.column_stack([gridLon.ravel() * scale, gridLat.ravel()])
+        return nodes, np.column_stack([self.longitude * scale, self.latitude])
+
+    def __idw(self, rows, nodes, stations, k):
+        # sparse weights of the k nearest stations (within radius) of the nodes in rows
+        distance, index = cKDTree(stations).query(nodes, k=k, distance_upper_bound=self.radius)
+        distance = distance.reshape(len(nodes), k)
+        index = index.reshape(len(nodes), k)
+        # missing neighbours come back as an infinite distance and index len(stations)
+        found = np.isfinite(distance)
+        weights = 1 / np.maximum(distance[found], 1e-6) ** self.power
+        return weights, np.repeat(rows, k).reshape(len(nodes), k)[found], index[found]
+
+    def buildWeights(self):
+        nodes, stations = self.__points()
+        k = min(self.candidates, len(stations))
+        self.__sorted = None
+        if k == 0:
+            self.weights = sparse.csr_matrix((len(nodes), 0))
+            return self.weights
+        weights, rows, columns = self.__idw(np.arange(len(nodes)), nodes, stations, k)
+        self.weights = sparse.csr_matrix((weights, (rows, columns)), shape=(len(nodes), len(stations)))
+        return self.weights
+
+    def __sortedCandidates(self):
+        # the nodes with candidates, and their candidates nearest first as
+        # arrays padded with station nStations and weight 0
+        if self.__sorted is None:
+            nNodes, nStations = self.weights.shape
+            weights = self.weights.tocoo()
+            order = np.lexsort((-weights.data, weights.row))
+            rows, columns, data = weights.row[order], weights.col[order], weights.data[order]
+            nodes, first, counts = np.unique(rows, return_index=True, return_counts=True)
+            position = np.arange(len(rows)) - np.repeat(first, counts)
+            slot = np.repeat(np.arange(len(nodes)), counts)
+            index = np.full((len(nodes), max(counts.max(initial=0), 1)), nStations, dtype=np.int32)
+            weight = np.zeros(index.shape)
+            index[slot, position] = columns
+            weight[slot, position] = data
+            self.__sorted = (nodes, index, weight, counts)
+        return self.__sorted
+
+    def weightsFor(self, known):
+        # nodes x stations weights of the neighbors nearest stations with known True
+        if self.weights is None:
+            self.buildWeights()
+        nodes, index, weight, counts = self.__sortedCandidates()
+        usable = np.append(known, False)[index]
+        rank = np.cumsum(usable, axis=1, dtype=np.int16)
+        used = usable & (rank <= self.neighbors)
+        taken = np.minimum(rank[:, -1], self.neighbors)
+        perNode = np.zeros(self.weights.shape[0], dtype=np.int64)
+        perNode[nodes] = taken
+        weights = sparse.csr_matrix((weight[used], index[used], np.concatenate([[0], np.cumsum(perNode)])),
+                                    shape=self.weights.shape)
+        # a node whose candidates are all used up may have farther stations with
+        # a value within radius: only those nodes search the known stations
+        short = nodes[(taken < self.neighbors) & (counts == self.candidates)]
+        stations = np.flatnonzero(known)
+        if len(short) and len(stations):
+            points, coordinates = self.__points()
+            values, rows, columns = self.__idw(short, points[short], coordinates[stations], min(self.neighbors, len(stations)))
+            kept = np.ones(self.weights.shape[0])
+            kept[short] = 0
+            weights = sparse.diags(kept) @ weights + sparse.csr_matrix((values, (rows, stations[columns])), shape=self.weights.shape)
+        return weights
+
+    def interpolate(self, values):
+        # values: stations, or stations x frames; returns latitudes x longitudes,
+        # or frames x latitudes x longitudes, NaN where no station is in reach
+        values = np.asarray(values, dtype=np.float64)
+        columns = values[:, np.newaxis] if values.ndim == 1 else values
+        known = np.isfinite(columns)
+        field = np.full((len(self.latitudes) * len(self.longitudes), columns.shape[1]), np.nan)
+        # frames with the same stations share their weights
+        masks, inverse = np.unique(known, axis=1, return_inverse=True)
+        inverse = inverse.ravel()
+        for m in range(masks.shape[1]):
+            frames = np.flatnonzero(inverse == m)
+            weights = self.weightsFor(masks[:, m])
+            total = weights @ np.where(known[:, frames], columns[:, frames], 0)
+            weight = np.asarray(weights.sum(axis=1))
+            with np.errstate(invalid='ignore', divide='ignore'):
+                field[:, frames] = np.where(weight > 0, total / weight, np.nan)
+        shape = (len(self.latitudes), len(self.longitudes))
+        if values.ndim == 1:
+            return field[:, 0].reshape(shape)
+        return np.moveaxis(field, 1, 0).reshape((values.shape[1],) + shape)
+
+
+def getGrid(latitude, longitude, cacheDir=None, **options):
+    """
+    function getGrid( latitude, longitude, cacheDir=None, **options )
+
+    Module     : scipy.sparse
+
+    Description: to get the IdwGrid of a station set, with its weights from this
+                 process, else from cacheDir, else computed (and saved there).
+
+    Parameters : latitude, longitude, array-like (station coordinates)
+                 cacheDir, str or None (folder of the saved weight matrices)
+                 options, see IdwGrid
+
+    Return     : IdwGrid
+
+    Examples of sage:
+        >> grid = getGrid(df['staLatitude'], df['staLongitude'], '/home/palert/data/grids')
+    """
+    grid = IdwGrid(latitude, longitude, **options)
+    key = grid.key
+    with _gridsLock:
+        if key in _grids:
+            return _grids[key]
+    path = f'{cacheDir}/idw_{key}.npz' if cacheDir else None
+    if path and os.path.exists(path):
+        grid.weights = sparse.load_npz(path).tocsr()
+    else:
+        grid.buildWeights()
+        if path:
+            os.makedirs(cacheDir, exist_ok=True)
+            buffer = io.BytesIO()
+            sparse.save_npz(buffer, grid.weights)
+            library.atomicWrite(path, buffer.getvalue())
+    with _gridsLock:
+        return _grids.setdefault(key, grid)
+
+
+def contourLines(longitudes, latitudes, field, levels=INTENSITY_LEVELS):
+    """
+    function contourLines( longitudes, latitudes, field, levels=INTENSITY_LEVELS )
+
+    Module     : matplotlib (figure)
+
+    Description: to get the contour lines of a gridded field, without drawing.
+
+    Parameters : longitudes, latitudes, np.ndarray (axes of the grid)
+                 field, np.ndarray (latitudes x longitudes, NaN for no data)
+                 levels, list of float
+
+    Return     : a list of (level, np.ndarray of lon/lat points) per line
+
+    Examples of sage:
+        >> for level, points in contourLines(grid.longitudes, grid.latitudes, intensity):
+        >>     print(level, len(points))
+    """
+    from matplotlib.figure import Figure
+
+    masked = np.ma.masked_invalid(field)
+    levels = [level for level in levels if masked.count() and masked.min() <= level <= masked.max()]
+    if not levels:
+        return []
+    contours = Figure().add_subplot().contour(longitudes, latitudes, masked, levels)
+    return [(level, points) for level, segments in zip(contours.levels, contours.allsegs)
+            for points in segments if len(points) > 1]
+
+
+def writeXyz(filename, longitudes, latitudes, field):
+    """
+    function writeXyz( filename, longitudes, latitudes, field )
+
+    Description: to write a grid as "lon lat value" lines, the input of gmt
+                 xyz2grd. Nodes without data are not written.
+
+    Parameters : filename, str
+                 longitudes, latitudes, np.ndarray (axes of the grid)
+                 field, np.ndarray (latitudes x longitudes)
+
+    Examples of sage:
+        >> writeXyz('20220108051219PGAs.xyz', grid.longitudes, grid.latitudes, intensity)
+    """
+    gridLon, gridLat = np.meshgrid(longitudes, latitudes)
+    found = np.isfinite(field)
+    buffer = io.StringIO()
+    np.savetxt(buffer, np.column_stack([gridLon[found], gridLat[found], field[found]]), fmt='%.4f %.4f %.3f')
+    library.atomicWrite(filename, buffer.getvalue())
+
+
+def writeContours(filename, lines):
+    """
+    function writeContours( filename, lines )
+
+    Description: to write contour lines as a gmt multiple segment file, one
+                 "> -Z<level>" header per line.
+
+    Parameters : filename, str
+                 lines, list of (level, points) from contourLines
+
+    Examples of sage:
+        >> writeContours('20220108051219PGAs.contour', contourLines(grid.longitudes, grid.latitudes, intensity))
+    """
+    buffer = io.StringIO()
+    for level, points in lines:
+        buffer.write(f'> -Z{level:g}\n')
+        np.savetxt(buffer, points, fmt='%.4f %.4f')
+    library.atomicWrite(filename, buffer.getvalue())
+
+
+def writeProducts(basename, grid, values, levels=INTENSITY_LEVELS):
+    """
+    function writeProducts( basename, grid, values, levels=INTENSITY_LEVELS )
+
+    Description: to grid station values and write basename.xyz and
+                 basename.contour for each frame.
+
+    Parameters : basename, str, or list of str (one per frame)
+                 grid, IdwGrid
+                 values, np.ndarray (stations, or stations x frames; NaN for no data)
+                 levels, list of float
+
+    Return     : the written file names
+
+    Examples of sage:
+        >> writeProducts([f'accum/PGAs_{i:02}' for i in range(1, 41)], grid, intensities)
+    """
+    fields = grid.interpolate(values)
+    if fields.ndim == 2:
+        basename, fields = [basename], fields[np.newaxis]
+    files = []
+    for name, field in zip(basename, fields):
+        writeXyz(f'{name}.xyz', grid.longitudes, grid.latitudes, field)
+        writeContours(f'{name}.contour', contourLines(grid.longitudes, grid.latitudes, field, levels))
+        files += [f'{name}.xyz', f'{name}.contour']
+    return files
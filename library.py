@@ -1,9 +1,8 @@
+# numpy, pandas, obspy, the xml parser and zipfile are imported by the
+# functions that use them, so the poller (alertEQ) starts without them when
+# there is no new event
 import os
-import pandas as pd
 import shutil
-import xml.etree.ElementTree as ET
-import zipfile
-from obspy.core import UTCDateTime
         
 
 def unzipFile(inputName, outputName):
@@ -30,12 +29,133 @@ def unzipFile(inputName, outputName):
         >> ls libraryTest
         download.zip   unzipFolder
     """
+    import zipfile
     if os.path.isdir(outputName): shutil.rmtree(outputName)
     if os.path.isfile(outputName): os.remove(outputName)
     with zipfile.ZipFile(inputName, 'r') as zip_ref:
         zip_ref.extractall(outputName)
         
         
+class CwbEvent():
+    """
+    class CwbEvent
+
+    Description: a CWB earthquake report parsed in one pass (see parseCwbXml).
+                 The station table is kept column-wise in typed numpy arrays;
+                 an integer column is a masked array, masked where the report
+                 has no value, and an Int64 column of to_dataframe.
+
+    Attributes : eqNo, int
+                 originTimeUTC, UTCDateTime
+                 longitude, latitude, depth, magnitude, float
+                 stations, dict of column name -> np.ndarray
+    """
+    # column name, path below eqStation, type of the value
+    STATION_FIELDS = [('stationCode', 'stationCode', str),
+                      ('stationLon', 'stationLon', float),
+                      ('stationLat', 'stationLat', float),
+                      ('stationDist', 'distance', float),
+                      ('stationAz', 'azimuth', float),
+                      ('stationIntensity', 'stationIntensity', int),
+                      ('stationPGAz', 'pga/vComponent', float),
+                      ('stationPGAns', 'pga/nsComponent', float),
+                      ('stationPGAew', 'pga/ewComponent', float)]
+    
+    def __init__(self):
+        self.eqNo = None
+        self.originTimeUTC = None
+        self.longitude = None
+        self.latitude = None
+        self.depth = None
+        self.magnitude = None
+        self.stations = {}
+    
+    @property
+    def parameters(self):
+        return {'originTImeUTC': self.originTimeUTC,
+                'longitude': self.longitude,
+                'latitude': self.latitude,
+                'depth': self.depth,
+                'magnitude': self.magnitude}
+    
+    def to_dataframe(self):
+        import numpy as np
+        import pandas as pd
+        df = pd.DataFrame({name: pd.arrays.IntegerArray(values.filled(0), np.ma.getmaskarray(values))
+                           if np.ma.isMaskedArray(values) else values
+                           for name, values in self.stations.items()})
+        df['stationPGAmax'] = df[['stationPGAz', 'stationPGAns', 'stationPGAew']].max(axis=1)
+        return df
+
+
+def parseCwbXml(source):
+    """
+    function parseCwbXml( source )
+    
+    Module     : ET (xml.etree.ElementTree)
+                 np (numpy)
+              
+    Description: to get eq id number, eq parameters and station information of
+                 a event in a single pass (iterparse), clearing every eqStation
+                 once it has been read.
+                 
+    Parameters : source, str or file object (a xml file including event information)
+    
+    Return     : a CwbEvent
+    
+    Examples of sage:
+        >> event = parseCwbXml('CWB-EQ110095-2021-0915-185053.xml')
+        >> print(event.eqNo, event.parameters)
+        110095 {'originTImeUTC': UTCDateTime(2021, 9, 15, 10, 50, 53), 'longitude': 121.39, 'latitude': 23.16, 'depth': 20.6, 'magnitude': 4.5}
+        >> df = event.to_dataframe()
+    """
+    import numpy as np
+    import xml.etree.ElementTree as ET
+    from obspy.core import UTCDateTime
+    event = CwbEvent()
+    columns = {name: [] for name, path, cast in CwbEvent.STATION_FIELDS}
+    ns = None
+    path = []
+    for action, elem in ET.iterparse(source, events=('start', 'end')):
+        tag = elem.tag.split('}')[-1]
+        if action == 'start':
+            if ns is None:
+                ns = {'d': elem.tag.split('}')[0].strip('{')}
+            path.append(tag)
+            continue
+        path.pop()
+        parent = path[-1] if path else None
+        if tag == 'earthquakeNo' and event.eqNo is None:
+            event.eqNo = int(elem.text)
+        elif parent == 'earthquakeInfo' and tag == 'originTime':
+            event.originTimeUTC = UTCDateTime(elem.text)
+        elif parent == 'earthquakeInfo' and tag == 'depth':
+            event.depth = float(elem.text)
+        elif parent == 'epicenter' and tag == 'epicenterLon':
+            event.longitude = float(elem.text)
+        elif parent == 'epicenter' and tag == 'epicenterLat':
+            event.latitude = float(elem.text)
+        elif parent == 'magnitude' and tag == 'magnitudeValue':
+            event.magnitude = float(elem.text)
+        elif parent == 'shakingArea' and tag == 'eqStation':
+            for name, field, cast in CwbEvent.STATION_FIELDS:
+                child = elem.find('/'.join(f'd:{part}' for part in field.split('/')), ns)
+                columns[name].append(None if child is None else cast(child.text))
+            elem.clear()
+    if event.eqNo is None:
+        raise ValueError(f'{getattr(source, "name", source)} has no earthquakeNo.')
+    for name, field, cast in CwbEvent.STATION_FIELDS:
+        values = columns[name]
+        if cast is str:
+            event.stations[name] = np.array(values, dtype=object)
+        elif cast is int:
+            event.stations[name] = np.ma.masked_array([0 if value is None else value for value in values],
+                                                      mask=[value is None for value in values], dtype=np.int64)
+        else:
+            event.stations[name] = np.array([np.nan if value is None else value for value in values], dtype=np.float64)
+    return event
+
+
 def getCwbStationInfo(xmlfile):
     """
     function getCwbStationInfo( xmlfile )
@@ -55,59 +175,7 @@ def getCwbStationInfo(xmlfile):
     Examples of sage:
         >> df = getCwbStationInfo(xmlfile)
     """
-    tree = ET.parse(xmlfile)
-    root = tree.getroot()
-    ns = {'d': root.tag.split('}')[0].strip('{')}
-    data = {'stationCode': [],
-            'stationLon': [],
-            'stationLat': [],
-            'stationDist': [],
-            'stationAz': [],
-            'stationIntensity': [],
-            'stationPGAz': [],
-            'stationPGAns': [],
-            'stationPGAew': []}
-    for station in root.findall('d:dataset/d:earthquake/d:intensity/d:shakingArea/d:eqStation', ns):
-        if station.find('d:stationCode', ns) == None:
-            data['stationCode'].append(None)
-        else:
-            data['stationCode'].append(station.find('d:stationCode', ns).text)
-            
-        if station.find('d:stationLon', ns) == None:
-            data['stationLon'].append(None)
-        else:
-            data['stationLon'].append(float(station.find('d:stationLon', ns).text))
-        if station.find('d:stationLat', ns) == None:
-            data['stationLat'].append(None)     
-        else:
-            data['stationLat'].append(float(station.find('d:stationLat', ns).text))
-        if station.find('d:distance', ns) == None:
-            data['stationDist'].append(None)
-        else:
-            data['stationDist'].append(float(station.find('d:distance', ns).text))       
-        if station.find('d:azimuth', ns) == None:
-            data['stationAz'].append(None)       
-        else:
-            data['stationAz'].append(float(station.find('d:azimuth', ns).text)) 
-        if station.find('d:stationIntensity', ns) == None:
-            data['stationIntensity'].append(None)        
-        else:
-            data['stationIntensity'].append(int(station.find('d:stationIntensity', ns).text))
-        if station.find('d:pga/d:vComponent', ns) == None:
-            data['stationPGAz'].append(None)      
-        else:
-            data['stationPGAz'].append(float(station.find('d:pga/d:vComponent', ns).text)) 
-        if station.find('d:pga/d:nsComponent', ns) == None:
-            data['stationPGAns'].append(None)      
-        else:
-            data['stationPGAns'].append(float(station.find('d:pga/d:nsComponent', ns).text)) 
-        if station.find('d:pga/d:ewComponent', ns) == None:
-            data['stationPGAew'].append(None)   
-        else:
-            data['stationPGAew'].append(float(station.find('d:pga/d:ewComponent', ns).text))
-    df = pd.DataFrame(data)
-    df['stationPGAmax'] = df[['stationPGAz', 'stationPGAns', 'stationPGAew']].max(axis=1)
-    return df
+    return parseCwbXml(xmlfile).to_dataframe()
 
 
 def getEqParameters(dict, xmlfile):
@@ -130,15 +198,7 @@ def getEqParameters(dict, xmlfile):
         >> print(getEqParameters(eqParameters, xmlfile))
         {'longitude': 121.39, 'latitude': 23.16, 'depth': 20.6, 'magnitude': 4.5}
     """
-    tree = ET.parse(xmlfile)
-    root = tree.getroot()
-    ns = {'d': root.tag.split('}')[0].strip('{')}
-    eqParameters = root.find('d:dataset/d:earthquake/d:earthquakeInfo', ns)
-    dict['originTImeUTC'] = UTCDateTime(eqParameters.find('d:originTime', ns).text)
-    dict['longitude'] = float(eqParameters.find('d:epicenter/d:epicenterLon', ns).text)
-    dict['latitude'] = float(eqParameters.find('d:epicenter/d:epicenterLat', ns).text)
-    dict['depth'] = float(eqParameters.find('d:depth', ns).text)
-    dict['magnitude'] = float(eqParameters.find('d:magnitude/d:magnitudeValue', ns).text)
+    dict.update(parseCwbXml(xmlfile).parameters)
 
 
 def removeFile(filename):
@@ -161,6 +221,52 @@ def removeFile(filename):
         os.remove(filename)
         
 
+def atomicWrite(filename, content):
+    """
+    function atomicWrite( filename, content )
+    
+    Module     : os
+              
+    Description: to write a file in one write to a temporary name beside it and
+                 rename it into place, so readers never see it half-written.
+                 
+    Parameters : filename, str
+                 content, str or bytes
+    
+    Examples of sage:
+        >> atomicWrite('20220108051219PGAs.txt', text)
+    """
+    tmpName = f'{filename}.{os.getpid()}.tmp'
+    with open(tmpName, 'wb' if isinstance(content, bytes) else 'w') as f:
+        f.write(content)
+    os.replace(tmpName, filename)
+
+
+def publishFile(source, destination):
+    """
+    function publishFile( source, destination )
+    
+    Module     : os
+              
+    Description: to publish a file under another name without copying it: a hard
+                 link, or a symbolic link across file systems, renamed into place
+                 atomically.
+                 
+    Parameters : source, str (an existing file)
+                 destination, str (the published file name)
+    
+    Examples of sage:
+        >> publishFile('20220108051219PGAs.txt', '/var/www/html/palert/pga/staticpga/20220108051219PGAs.txt')
+    """
+    tmpName = f'{destination}.{os.getpid()}.tmp'
+    removeFile(tmpName)
+    try:
+        os.link(source, tmpName)
+    except OSError:
+        os.symlink(os.path.abspath(source), tmpName)
+    os.replace(tmpName, destination)
+
+
 if __name__ == "__main__":
     print('You\'re in a function library.')
     
@@ -0,0 +1,251 @@
+# to see where the time of an event goes
+#
+# Every span (an Earthquake stage, an alertEQ poll) records its wall time, CPU
+# time, the bytes downloaded, the files opened for reading and for writing, the
+# subprocesses started and the peak RSS of the process. The counters are
+# process wide: spans running at the same time in other threads are counted
+# in each other. Spans go to a JSON lines file, a Prometheus text file (for
+# the node exporter textfile collector) or both, and each span can be
+# profiled with cProfile.
+
+import contextlib
+import cProfile
+import json
+import os
+import resource
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+
+COUNTERS = ['bytesDownloaded', 'filesRead', 'filesWritten', 'subprocesses']
+PROMETHEUS_PREFIX = 'palert'
+
+_counters = dict.fromkeys(COUNTERS, 0)
+_countersLock = threading.Lock()
+_hookInstalled = False
+_config = {'jsonPath': os.environ.get('PALERT_METRICS_JSON'),
+           'prometheusPath': os.environ.get('PALERT_METRICS_PROM'),
+           'profileDir': os.environ.get('PALERT_PROFILE_DIR'),
+           'owner': os.getpid()}
+_totals = {}
+_writeLock = threading.Lock()
+_profiling = threading.local()
+_muted = threading.local()
+
+
+def count(counter, n=1):
+    """
+    function count( counter, n=1 )
+
+    Description: to add n to one of the COUNTERS, e.g. the bytes of a download.
+
+    Parameters : counter, str (one of COUNTERS)
+                 n, int
+
+    Examples of sage:
+        >> count('bytesDownloaded', len(response.content))
+    """
+    with _countersLock:
+        _counters[counter] += n
+
+
+def _audit(event, args):
+    # files and subprocesses are counted from the audit events of the interpreter
+    if getattr(_muted, 'active', False):
+        return
+    if event == 'open':
+        path, mode, flags = args
+        if not isinstance(path, (str, bytes, os.PathLike)) or str(path).endswith(('.py', '.pyc')):
+            return
+        if mode is not None:
+            writing = any(char in mode for char in 'wax+')
+        else:
+            writing = bool(flags & (os.O_WRONLY | os.O_RDWR))
+        count('filesWritten' if writing else 'filesRead')
+    elif event in ('subprocess.Popen', 'os.system'):
+        count('subprocesses')
+
+
+def configure(jsonPath=None, prometheusPath=None, profileDir=None):
+    """
+    function configure( jsonPath=None, prometheusPath=None, profileDir=None )
+
+    Description: to choose where the spans go. The defaults come from the
+                 environment variables PALERT_METRICS_JSON, PALERT_METRICS_PROM
+                 and PALERT_PROFILE_DIR; a None argument keeps the current value.
+
+    Parameters : jsonPath, str (one json object per span is appended)
+                 prometheusPath, str (rewritten with the totals after every span)
+                 profileDir, str (one cProfile dump per span)
+
+    Examples of sage:
+        >> configure(jsonPath='/home/palert/data/metrics.jsonl', profileDir='/home/palert/data/profiles')
+    """
+    for key, value in [('jsonPath', jsonPath), ('prometheusPath', prometheusPath), ('profileDir', profileDir)]:
+        if value is not None:
+            _config[key] = value
+    _config['owner'] = os.getpid()
+    if _config['profileDir']:
+        os.makedirs(_config['profileDir'], exist_ok=True)
+
+
+def workerSettings():
+    """
+    function workerSettings( )
+
+    Description: to get what a worker process started with forkserver or spawn
+                 (which does not inherit configure) needs to record its spans
+                 like this process: the json lines and the profiles, never the
+                 totals file.
+
+    Return     : dict, for configureWorker
+
+    Examples of sage:
+        >> ProcessPoolExecutor(initializer=configureWorker, initargs=(workerSettings(),))
+    """
+    return {'jsonPath': _config['jsonPath'], 'profileDir': _config['profileDir']}
+
+
+def configureWorker(settings):
+    """
+    function configureWorker( settings )
+
+    Description: to configure a worker process with the workerSettings of its parent.
+
+    Parameters : settings, dict (see workerSettings)
+
+    Examples of sage:
+        >> configureWorker({'jsonPath': '/home/palert/data/metrics.jsonl', 'profileDir': None})
+    """
+    _config.update(settings, prometheusPath=None)
+    if _config['profileDir']:
+        os.makedirs(_config['profileDir'], exist_ok=True)
+
+
+def _installHook():
+    global _hookInstalled
+    with _countersLock:
+        if not _hookInstalled:
+            sys.addaudithook(_audit)
+            _hookInstalled = True
+
+
+def _snapshot():
+    with _countersLock:
+        counters = dict(_counters)
+    return time.perf_counter(), time.process_time(), counters
+
+
+def _peakRss():
+    # ru_maxrss is in kilobytes on linux and in bytes on macos
+    scale = 1 if sys.platform == 'darwin' else 1024
+    return max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) * scale
+
+
+@contextlib.contextmanager
+def span(name, **labels):
+    """
+    function span( name, **labels )
+
+    Module     : cProfile
+                 resource
+
+    Description: to measure a block of work and emit it as one record.
+
+    Parameters : name, str (e.g. the stage name)
+                 labels, str or int (e.g. eqNo=111001, only in the json lines)
+
+    Return     : the record, a dict filled in when the block ends
+
+    Examples of sage:
+        >> with span('processData', eqNo=111001):
+        >>     event.processData(dir2Process, -20, 100)
+    """
+    _installHook()
+    record = {'span': name, **labels}
+    profiler = None
+    if _config['profileDir'] and not getattr(_profiling, 'active', False):
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+            _profiling.active = True
+        except ValueError:
+            # another profiler (e.g. of an outer span in another thread) is running
+            profiler = None
+    wall, cpu, counters = _snapshot()
+    record['status'] = 'error'
+    try:
+        yield record
+        record['status'] = 'ok'
+    finally:
+        endWall, endCpu, endCounters = _snapshot()
+        if profiler is not None:
+            profiler.disable()
+            _profiling.active = False
+            stamp = datetime.now(timezone.utc).strftime('%Y%m%d%H%M%S%f')
+            suffix = ''.join(f'-{value}' for value in labels.values())
+            profiler.dump_stats(f"{_config['profileDir']}/{name}{suffix}-{stamp}.prof")
+        record.update({'time': datetime.now(timezone.utc).isoformat(),
+                       'wall': round(endWall - wall, 6),
+                       'cpu': round(endCpu - cpu, 6),
+                       **{counter: endCounters[counter] - counters[counter] for counter in COUNTERS},
+                       'peakRss': _peakRss()})
+        _emit(record)
+
+
+def _emit(record):
+    with _writeLock:
+        total = _totals.setdefault(record['span'], {'runs': 0, 'errors': 0, 'wall': 0., 'cpu': 0., **dict.fromkeys(COUNTERS, 0)})
+        total['runs'] += 1
+        total['errors'] += record['status'] != 'ok'
+        for key in ['wall', 'cpu', *COUNTERS]:
+            total[key] += record[key]
+        # the files written here are not counted in the next span
+        _muted.active = True
+        try:
+            if _config['jsonPath']:
+                with open(_config['jsonPath'], 'a') as f:
+                    f.write(json.dumps(record, default=str) + '\n')
+            # worker processes (e.g. of backfill) only append json lines, the
+            # totals file belongs to the process that configured it
+            if _config['prometheusPath'] and os.getpid() == _config['owner']:
+                tmpPath = f"{_config['prometheusPath']}.{os.getpid()}.tmp"
+                with open(tmpPath, 'w') as f:
+                    f.write(prometheusText())
+                os.replace(tmpPath, _config['prometheusPath'])
+        finally:
+            _muted.active = False
+
+
+def prometheusText():
+    """
+    function prometheusText( )
+
+    Description: to get the totals of every span name of this process in the
+                 Prometheus text exposition format.
+
+    Return     : str
+
+    Examples of sage:
+        >> print(prometheusText())
+        # TYPE palert_span_runs_total counter
+        palert_span_runs_total{span="processData"} 2
+        ...
+    """
+    metrics = [('span_runs_total', 'counter', 'runs'),
+               ('span_errors_total', 'counter', 'errors'),
+               ('span_wall_seconds_total', 'counter', 'wall'),
+               ('span_cpu_seconds_total', 'counter', 'cpu'),
+               ('span_downloaded_bytes_total', 'counter', 'bytesDownloaded'),
+               ('span_files_read_total', 'counter', 'filesRead'),
+               ('span_files_written_total', 'counter', 'filesWritten'),
+               ('span_subprocesses_total', 'counter', 'subprocesses')]
+    lines = []
+    for metric, kind, key in metrics:
+        lines.append(f'# TYPE {PROMETHEUS_PREFIX}_{metric} {kind}')
+        lines += [f'{PROMETHEUS_PREFIX}_{metric}{{span="{name}"}} {total[key]}' for name, total in sorted(_totals.items())]
+    lines.append(f'# TYPE {PROMETHEUS_PREFIX}_peak_rss_bytes gauge')
+    lines.append(f'{PROMETHEUS_PREFIX}_peak_rss_bytes {_peakRss()}')
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,428 @@
+import bisect
+import contextlib
+import ftplib
+import io
+import json
+import metrics
+import os
+import queue
+import re
+import tarfile
+import threading
+import time
+from ftplib import FTP
+from obspy import UTCDateTime
+
+
+# can be pointed elsewhere, e.g. at the ftp stand-in of benchmarks/mockServices.py
+NTU_FTP_HOST = os.environ.get('PALERT_NTU_FTP_HOST', '140.112.65.220')
+NTU_FTP_PORT = int(os.environ.get('PALERT_NTU_FTP_PORT', 2121))
+# seconds a stopped archive reader waits for its transfer thread
+JOIN_TIMEOUT = 5
+
+
+class _ChunkReader(io.RawIOBase):
+    """File-like end of a queue filled by retrbinary, read by tarfile in stream mode."""
+
+    def __init__(self, maxChunks=64):
+        self.chunks = queue.Queue(maxChunks)
+        self.abandoned = threading.Event()
+        self.__buffer = b''
+        self.__eof = False
+
+    def readable(self):
+        return True
+
+    def feed(self, chunk):
+        while True:
+            if self.abandoned.is_set():
+                raise IOError('The archive reader stopped before the transfer ended.')
+            try:
+                self.chunks.put(chunk, timeout=1)
+                return
+            except queue.Full:
+                pass
+
+    def readinto(self, b):
+        while not self.__buffer and not self.__eof:
+            chunk = self.chunks.get()
+            if isinstance(chunk, BaseException):
+                raise chunk
+            if chunk is None:
+                self.__eof = True
+            else:
+                self.__buffer = chunk
+        n = min(len(b), len(self.__buffer))
+        b[:n] = self.__buffer[:n]
+        self.__buffer = self.__buffer[n:]
+        return n
+
+
+def connect(host=NTU_FTP_HOST, port=NTU_FTP_PORT, timeout=None):
+    """
+    function connect( host=NTU_FTP_HOST, port=NTU_FTP_PORT, timeout=None )
+
+    Module     : ftplib
+
+    Description: to open an anonymous connection to the NTU ftp server.
+
+    Return     : a logged-in ftplib.FTP
+
+    Examples of sage:
+        >> ftpNTU = connect()
+    """
+    ftp = FTP(timeout=timeout)
+    ftp.connect(host, port)
+    ftp.login()
+    return ftp
+
+
+def iterArchive(ftp, remoteName):
+    """
+    function iterArchive( ftp, remoteName )
+
+    Module     : tarfile
+                 threading
+
+    Description: to decompress a .tar.bz2 while retrbinary is still receiving it.
+                 The transfer runs in a thread and tarfile reads it in stream mode,
+                 so nothing but the members themselves is ever written anywhere.
+
+    Parameters : ftp, ftplib.FTP (already in the folder of the archive)
+                 remoteName, str (name of the archive on the server)
+
+    Return     : a generator of (member name, member bytes) of the regular files
+
+    Examples of sage:
+        >> for name, content in iterArchive(ftpNTU, '20220107_211019_MAN.tar.bz2'):
+        >>     print(name, len(content))
+    """
+    reader = _ChunkReader()
+
+    def received(chunk):
+        metrics.count('bytesDownloaded', len(chunk))
+        reader.feed(chunk)
+
+    def transfer():
+        try:
+            ftp.retrbinary('RETR ' + remoteName, received)
+            end = None
+        except BaseException as error:
+            end = error
+        try:
+            reader.feed(end)
+        except IOError:
+            # the reader stopped, nobody waits for the end
+            pass
+
+    thread = threading.Thread(target=transfer, daemon=True)
+    thread.start()
+    try:
+        with tarfile.open(fileobj=io.BufferedReader(reader), mode='r|bz2') as tar:
+            for member in tar:
+                if member.isfile():
+                    yield member.name, tar.extractfile(member).read()
+        # the rest of the transfer (tar padding) is read, so retrbinary gets the
+        # reply of the server and the connection can be used again
+        while reader.read(65536):
+            pass
+    finally:
+        reader.abandoned.set()
+        thread.join(JOIN_TIMEOUT)
+    if thread.is_alive():
+        raise IOError(f'The transfer of {remoteName} did not stop.')
+
+
+def extractArchive(ftp, remoteName, outputDir=None):
+    """
+    function extractArchive( ftp, remoteName, outputDir=None )
+
+    Module     : os
+
+    Description: to stream a .tar.bz2 from the ftp server either into memory or
+                 into one on-disk copy under outputDir (the same layout as tar -C).
+
+    Parameters : ftp, ftplib.FTP (already in the folder of the archive)
+                 remoteName, str (name of the archive on the server)
+                 outputDir, str or None (None keeps the members in memory)
+
+    Return     : a dict of member name -> bytes if outputDir is None,
+                 otherwise a list of the written paths
+
+    Examples of sage:
+        >> members = extractArchive(ftpNTU, '20220107_211019_MAN.tar.bz2')
+        >> paths = extractArchive(ftpNTU, '20220107_211019_MAN.tar.bz2', '/home/palert/data/SAC/202201')
+    """
+    return _storeMembers(iterArchive(ftp, remoteName), outputDir)
+
+
+def extractLocalArchive(path, outputDir=None):
+    """
+    function extractLocalArchive( path, outputDir=None )
+
+    Module     : tarfile
+
+    Description: to do what extractArchive does with an archive that is already
+                 downloaded (e.g. by asyncFetch).
+
+    Parameters : path, str (a .tar.bz2)
+                 outputDir, str or None (None keeps the members in memory)
+
+    Return     : a dict of member name -> bytes if outputDir is None,
+                 otherwise a list of the written paths
+
+    Examples of sage:
+        >> members = extractLocalArchive('/home/palert/data/SAC/202201/20220107_211019_MAN.tar.bz2')
+    """
+    def iterLocal():
+        with tarfile.open(path, mode='r|bz2') as tar:
+            for member in tar:
+                if member.isfile():
+                    yield member.name, tar.extractfile(member).read()
+
+    return _storeMembers(iterLocal(), outputDir)
+
+
+def _storeMembers(items, outputDir):
+    members = {} if outputDir is None else []
+    for name, content in items:
+        if outputDir is None:
+            members[name] = content
+            continue
+        path = os.path.normpath(os.path.join(outputDir, name))
+        if not path.startswith(os.path.normpath(outputDir) + os.sep):
+            raise ValueError(f'{name} is outside of {outputDir}.')
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(content)
+        members.append(path)
+    return members
+
+
+class FtpPool():
+    """
+    class FtpPool
+
+    Module     : ftplib
+
+    Description: logged-in connections to the NTU ftp server that are reused
+                 instead of opened for every listing and download. A connection
+                 goes back to its home folder when it is returned.
+
+    Examples of sage:
+        >> pool = FtpPool()
+        >> with pool.connection() as ftpNTU:
+        >>     print(ftpNTU.nlst('events/202201'))
+    """
+    def __init__(self, host=NTU_FTP_HOST, port=NTU_FTP_PORT, size=2, timeout=60):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.__idle = queue.LifoQueue()
+        self.__slots = threading.BoundedSemaphore(size)
+
+    @contextlib.contextmanager
+    def connection(self):
+        with self.__slots:
+            ftp, home = self.__acquire()
+            try:
+                yield ftp
+                ftp.cwd(home)
+            except BaseException:
+                self.__discard(ftp)
+                raise
+            self.__idle.put((ftp, home))
+
+    def __acquire(self):
+        while True:
+            try:
+                ftp, home = self.__idle.get_nowait()
+            except queue.Empty:
+                ftp = connect(self.host, self.port, self.timeout)
+                return ftp, ftp.pwd()
+            try:
+                ftp.voidcmd('NOOP')
+                return ftp, home
+            except (OSError, EOFError, ftplib.Error):
+                self.__discard(ftp)
+
+    @staticmethod
+    def __discard(ftp):
+        try:
+            ftp.close()
+        except OSError:
+            pass
+
+    def close(self):
+        while True:
+            try:
+                ftp, home = self.__idle.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                ftp.quit()
+            except (OSError, EOFError, ftplib.Error):
+                ftp.close()
+
+
+class ArchiveIndex():
+    """
+    class ArchiveIndex
+
+    Module     : bisect
+                 json
+
+    Description: the list of events/YYYYMM/*.tar.bz2 on the NTU ftp server, kept
+                 in memory and in a local json file, refreshed when older than
+                 maxAge seconds, or when a lookup misses.
+
+    Examples of sage:
+        >> index = ArchiveIndex(FtpPool(), '/home/palert/data/ntuArchiveIndex.json')
+        >> print(index.nearest(UTCDateTime('2022-01-07T21:10:19'), tolerance=1))
+        20220107_211019_MAN
+    """
+    SUFFIX = '.tar.bz2'
+    NAME = re.compile(r'\d{8}_\d{6}_\w+\.tar\.bz2')
+
+    def __init__(self, pool, cachePath=None, maxAge=300):
+        self.pool = pool
+        self.cachePath = cachePath
+        self.maxAge = maxAge
+        self.__lock = threading.RLock()
+        self.__months = {}
+        if cachePath and os.path.exists(cachePath):
+            with open(cachePath) as f:
+                for month, entry in json.load(f).items():
+                    self.__months[month] = self.__entry(entry['fetched'], entry['names'])
+
+    @classmethod
+    def __entry(cls, fetched, names):
+        # (fetched, names, times) of a month, replaced as a whole so that a
+        # reader never pairs the names of one listing with the times of another
+        names = cls.__archiveNames(names)
+        return fetched, names, cls.__parseTimes(names)
+
+    @classmethod
+    def __archiveNames(cls, names):
+        # only YYYYMMDD_HHMMSS_KIND.tar.bz2 with a real date, sorted; anything
+        # else in the folder (notes, partial uploads) is left out of the index
+        archives = []
+        for name in names:
+            if cls.NAME.fullmatch(name):
+                try:
+                    UTCDateTime.strptime(name[:15], '%Y%m%d_%H%M%S')
+                except ValueError:
+                    continue
+                archives.append(name)
+        return sorted(archives)
+
+    @classmethod
+    def __parseTimes(cls, names):
+        # names sorted by time: YYYYMMDD_HHMMSS_MAN.tar.bz2 sorts as its timestamp
+        return [UTCDateTime.strptime(name[:15], '%Y%m%d_%H%M%S').timestamp for name in names]
+
+    def refresh(self, month):
+        return self.__refresh(month)[1]
+
+    def __refresh(self, month):
+        with self.pool.connection() as ftp:
+            listing = ftp.nlst(f'events/{month}')
+        entry = self.__entry(time.time(), [os.path.basename(name) for name in listing])
+        with self.__lock:
+            self.__months[month] = entry
+            self.__save()
+        return entry
+
+    def __save(self):
+        if not self.cachePath:
+            return
+        tmpPath = f'{self.cachePath}.tmp'
+        with open(tmpPath, 'w') as f:
+            json.dump({month: {'fetched': fetched, 'names': names}
+                       for month, (fetched, names, times) in self.__months.items()}, f)
+        os.replace(tmpPath, self.cachePath)
+
+    def names(self, month):
+        return self.__snapshot(month)[1]
+
+    def __snapshot(self, month):
+        with self.__lock:
+            entry = self.__months.get(month)
+        if entry is None or time.time() - entry[0] > self.maxAge:
+            entry = self.__refresh(month)
+        return entry
+
+    def nearest(self, datetime, tolerance=1, month=None, kind='_MAN'):
+        # month is the events/ folder to look in, by default the one of datetime;
+        # the exact time wins, then later before earlier for the same offset
+        month = month or f'{datetime.year}{datetime.month:02d}'
+        for attempt in range(2):
+            fetched, names, times = self.__snapshot(month) if attempt == 0 else self.__refresh(month)
+            target = datetime.timestamp
+            i = bisect.bisect_left(times, target - tolerance)
+            candidates = [(abs(times[j] - target), -times[j], j) for j in range(i, len(times))
+                          if times[j] <= target + tolerance and names[j].endswith(kind + self.SUFFIX)]
+            if candidates:
+                return names[min(candidates)[2]][:-len(self.SUFFIX)]
+        return None
+
+    def startRefreshing(self, interval=60):
+        # keeps the months already known up to date in a daemon thread
+        def loop():
+            while True:
+                time.sleep(interval)
+                with self.__lock:
+                    months = list(self.__months)
+                for month in months:
+                    try:
+                        self.refresh(month)
+                    except (OSError, EOFError, ftplib.Error) as error:
+                        print(f'Refreshing events/{month} failed: {error!r}')
+
+        thread = threading.Thread(target=loop, daemon=True)
+        thread.start()
+        return thread
+
+
+_defaultPool = None
+_defaultIndexes = {}
+_defaultLock = threading.Lock()
+
+
+def getPool():
+    """
+    function getPool( )
+
+    Description: to get the FtpPool shared by everything in this process.
+
+    Return     : FtpPool
+
+    Examples of sage:
+        >> with getPool().connection() as ftpNTU:
+        >>     ftpNTU.cwd('events/202201')
+    """
+    global _defaultPool
+    with _defaultLock:
+        if _defaultPool is None:
+            _defaultPool = FtpPool()
+        return _defaultPool
+
+
+def getIndex(cachePath=None):
+    """
+    function getIndex( cachePath=None )
+
+    Description: to get the ArchiveIndex of this process for a cache file.
+
+    Parameters : cachePath, str or None (json file to persist the index)
+
+    Return     : ArchiveIndex
+
+    Examples of sage:
+        >> print(getIndex('/home/palert/data/ntuArchiveIndex.json').names('202201'))
+    """
+    pool = getPool()
+    with _defaultLock:
+        if cachePath not in _defaultIndexes:
+            _defaultIndexes[cachePath] = ArchiveIndex(pool, cachePath)
+        return _defaultIndexes[cachePath]
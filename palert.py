@@ -0,0 +1,75 @@
+# the command line of the whole workflow, one command per job
+#
+#   poll     : check the CWB opendata feed once (cron) or keep watching it (alertEQ)
+#   process  : run one CWB earthquake report through every Earthquake stage
+#   backfill : reprocess many reports at once (backfill)
+#   archive  : add reports to the columnar report archive or query it (reportArchive)
+#
+# Only the modules of the chosen command are imported: a poll that finds no new
+# event loads neither numpy, pandas, obspy nor requests. benchmarks/benchImport.py
+# checks it.
+#
+# usage: python palert.py poll --xml-dir /home/palert/xml
+#        python palert.py process ee2022010805121947003 --native-grid
+#        python palert.py backfill --file reports.txt --cpu-workers 8
+#        python palert.py archive stations --start 2021-01-01 --end 2021-12-31T23:59:59 --min-pga 80
+
+import sys
+
+COMMANDS = {'poll': 'check the CWB opendata feed for new earthquake reports',
+            'process': 'run one CWB earthquake report through the whole workflow',
+            'backfill': 'reprocess many CWB earthquake reports',
+            'archive': 'add CWB reports to the report archive, or query it'}
+
+
+def poll(argv):
+    import alertEQ
+    alertEQ.main(argv)
+
+
+def process(argv):
+    import argparse
+    parser = argparse.ArgumentParser(prog='palert.py process', description=COMMANDS['process'])
+    parser.add_argument('report', help='url or id of a CWB earthquake report')
+    parser.add_argument('--data-dir', help='default NTUData.DATA_DIR')
+    parser.add_argument('--web-dir', help='default NTUData.WEB_DIR')
+    parser.add_argument('--db', help='record the finished stages in this event store')
+    parser.add_argument('--native-grid', action='store_true', help='grid and contour without gmt')
+    parser.add_argument('--metrics-json', help='append one json line per stage to this file')
+    parser.add_argument('--metrics-prom', help='keep the totals in this Prometheus text file')
+    parser.add_argument('--profile-dir', help='write a cProfile dump of every stage here')
+    args = parser.parse_args(argv)
+
+    import backfill
+    import eventStore
+    import metrics
+    metrics.configure(args.metrics_json, args.metrics_prom, args.profile_dir)
+    store = eventStore.EventStore(args.db) if args.db else None
+    event = backfill.fetchEvent(args.report, store, args.data_dir, args.web_dir)
+    backfill.publishEvent(backfill.processEvent(event), args.native_grid)
+
+
+def runBackfill(argv):
+    import backfill
+    backfill.main(argv)
+
+
+def archive(argv):
+    import reportArchive
+    reportArchive.main(argv)
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    commands = {'poll': poll, 'process': process, 'backfill': runBackfill, 'archive': archive}
+    if not argv or argv[0] not in commands:
+        print('usage: python palert.py {poll,process,backfill,archive} ...\n')
+        for command, description in COMMANDS.items():
+            print(f'  {command:<10} {description}')
+        sys.exit(0 if argv[:1] in (['-h'], ['--help']) else 2)
+    sys.argv[0] = f'palert.py {argv[0]}'
+    commands[argv[0]](argv[1:])
+
+
+if __name__ == "__main__":
+    main()
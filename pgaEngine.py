@@ -0,0 +1,277 @@
+import numpy as np
+import pandas as pd
+import subprocess
+import library
+
+
+COMPONENTS = ('E', 'N', 'Z')
+PGA_COLUMNS = ['PGAsMaxInENZ', 'intensity', 'PGAsResultantOfENZ', 'PGAsResultantOfEN']
+RDSAC2 = '/home/palert/data/rdsac2'
+
+
+def streamToArray(st, staNames, demean=True, dtype=np.float32, allocate=np.zeros):
+    """
+    function streamToArray( st, staNames, demean=True, dtype=np.float32, allocate=np.zeros )
+
+    Module     : np (numpy)
+
+    Description: to pack the E/N/Z traces of a stream into one aligned array.
+                 Row i belongs to staNames[i]; missing traces stay zero.
+
+    Parameters : st, obspy.Stream (synced traces of a event)
+                 staNames, list of str (station order of the output rows)
+                 demean, bool (remove the mean of each trace)
+                 dtype, numpy dtype of the output array
+                 allocate, function(shape, dtype) returning a zero-filled array
+                           (e.g. to fill a memory-mapped file directly)
+
+    Return     : data, np.ndarray (stations x components x samples)
+                 starttime, UTCDateTime (time of the first sample)
+                 delta, float (sample interval in seconds)
+
+    Examples of sage:
+        >> data, starttime, delta = streamToArray(st, df['staName'])
+    """
+    staIndex = {sta: i for i, sta in enumerate(staNames)}
+    traces = [tr for tr in st
+              if tr.stats.station in staIndex and tr.stats.channel[-1:] in COMPONENTS]
+    if not traces:
+        return allocate((len(staIndex), len(COMPONENTS), 0), dtype=dtype), None, None
+
+    delta = traces[0].stats.delta
+    if any(abs(tr.stats.delta - delta) > 1e-9 for tr in traces):
+        raise ValueError('All traces must share the same sampling rate.')
+    starttime = min(tr.stats.starttime for tr in traces)
+    offsets = [int(round((tr.stats.starttime - starttime) / delta)) for tr in traces]
+    nSamples = max(offset + tr.stats.npts for offset, tr in zip(offsets, traces))
+
+    data = allocate((len(staIndex), len(COMPONENTS), nSamples), dtype=dtype)
+    for offset, tr in zip(offsets, traces):
+        samples = tr.data.astype(np.float64)
+        if demean and samples.size:
+            samples = samples - samples.mean()
+        data[staIndex[tr.stats.station], COMPONENTS.index(tr.stats.channel[-1]),
+             offset:offset + samples.size] = samples
+    return data, starttime, delta
+
+
+def pgaToIntensity(pga):
+    """
+    function pgaToIntensity( pga )
+
+    Module     : np (numpy)
+
+    Description: to convert PGA (gal) to the CWB intensity, I = 2 log10(PGA) + 0.7.
+
+    Parameters : pga, float or np.ndarray (gal)
+
+    Return     : intensity, np.ndarray (non-negative)
+
+    Examples of sage:
+        >> print(pgaToIntensity(np.array([0., 8., 80.])))
+        [0.         2.50617997 4.50617997]
+    """
+    pga = np.asarray(pga, dtype=np.float64)
+    with np.errstate(divide='ignore'):
+        intensity = 2 * np.log10(pga) + 0.7
+    return np.where(pga > 0, np.clip(intensity, 0, None), 0.)
+
+
+def computePGAs(data, chunkSize=64):
+    """
+    function computePGAs( data, chunkSize=64 )
+
+    Module     : np (numpy)
+
+    Description: to get max PGA in E/N/Z, intensity and the ENZ/EN resultant PGAs
+                 of every station in one batched pass.
+
+    Parameters : data, np.ndarray (stations x E/N/Z x samples, see streamToArray)
+                 chunkSize, int (stations per batch, bounds the memory used)
+
+    Return     : np.ndarray (stations x 4), columns ordered as PGA_COLUMNS
+
+    Examples of sage:
+        >> pgas = computePGAs(streamToArray(st, staNames)[0])
+    """
+    result = np.zeros((data.shape[0], len(PGA_COLUMNS)))
+    if data.shape[-1] == 0:
+        return result
+    for start in range(0, data.shape[0], chunkSize):
+        chunk = data[start:start + chunkSize].astype(np.float64)
+        squared = chunk ** 2
+        result[start:start + chunkSize, 0] = np.abs(chunk).max(axis=(1, 2))
+        result[start:start + chunkSize, 2] = np.sqrt(squared.sum(axis=1).max(axis=1))
+        result[start:start + chunkSize, 3] = np.sqrt(squared[:, :2].sum(axis=1).max(axis=1))
+    result[:, 1] = pgaToIntensity(result[:, 0])
+    return result
+
+
+def getPGAs(st, staNames, demean=True):
+    """
+    function getPGAs( st, staNames, demean=True )
+
+    Module     : np (numpy)
+                 pd (pandas)
+
+    Description: to get the PGAs of every station from a stream already in memory,
+                 the in-process replacement of running rdsac2 once per station.
+
+    Parameters : st, obspy.Stream
+                 staNames, list of str
+                 demean, bool (remove the mean of each trace)
+
+    Return     : a pd.dataframe with staName and the PGA_COLUMNS
+
+    Examples of sage:
+        >> df = getPGAs(read('*TW*'), ['A001', 'A002'])
+    """
+    staNames = list(staNames)
+    return pgaFrame(staNames, computePGAs(streamToArray(st, staNames, demean=demean)[0]))
+
+
+def pgaFrame(staNames, pgas):
+    """
+    function pgaFrame( staNames, pgas )
+
+    Module     : pd (pandas)
+
+    Description: to put the output of computePGAs into a dataframe, rounded as
+                 the PGA files are written.
+
+    Parameters : staNames, list of str
+                 pgas, np.ndarray (stations x 4, see computePGAs)
+
+    Return     : a pd.dataframe with staName and the PGA_COLUMNS
+
+    Examples of sage:
+        >> df = pgaFrame(staNames, computePGAs(data))
+    """
+    df = pd.DataFrame(pgas, columns=PGA_COLUMNS)
+    df.insert(0, 'staName', list(staNames))
+    return df.round({'PGAsMaxInENZ': 3, 'intensity': 2,
+                     'PGAsResultantOfENZ': 3, 'PGAsResultantOfEN': 3})
+
+
+def rdsac2PGAs(staNames, workDir, rdsac2=RDSAC2):
+    """
+    function rdsac2PGAs( staNames, workDir, rdsac2=RDSAC2 )
+
+    Module     : pd (pandas)
+                 subprocess
+
+    Description: to get the PGAs of every station by running rdsac2 once per station.
+
+    Parameters : staNames, list of str
+                 workDir, str (folder with the sac files)
+                 rdsac2, str (path of the rdsac2 executable)
+
+    Return     : a pd.dataframe with staName and the PGA_COLUMNS
+
+    Examples of sage:
+        >> df = rdsac2PGAs(['A001', 'A002'], '/home/palert/data/SAC/202201/20220107_211019_MAN')
+    """
+    rows = []
+    for sta in staNames:
+        p = subprocess.Popen([rdsac2, sta], stdout=subprocess.PIPE, cwd=workDir)
+        rows.append([sta, *map(float, p.communicate()[0].decode("utf-8").split()[:4])])
+    return pd.DataFrame(rows, columns=['staName', *PGA_COLUMNS])
+
+
+def checkParity(df, reference, rtol=1e-2, atol=1e-2):
+    """
+    function checkParity( df, reference, rtol=1e-2, atol=1e-2 )
+
+    Module     : np (numpy)
+
+    Description: to compare the PGAs from getPGAs against the rdsac2 ones.
+
+    Parameters : df, pd.dataframe (output of getPGAs)
+                 reference, pd.dataframe (output of rdsac2PGAs)
+                 rtol, atol, float (tolerances, see np.isclose)
+
+    Return     : a pd.dataframe with the stations that disagree
+
+    Examples of sage:
+        >> print(checkParity(getPGAs(st, staNames), rdsac2PGAs(staNames, workDir)))
+    """
+    merged = df.merge(reference, on='staName', suffixes=('', 'Rdsac2'))
+    close = np.ones(len(merged), dtype=bool)
+    for column in PGA_COLUMNS:
+        close &= np.isclose(merged[column], merged[f'{column}Rdsac2'], rtol=rtol, atol=atol)
+    return merged[~close].reset_index(drop=True)
+
+
+def accumPGAs(data, starttime, delta, windowStart, windowLength=3, windowCount=40, chunkSize=64):
+    """
+    function accumPGAs( data, starttime, delta, windowStart, windowLength=3, windowCount=40, chunkSize=64 )
+
+    Module     : np (numpy)
+
+    Description: to get the cumulative PGAs from windowStart to every window boundary
+                 (windowStart + windowLength * i, i = 1 ... windowCount) in one sweep,
+                 using a running prefix-maximum instead of re-cutting the waveforms.
+
+    Parameters : data, np.ndarray (stations x E/N/Z x samples, see streamToArray)
+                 starttime, UTCDateTime (time of the first sample of data)
+                 delta, float (sample interval in seconds)
+                 windowStart, UTCDateTime (start of every cumulative window)
+                 windowLength, float (seconds between two boundaries)
+                 windowCount, int (number of boundaries)
+                 chunkSize, int (stations per batch, bounds the memory used)
+
+    Return     : endtimes, list of UTCDateTime (the window boundaries)
+                 pgas, np.ndarray (windows x stations x 4), columns ordered as PGA_COLUMNS
+
+    Examples of sage:
+        >> data, starttime, delta = streamToArray(st, staNames)
+        >> endtimes, pgas = accumPGAs(data, starttime, delta, originTime - 20)
+    """
+    endtimes = [windowStart + windowLength * i for i in range(1, windowCount + 1)]
+    pgas = np.zeros((windowCount, data.shape[0], len(PGA_COLUMNS)))
+    if data.shape[-1] == 0:
+        return endtimes, pgas
+
+    first = max(int(round((windowStart - starttime) / delta)), 0)
+    if first >= data.shape[-1]:
+        # the windows start after the last sample
+        return endtimes, pgas
+    # trim keeps the sample at endtime, so each boundary index is inclusive
+    last = np.array([int(round((endtime - starttime) / delta)) for endtime in endtimes])
+    valid = last >= first
+    last = np.clip(last, first, data.shape[-1] - 1) - first
+
+    window = data[:, :, first:]
+    for start in range(0, data.shape[0], chunkSize):
+        chunk = window[start:start + chunkSize].astype(np.float64)
+        squared = chunk ** 2
+        series = [np.abs(chunk).max(axis=1),
+                  squared.sum(axis=1),
+                  squared[:, :2].sum(axis=1)]
+        for column, values in zip([0, 2, 3], series):
+            pgas[:, start:start + chunkSize, column] = np.maximum.accumulate(values, axis=1)[:, last].T
+    pgas[:, :, 2:] = np.sqrt(pgas[:, :, 2:])
+    pgas[~valid] = 0
+    pgas[:, :, 1] = pgaToIntensity(pgas[:, :, 0])
+    return endtimes, pgas
+
+
+def writeAccumFrame(filename, endtime, staNames, latitude, longitude, pgas):
+    """
+    function writeAccumFrame( filename, endtime, staNames, latitude, longitude, pgas )
+
+    Description: to write one PGAs_NN file of the accumulated PGAs, the window
+                 end on the first line and one station per line.
+
+    Parameters : filename, str
+                 endtime, UTCDateTime (end of the cumulative window)
+                 staNames, latitude, longitude, list (one per station)
+                 pgas, np.ndarray (stations x 4), columns ordered as PGA_COLUMNS
+
+    Examples of sage:
+        >> writeAccumFrame('accum/PGAs_01', endtimes[0], df['staName'], df['staLatitude'], df['staLongitude'], pgas[0])
+    """
+    lines = [f"{endtime.strftime('%Y %m %d %H%M%S')}\n"]
+    lines += [f"{sta} {lat:.6f} {lon:.6f} {pga[0]:.3f} {pga[1]:.2f} {pga[2]:.3f} {pga[3]:.3f}\n"
+              for sta, lat, lon, pga in zip(staNames, latitude, longitude, pgas)]
+    library.atomicWrite(filename, ''.join(lines))
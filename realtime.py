@@ -0,0 +1,399 @@
+# to follow the accumulated PGAs while the waveforms are still arriving
+#
+# Waveform packets (obspy traces of a few seconds) come from a watched folder,
+# a local socket or a replayed stream. Every station keeps a ring buffer per
+# component and running maxima from the window start, and a PGAs_NN file is
+# written as soon as every active station has passed the window boundary (or
+# `latency` seconds after it), the same products as Earthquake.accum3sPGAs.
+
+import argparse
+import glob
+import io
+import numpy as np
+import os
+import select
+import socket
+import time
+from obspy import read, UTCDateTime
+import intensityGrid
+import pgaEngine
+import stationCatalog
+
+PACKET_PORT = 18000
+STATION_LIST = '/home/palert/data/stalist.txt'
+
+
+class RealtimePGA():
+    """
+    class RealtimePGA
+
+    Module     : np (numpy)
+
+    Description: the cumulative PGAs from windowStart to every window boundary
+                 (windowStart + windowLength * i, both ends included as in
+                 cutWaveform), updated packet by packet. Each station has a ring
+                 buffer of bufferSeconds per component; samples are folded into
+                 the running maxima once all its components have arrived (or
+                 the missing ones are a buffer behind), after the mean of each
+                 component's first baselineSeconds has been removed.
+
+    Examples of sage:
+        >> engine = RealtimePGA(staNames, originTime - 20)
+        >> engine.feed(packet)
+        >> for i, endtime, pgas in engine.ready():
+        >>     print(i, endtime, pgas.max(axis=0))
+    """
+    def __init__(self, staNames, windowStart, delta=0.01, windowLength=3, windowCount=40, bufferSeconds=30, baselineSeconds=5):
+        self.staNames = list(staNames)
+        self.windowStart = windowStart
+        self.delta = delta
+        self.endtimes = [windowStart + windowLength * i for i in range(1, windowCount + 1)]
+        # index of the last sample of every window, relative to windowStart
+        self.boundaries = np.array([int(round(windowLength * i / delta)) for i in range(1, windowCount + 1)])
+        self.__rows = {sta: i for i, sta in enumerate(self.staNames)}
+        self.__size = int(round(bufferSeconds / delta))
+        self.__baselineSamples = min(int(round(baselineSeconds / delta)), self.__size)
+        n = len(self.staNames)
+        components = len(pgaEngine.COMPONENTS)
+        # NaN where no sample arrived
+        self.__ring = np.full((n, components, self.__size), np.nan, dtype=np.float32)
+        self.__ends = np.zeros((n, components), dtype=np.int64)
+        self.__seen = np.zeros((n, components), dtype=bool)
+        # index of the first sample of every component
+        self.__firsts = np.zeros((n, components), dtype=np.int64)
+        self.__baseline = np.zeros((n, components))
+        self.__baselined = np.zeros((n, components), dtype=bool)
+        self.__done = np.zeros(n, dtype=np.int64)
+        # max |a| of any component, max E2+N2+Z2, max E2+N2
+        self.__running = np.zeros((n, 3))
+        self.__frames = np.zeros((windowCount, n, len(pgaEngine.PGA_COLUMNS)))
+        self.__reached = np.zeros((windowCount, n), dtype=bool)
+        self.emitted = 0
+
+    @property
+    def finished(self):
+        return self.emitted == len(self.endtimes)
+
+    def feed(self, traces):
+        # traces: an obspy Stream or a list of traces, in any order
+        pieces = []
+        for tr in traces:
+            row = self.__rows.get(tr.stats.station)
+            component = tr.stats.channel[-1:]
+            if row is None or component not in pgaEngine.COMPONENTS:
+                continue
+            if abs(tr.stats.delta - self.delta) > 1e-9:
+                raise ValueError(f'{tr.id} is not sampled every {self.delta} s.')
+            first = int(round((tr.stats.starttime - self.windowStart) / self.delta))
+            # pieces no longer than the buffer, written in time order, so a long
+            # trace never overwrites its own samples before they are folded in
+            for offset in range(0, len(tr.data), self.__size):
+                pieces.append((first + offset, row, pgaEngine.COMPONENTS.index(component),
+                               tr.data[offset:offset + self.__size]))
+        pieces.sort(key=lambda piece: piece[0])
+        for first, row, component, samples in pieces:
+            self.__write(row, component, first, samples)
+        for row in {piece[1] for piece in pieces}:
+            if not self.__seen[row].any():
+                continue
+            # a component that has not arrived (ends at 0) or is more than a
+            # buffer behind holds the station back at most a buffer, then is
+            # taken as zero
+            self.__advance(row, max(self.__ends[row].min(), self.__ends[row].max() - self.__size))
+
+    def __write(self, row, component, first, samples):
+        # nothing before windowStart, after the last boundary or already folded in
+        skip = max(self.__done[row], 0) - first
+        if skip > 0:
+            samples, first = samples[skip:], first + skip
+        samples = samples[:max(self.boundaries[-1] + 1 - first, 0)]
+        if not len(samples):
+            return
+        # samples that would overwrite unprocessed ones push the station forward first
+        overflow = first + len(samples) - self.__size - self.__done[row]
+        if overflow > 0:
+            self.__advance(row, self.__done[row] + overflow, force=True)
+        self.__ring[row, component, np.arange(first, first + len(samples)) % self.__size] = samples
+        if not self.__seen[row, component]:
+            self.__firsts[row, component] = first
+        self.__ends[row, component] = max(self.__ends[row, component], first + len(samples))
+        self.__seen[row, component] = True
+
+    def __advance(self, row, upto, force=False):
+        start = self.__done[row]
+        if upto <= start:
+            return
+        # every component's baseline is the mean of its own first samples,
+        # so one that arrives late is not left with its offset
+        pending = np.flatnonzero(self.__seen[row] & ~self.__baselined[row])
+        counts = np.minimum(self.__ends[row] - self.__firsts[row], self.__baselineSamples)
+        if not force and (counts[pending] < self.__baselineSamples).any():
+            return
+        for component in pending:
+            first = self.__firsts[row, component]
+            slots = np.arange(first, first + counts[component]) % self.__size
+            self.__baseline[row, component] = np.nanmean(self.__ring[row, component, slots])
+            self.__baselined[row, component] = True
+        slots = np.arange(start, upto) % self.__size
+        segment = self.__ring[row][:, slots].astype(np.float64) - self.__baseline[row][:, np.newaxis]
+        # samples that never arrived (a component missing, before its first
+        # sample or in a gap) are taken as zero
+        segment[np.isnan(segment)] = 0
+        self.__ring[row][:, slots] = np.nan
+        squared = segment ** 2
+        series = np.vstack([np.abs(segment).max(axis=0), squared.sum(axis=0), squared[:2].sum(axis=0)])
+        series = np.maximum(np.maximum.accumulate(series, axis=1), self.__running[row][:, np.newaxis])
+        self.__running[row] = series[:, -1]
+        for i in np.flatnonzero((self.boundaries >= start) & (self.boundaries < upto)):
+            self.__frames[i, row] = self.__pgas(series[:, self.boundaries[i] - start])
+            self.__reached[i, row] = True
+        self.__done[row] = upto
+
+    @staticmethod
+    def __pgas(running):
+        # running maxima (..., 3) to the PGA_COLUMNS (..., 4)
+        return np.stack([running[..., 0], pgaEngine.pgaToIntensity(running[..., 0]),
+                         np.sqrt(running[..., 1]), np.sqrt(running[..., 2])], axis=-1)
+
+    def ready(self, now=None, latency=None):
+        # frames that every active station has reached, or that are latency
+        # seconds old at now; a station still behind gets its maxima so far
+        active = self.__seen.any(axis=1)
+        frames = []
+        while not self.finished:
+            i = self.emitted
+            late = latency is not None and (now or UTCDateTime()) >= self.endtimes[i] + latency
+            if not (late or (active.any() and self.__reached[i][active].all())):
+                break
+            frames.append(self.__emit(i))
+        return frames
+
+    def flush(self):
+        # the stream ended: fold in what is left and emit the remaining frames
+        for row in np.flatnonzero(self.__seen.any(axis=1)):
+            self.__advance(row, self.__ends[row].max(), force=True)
+        frames = []
+        while not self.finished:
+            frames.append(self.__emit(self.emitted))
+        return frames
+
+    def __emit(self, i):
+        behind = ~self.__reached[i]
+        self.__frames[i, behind] = self.__pgas(self.__running[behind])
+        self.emitted += 1
+        return i + 1, self.endtimes[i], self.__frames[i].copy()
+
+
+def watchDirectory(path, pattern='*', interval=0.5, remove=False):
+    """
+    function watchDirectory( path, pattern='*', interval=0.5, remove=False )
+
+    Module     : glob
+                 obspy
+
+    Description: to read waveform packets as they appear in a folder. A packet
+                 is any file obspy can read; writers should write to another
+                 name and rename it into the folder. Files that cannot be read
+                 yet are tried again at the next poll.
+
+    Parameters : path, str
+                 pattern, str (glob of the packet files)
+                 interval, float (seconds between two polls)
+                 remove, bool (delete the packets once read)
+
+    Return     : a generator of lists of traces, empty when nothing arrived
+
+    Examples of sage:
+        >> for traces in watchDirectory('/home/palert/data/packets', '*.mseed'):
+        >>     engine.feed(traces)
+    """
+    seen = set()
+    while True:
+        names = sorted(set(glob.glob(os.path.join(path, pattern))) - seen)
+        traces = []
+        for name in names:
+            try:
+                traces += read(name)
+            except Exception as error:
+                print(f'{name} is not readable yet: {error!r}')
+                continue
+            if remove:
+                os.remove(name)
+            else:
+                seen.add(name)
+        yield traces
+        if not names:
+            time.sleep(interval)
+
+
+def socketPackets(host='127.0.0.1', port=PACKET_PORT, interval=0.5):
+    """
+    function socketPackets( host='127.0.0.1', port=PACKET_PORT, interval=0.5 )
+
+    Module     : select
+                 socket
+
+    Description: to receive waveform packets on a local socket, a stand-in for
+                 the real-time feed. Every packet is a 4 byte big-endian length
+                 followed by that many bytes of miniSEED (see sendPacket).
+
+    Parameters : host, str
+                 port, int
+                 interval, float (longest wait in seconds before an empty list)
+
+    Return     : a generator of lists of traces, empty when nothing arrived
+
+    Examples of sage:
+        >> for traces in socketPackets(port=18000):
+        >>     engine.feed(traces)
+    """
+    with socket.create_server((host, port)) as server:
+        clients = {}
+        try:
+            while True:
+                readable, _, _ = select.select([server, *clients], [], [], interval)
+                traces = []
+                for sock in readable:
+                    if sock is server:
+                        client, address = server.accept()
+                        clients[client] = b''
+                        continue
+                    chunk = sock.recv(65536)
+                    if not chunk:
+                        sock.close()
+                        del clients[sock]
+                        continue
+                    buffer = clients[sock] + chunk
+                    while len(buffer) >= 4 and len(buffer) >= 4 + int.from_bytes(buffer[:4], 'big'):
+                        size = int.from_bytes(buffer[:4], 'big')
+                        traces += read(io.BytesIO(buffer[4:4 + size]), format='MSEED')
+                        buffer = buffer[4 + size:]
+                    clients[sock] = buffer
+                yield traces
+        finally:
+            for sock in clients:
+                sock.close()
+
+
+def sendPacket(sock, traces):
+    """
+    function sendPacket( sock, traces )
+
+    Description: to send traces to socketPackets as one miniSEED packet.
+
+    Parameters : sock, socket.socket (connected)
+                 traces, obspy.Stream
+
+    Examples of sage:
+        >> sock = socket.create_connection(('127.0.0.1', 18000))
+        >> sendPacket(sock, st.slice(t, t + 1))
+    """
+    buffer = io.BytesIO()
+    traces.write(buffer, format='MSEED')
+    payload = buffer.getvalue()
+    sock.sendall(len(payload).to_bytes(4, 'big') + payload)
+
+
+def replayStream(st, packetSeconds=1.0):
+    """
+    function replayStream( st, packetSeconds=1.0 )
+
+    Description: to cut a recorded stream into packets of packetSeconds, in
+                 time order, to replay an event through RealtimePGA.
+
+    Parameters : st, obspy.Stream
+                 packetSeconds, float
+
+    Return     : a generator of lists of traces
+
+    Examples of sage:
+        >> run(replayStream(read('*TW*')), staNames, latitude, longitude, 'accum')
+    """
+    starttime = min(tr.stats.starttime for tr in st)
+    endtime = max(tr.stats.endtime for tr in st)
+    while starttime <= endtime:
+        # slice keeps both ends, so the packets overlap by one sample at most
+        yield list(st.slice(starttime, starttime + packetSeconds - st[0].stats.delta / 2))
+        starttime += packetSeconds
+
+
+def run(packets, staNames, latitude, longitude, outputDir, windowStart=None, windowLength=3, windowCount=40, latency=None, grid=None):
+    """
+    function run( packets, staNames, latitude, longitude, outputDir, windowStart=None,
+                  windowLength=3, windowCount=40, latency=None, grid=None )
+
+    Description: to write outputDir/PGAs_NN while the packets arrive, until all
+                 windowCount frames are written or the packets end.
+
+    Parameters : packets, iterable of lists of traces (watchDirectory, socketPackets, replayStream)
+                 staNames, latitude, longitude, list (the stations, e.g. from StationCatalog)
+                 outputDir, str
+                 windowStart, UTCDateTime (default the start of the first packet)
+                 windowLength, float (seconds between two frames)
+                 windowCount, int
+                 latency, float or None (seconds to wait for late stations; None
+                          waits for every active station, for replays)
+                 grid, intensityGrid.IdwGrid or None (also write the grids of every frame)
+
+    Return     : the written PGAs_NN file names
+
+    Examples of sage:
+        >> catalog = stationCatalog.getCatalog('/home/palert/data/stalist.txt')
+        >> run(watchDirectory('packets'), catalog.names, catalog.latitude, catalog.longitude, 'accum', latency=2)
+    """
+    os.makedirs(outputDir, exist_ok=True)
+    engine = None
+    files = []
+
+    def write(frames):
+        for i, endtime, pgas in frames:
+            files.append(f'{outputDir}/PGAs_{i:02}')
+            pgaEngine.writeAccumFrame(files[-1], endtime, staNames, latitude, longitude, pgas)
+            if grid is not None:
+                intensityGrid.writeProducts(files[-1], grid, np.where(pgas[:, 0] > 0, pgas[:, 1], np.nan))
+            print(f'{files[-1]} ({endtime})')
+
+    try:
+        for traces in packets:
+            if engine is None and traces:
+                start = windowStart or min(tr.stats.starttime for tr in traces)
+                engine = RealtimePGA(staNames, start, traces[0].stats.delta, windowLength, windowCount)
+            if engine is None:
+                continue
+            engine.feed(traces)
+            write(engine.ready(latency=latency))
+            if engine.finished:
+                break
+        else:
+            if engine is not None:
+                write(engine.flush())
+    finally:
+        if hasattr(packets, 'close'):
+            packets.close()
+    return files
+
+
+def main():
+    parser = argparse.ArgumentParser(description='accumulated PGAs from waveform packets as they arrive')
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--watch', help='folder where the packet files appear')
+    source.add_argument('--port', type=int, help='local port of the packet socket')
+    parser.add_argument('--pattern', default='*', help='glob of the packet files')
+    parser.add_argument('--output', default='accum', help='folder of the PGAs_NN files')
+    parser.add_argument('--start', help='window start (UTC), default the first packet')
+    parser.add_argument('--window-length', type=float, default=3)
+    parser.add_argument('--window-count', type=int, default=40)
+    parser.add_argument('--latency', type=float, default=2, help='seconds to wait for late stations')
+    parser.add_argument('--stalist', default=STATION_LIST)
+    parser.add_argument('--native-grid', action='store_true', help='also write the grid and contours of every frame')
+    args = parser.parse_args()
+
+    catalog = stationCatalog.getCatalog(args.stalist)
+    packets = watchDirectory(args.watch, args.pattern) if args.watch else socketPackets(port=args.port)
+    grid = intensityGrid.getGrid(catalog.latitude, catalog.longitude) if args.native_grid else None
+    run(packets, catalog.names, catalog.latitude, catalog.longitude, args.output,
+        UTCDateTime(args.start) if args.start else None, args.window_length, args.window_count, args.latency, grid)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,342 @@
+# to keep every CWB earthquake report in a columnar archive for historical queries
+#
+# Two Parquet tables, partitioned by the month of the origin time (hive style):
+#   {root}/events/month=2021-09/part-*.parquet    one row per report
+#   {root}/stations/month=2021-09/part-*.parquet  one row per station of a report
+# Origin times are int64 nanoseconds since 1970 (UTC). The archive is append
+# only: every append writes new part files (renamed into place, so readers
+# never see them half-written). A report archived again (e.g. a revised one)
+# is a new revision; queries and compact keep the latest revision of an event.
+#
+# usage: python reportArchive.py add xmlfiles/*.xml
+#        python reportArchive.py stations --start 2021-01-01 --end 2021-12-31T23:59:59 --min-pga 80
+#        python reportArchive.py events --min-magnitude 5 --region 120 122 22 24
+#        python reportArchive.py compact
+
+import argparse
+import glob
+import library
+import os
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+import time
+from obspy import UTCDateTime
+
+DEFAULT_PATH = os.environ.get('PALERT_REPORT_ARCHIVE', '/home/palert/data/reports')
+
+EVENT_SCHEMA = pa.schema([('eqNo', pa.int64()),
+                          ('originTime', pa.int64()),
+                          ('longitude', pa.float64()),
+                          ('latitude', pa.float64()),
+                          ('depth', pa.float64()),
+                          ('magnitude', pa.float64()),
+                          ('archivedAt', pa.int64())])
+STATION_SCHEMA = pa.schema([('eqNo', pa.int64()),
+                            ('originTime', pa.int64()),
+                            ('stationCode', pa.string()),
+                            ('stationLon', pa.float64()),
+                            ('stationLat', pa.float64()),
+                            ('stationDist', pa.float64()),
+                            ('stationAz', pa.float64()),
+                            ('stationIntensity', pa.float32()),
+                            ('stationPGAz', pa.float64()),
+                            ('stationPGAns', pa.float64()),
+                            ('stationPGAew', pa.float64()),
+                            ('stationPGAmax', pa.float64()),
+                            ('archivedAt', pa.int64())])
+SCHEMAS = {'events': EVENT_SCHEMA, 'stations': STATION_SCHEMA}
+PARTITIONING = ds.partitioning(pa.schema([('month', pa.string())]), flavor='hive')
+# part files of a month the poller lets pile up before it compacts the month
+COMPACT_PARTS = 16
+
+
+def monthOf(t):
+    # the partition of an origin time, UTCDateTime
+    return t.strftime('%Y-%m')
+
+
+class ReportArchive():
+    """
+    class ReportArchive
+
+    Module     : pyarrow
+
+    Description: the CWB earthquake reports (library.CwbEvent) in Parquet
+                 tables partitioned by month, appended as reports arrive and
+                 queried by time, magnitude, region and station without the xml.
+
+    Examples of sage:
+        >> archive = ReportArchive('/home/palert/data/reports')
+        >> archive.append([library.parseCwbXml(xmlfile) for xmlfile in xmlfiles])
+        >> df = archive.stations(UTCDateTime(2021, 1, 1), UTCDateTime(2022, 1, 1), minPGA=80)
+    """
+    def __init__(self, root=DEFAULT_PATH):
+        self.root = root
+
+    def append(self, events):
+        """
+        function append( events )
+
+        Description: to archive reports, one part file per month and table for
+                     the whole list, so append many reports at once if you can.
+
+        Parameters : events, list of library.CwbEvent
+
+        Return     : the written files, list of str
+
+        Examples of sage:
+            >> archive.append([library.parseCwbXml('CWB-EQ110091-2021-0901-062756.xml')])
+        """
+        archivedAt = time.time_ns()
+        months = {}
+        for event in events:
+            originTime = event.originTimeUTC.ns
+            eventRows, stationRows = months.setdefault(monthOf(event.originTimeUTC), ([], []))
+            eventRows.append({'eqNo': event.eqNo, 'originTime': originTime, 'longitude': event.longitude,
+                              'latitude': event.latitude, 'depth': event.depth, 'magnitude': event.magnitude,
+                              'archivedAt': archivedAt})
+            stations = event.to_dataframe()
+            stations.insert(0, 'originTime', originTime)
+            stations.insert(0, 'eqNo', event.eqNo)
+            stations['archivedAt'] = archivedAt
+            stationRows.append(stations)
+
+        files = []
+        for month, (eventRows, stationRows) in sorted(months.items()):
+            files.append(self.__write('events', month, pd.DataFrame(eventRows), f'{archivedAt}-{os.getpid()}'))
+            files.append(self.__write('stations', month, pd.concat(stationRows, ignore_index=True), f'{archivedAt}-{os.getpid()}'))
+        return files
+
+    def __write(self, table, month, df, name):
+        directory = f'{self.root}/{table}/month={month}'
+        os.makedirs(directory, exist_ok=True)
+        filename = f'{directory}/part-{name}.parquet'
+        # the dataset ignores names starting with a dot, e.g. this one while it is written
+        tmpName = f'{directory}/.part-{name}.parquet.tmp'
+        pq.write_table(pa.Table.from_pandas(df, schema=SCHEMAS[table], preserve_index=False), tmpName, compression='zstd')
+        os.replace(tmpName, filename)
+        return filename
+
+    def __read(self, table, filter=None, columns=None):
+        directory = f'{self.root}/{table}'
+        columns = columns or SCHEMAS[table].names
+        if not os.path.isdir(directory):
+            return SCHEMAS[table].empty_table().select(columns).to_pandas()
+        dataset = ds.dataset(directory, schema=SCHEMAS[table].append(pa.field('month', pa.string())),
+                             format='parquet', partitioning=PARTITIONING)
+        return dataset.to_table(columns=columns, filter=filter).to_pandas()
+
+    @staticmethod
+    def __timeFilter(starttime, endtime):
+        # the month partitions are pruned before any row is read
+        conditions = []
+        if starttime is not None:
+            conditions += [ds.field('month') >= monthOf(starttime), ds.field('originTime') >= starttime.ns]
+        if endtime is not None:
+            conditions += [ds.field('month') <= monthOf(endtime), ds.field('originTime') <= endtime.ns]
+        return conditions
+
+    @staticmethod
+    def __combine(conditions):
+        filter = None
+        for condition in conditions:
+            filter = condition if filter is None else filter & condition
+        return filter
+
+    def events(self, starttime=None, endtime=None, minMagnitude=None, maxMagnitude=None, region=None):
+        """
+        function events( starttime=None, endtime=None, minMagnitude=None, maxMagnitude=None, region=None )
+
+        Description: to get the latest revision of the archived reports; both
+                     ends of every range are inclusive.
+
+        Parameters : starttime, endtime, UTCDateTime (origin time)
+                     minMagnitude, maxMagnitude, float
+                     region, (lonMin, lonMax, latMin, latMax) of the epicenter
+
+        Return     : a pd.DataFrame of EVENT_SCHEMA, sorted by origin time
+
+        Examples of sage:
+            >> df = archive.events(UTCDateTime(2021, 1, 1), minMagnitude=5.0)
+            >> df['originTime'] = pd.to_datetime(df['originTime'], utc=True)
+        """
+        conditions = self.__timeFilter(starttime, endtime)
+        if minMagnitude is not None:
+            conditions.append(ds.field('magnitude') >= minMagnitude)
+        if maxMagnitude is not None:
+            conditions.append(ds.field('magnitude') <= maxMagnitude)
+        conditions += regionFilter('longitude', 'latitude', region)
+        df = self.__read('events', self.__combine(conditions))
+        if df.empty:
+            return df
+        # an older revision may match where the latest does not (e.g. a revised
+        # magnitude), so the rows are checked against the latest of every event,
+        # read from the matched events in their months and the next ones (a
+        # revised origin time may cross a month)
+        months = pd.to_datetime(df['originTime'], utc=True).dt.tz_localize(None).dt.to_period('M').unique()
+        months = sorted({str(month + shift) for month in months for shift in (-1, 0, 1)})
+        matched = ds.field('month').isin(months) & ds.field('eqNo').isin(df['eqNo'].unique().tolist())
+        latest = self.__read('events', matched, ['eqNo', 'archivedAt']).groupby('eqNo', as_index=False)['archivedAt'].max()
+        df = df.merge(latest, on=['eqNo', 'archivedAt']).drop_duplicates('eqNo')
+        return df.sort_values(['originTime', 'eqNo']).reset_index(drop=True)
+
+    def stations(self, starttime=None, endtime=None, minMagnitude=None, maxMagnitude=None, region=None,
+                 epicenterRegion=None, stationCodes=None, minPGA=None, minIntensity=None):
+        """
+        function stations( starttime=None, endtime=None, minMagnitude=None, maxMagnitude=None, region=None,
+                           epicenterRegion=None, stationCodes=None, minPGA=None, minIntensity=None )
+
+        Description: to get the station observations of the latest revision of
+                     the archived reports. The event conditions (time, magnitude,
+                     epicenter) are applied to the events table first.
+
+        Parameters : starttime, endtime, UTCDateTime (origin time)
+                     minMagnitude, maxMagnitude, float
+                     region, (lonMin, lonMax, latMin, latMax) of the stations
+                     epicenterRegion, (lonMin, lonMax, latMin, latMax) of the epicenter
+                     stationCodes, list of str
+                     minPGA, float (gal, of stationPGAmax)
+                     minIntensity, float
+
+        Return     : a pd.DataFrame of STATION_SCHEMA, sorted by origin time and station
+
+        Examples of sage:
+            >> df = archive.stations(UTCDateTime(2021, 1, 1), UTCDateTime(2021, 12, 31, 23, 59, 59), minPGA=80)
+            >> df = archive.stations(stationCodes=['TAP', 'HWA'], minMagnitude=6)
+        """
+        events = self.events(starttime, endtime, minMagnitude, maxMagnitude, epicenterRegion)
+        conditions = self.__timeFilter(starttime, endtime)
+        conditions.append(ds.field('eqNo').isin(events['eqNo'].tolist()))
+        conditions += regionFilter('stationLon', 'stationLat', region)
+        if stationCodes is not None:
+            conditions.append(ds.field('stationCode').isin(list(stationCodes)))
+        if minPGA is not None:
+            conditions.append(ds.field('stationPGAmax') >= minPGA)
+        if minIntensity is not None:
+            conditions.append(ds.field('stationIntensity') >= minIntensity)
+        df = self.__read('stations', self.__combine(conditions))
+        # rows of older revisions, or copies left by an interrupted compact, are dropped
+        df = df.merge(events[['eqNo', 'archivedAt']], on=['eqNo', 'archivedAt'])
+        df = df.drop_duplicates(['eqNo', 'stationCode'])
+        return df.sort_values(['originTime', 'eqNo', 'stationCode']).reset_index(drop=True)
+
+    def compact(self, months=None, minParts=2):
+        """
+        function compact( months=None, minParts=2 )
+
+        Description: to merge the part files of every month into one, keeping
+                     only the latest revision of each event. The merged file is
+                     in place before the parts are removed, so readers see every
+                     row at any time (queries drop the copies).
+
+        Parameters : months, list of str (e.g. ['2021-09'], default every month)
+                     minParts, int (months with fewer part files are left as they are)
+
+        Return     : the months compacted, list of str
+
+        Examples of sage:
+            >> archive.compact()
+            >> archive.compact(['2021-09'], minParts=COMPACT_PARTS)
+        """
+        compacted = []
+        if months is None:
+            months = [directory.rsplit('=', 1)[-1] for directory in glob.glob(f'{self.root}/events/month=*')]
+        for month in sorted(set(months)):
+            parts = {table: sorted(glob.glob(f'{self.root}/{table}/month={month}/part-*.parquet')) for table in SCHEMAS}
+            if len(parts['events']) < minParts and len(parts['stations']) < minParts:
+                continue
+            events = pd.concat([pq.read_table(part, schema=EVENT_SCHEMA).to_pandas() for part in parts['events']],
+                               ignore_index=True)
+            events = events.sort_values(['eqNo', 'archivedAt']).drop_duplicates('eqNo', keep='last')
+            stations = pd.concat([pq.read_table(part, schema=STATION_SCHEMA).to_pandas() for part in parts['stations']],
+                                 ignore_index=True)
+            stations = stations.merge(events[['eqNo', 'archivedAt']], on=['eqNo', 'archivedAt'])
+            stations = stations.drop_duplicates(['eqNo', 'stationCode'])
+            name = f'compact-{time.time_ns()}-{os.getpid()}'
+            for table, df in [('events', events), ('stations', stations)]:
+                self.__write(table, month, df.sort_values(['originTime', 'eqNo']), name)
+                for part in parts[table]:
+                    os.remove(part)
+            compacted.append(month)
+        return compacted
+
+
+def regionFilter(lonColumn, latColumn, region):
+    # (lonMin, lonMax, latMin, latMax), the order of intensityGrid.REGION
+    if region is None:
+        return []
+    lonMin, lonMax, latMin, latMax = region
+    return [ds.field(lonColumn) >= lonMin, ds.field(lonColumn) <= lonMax,
+            ds.field(latColumn) >= latMin, ds.field(latColumn) <= latMax]
+
+
+def archiveXmlFiles(xmlfiles, archive=None, batchSize=500):
+    """
+    function archiveXmlFiles( xmlfiles, archive=None, batchSize=500 )
+
+    Module     : library
+
+    Description: to archive many xml reports (e.g. a backfill of the history),
+                 batchSize reports per append.
+
+    Parameters : xmlfiles, list of str
+                 archive, ReportArchive (default the one at DEFAULT_PATH)
+                 batchSize, int
+
+    Return     : the number of archived reports, int
+
+    Examples of sage:
+        >> archiveXmlFiles(sorted(glob.glob('xmlfiles/*.xml')))
+    """
+    archive = archive or ReportArchive()
+    for start in range(0, len(xmlfiles), batchSize):
+        archive.append([library.parseCwbXml(xmlfile) for xmlfile in xmlfiles[start:start + batchSize]])
+    return len(xmlfiles)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='archive CWB earthquake reports and query them')
+    parser.add_argument('--root', default=DEFAULT_PATH, help='directory of the archive')
+    commands = parser.add_subparsers(dest='command', required=True)
+    add = commands.add_parser('add', help='archive xml reports')
+    add.add_argument('xmlfiles', nargs='+')
+    commands.add_parser('compact', help='merge the part files of every month')
+    for command in ['events', 'stations']:
+        query = commands.add_parser(command, help=f'query the {command}')
+        query.add_argument('--start', type=UTCDateTime, help='earliest origin time, e.g. 2021-01-01')
+        query.add_argument('--end', type=UTCDateTime, help='latest origin time')
+        query.add_argument('--min-magnitude', type=float)
+        query.add_argument('--max-magnitude', type=float)
+        query.add_argument('--region', type=float, nargs=4, metavar=('LONMIN', 'LONMAX', 'LATMIN', 'LATMAX'),
+                           help='of the epicenter (events) or of the stations (stations)')
+        query.add_argument('--output', help='write a csv file instead of printing')
+    query.add_argument('--epicenter-region', type=float, nargs=4, metavar=('LONMIN', 'LONMAX', 'LATMIN', 'LATMAX'))
+    query.add_argument('--station', nargs='+', help='station codes')
+    query.add_argument('--min-pga', type=float, help='gal, of the largest component')
+    query.add_argument('--min-intensity', type=float)
+    args = parser.parse_args(argv)
+
+    archive = ReportArchive(args.root)
+    if args.command == 'add':
+        print(archiveXmlFiles(args.xmlfiles, archive), 'reports archived')
+        return
+    if args.command == 'compact':
+        print('compacted:', *archive.compact())
+        return
+    if args.command == 'events':
+        df = archive.events(args.start, args.end, args.min_magnitude, args.max_magnitude, args.region)
+    else:
+        df = archive.stations(args.start, args.end, args.min_magnitude, args.max_magnitude, args.region,
+                              args.epicenter_region, args.station, args.min_pga, args.min_intensity)
+    df['originTime'] = pd.to_datetime(df['originTime'], utc=True)
+    if args.output:
+        df.to_csv(args.output, index=False)
+    else:
+        with pd.option_context('display.max_rows', 100, 'display.width', 200):
+            print(df)
+
+
+if __name__ == "__main__":
+    main()
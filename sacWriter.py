@@ -0,0 +1,112 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+from obspy.io.sac import SACTrace
+
+
+def traceFilename(tr, outputDir='.'):
+    """
+    function traceFilename( tr, outputDir='.' )
+
+    Description: to get the sac file name of a trace, sta.cha.net.loc.
+
+    Parameters : tr, obspy.Trace
+                 outputDir, str
+
+    Return     : filename, str
+
+    Examples of sage:
+        >> print(traceFilename(tr, 'SAC/202201'))
+        SAC/202201/A001.HLE.TW.--
+    """
+    return f'{outputDir}/{tr.stats.station}.{tr.stats.channel}.{tr.stats.network}.{tr.stats.location}'
+
+
+def _writeChunk(chunk):
+    for filename, tr, headers in chunk:
+        if headers is None:
+            tr.write(filename, format="SAC")
+            continue
+        sac = SACTrace.from_obspy_trace(tr)
+        for header, value in headers.items():
+            setattr(sac, header, value)
+        sac.write(filename)
+    return [filename for filename, tr, headers in chunk]
+
+
+def _patchChunk(chunk):
+    for filename, headers in chunk:
+        sac = SACTrace.read(filename)
+        for header, value in headers.items():
+            setattr(sac, header, value)
+        sac.write(filename)
+    return [filename for filename, headers in chunk]
+
+
+def _dispatch(function, items, workers, chunkSize):
+    # items are sorted by file name and every file belongs to exactly one chunk,
+    # so the output does not depend on the number of workers. Threads, not
+    # processes: a process pool pickles every trace to its worker, which costs
+    # as much as the write, while the sac writes release the GIL
+    items = sorted(items, key=lambda item: item[0])
+    chunks = [items[i:i + chunkSize] for i in range(0, len(items), chunkSize)]
+    workers = os.cpu_count() if workers is None else workers
+    if workers <= 1 or len(chunks) <= 1:
+        return [filename for chunk in chunks for filename in function(chunk)]
+    with ThreadPoolExecutor(min(workers, len(chunks))) as pool:
+        return [filename for done in pool.map(function, chunks) for filename in done]
+
+
+def writeTraces(st, outputDir='.', headers=None, stationHeaders=None, workers=None, chunkSize=32):
+    """
+    function writeTraces( st, outputDir='.', headers=None, stationHeaders=None, workers=None, chunkSize=32 )
+
+    Module     : concurrent.futures
+                 SACTrace (obspy.io.sac)
+
+    Description: to write every trace of a stream as a sac file, in chunks of
+                 chunkSize traces spread over a pool of worker threads.
+
+    Parameters : st, obspy.Stream
+                 outputDir, str
+                 headers, dict (sac headers set in every file, e.g. {'evla': 23.5})
+                 stationHeaders, dict of station -> dict (sac headers of one station)
+                 workers, int (default os.cpu_count(), 1 writes in this process)
+                 chunkSize, int (traces sent to a worker at once)
+
+    Return     : the written file names, sorted
+
+    Examples of sage:
+        >> writeTraces(st, 'SAC/202201/20220107_211139_MAN', {'mag': 5.9}, workers=8)
+    """
+    items = []
+    for tr in st:
+        traceHeaders = None
+        if headers is not None or stationHeaders is not None:
+            traceHeaders = {**(headers or {}), **(stationHeaders or {}).get(tr.stats.station, {})}
+        items.append((traceFilename(tr, outputDir), tr, traceHeaders))
+    return _dispatch(_writeChunk, items, workers, chunkSize)
+
+
+def patchHeaders(files, headers=None, fileHeaders=None, workers=None, chunkSize=32):
+    """
+    function patchHeaders( files, headers=None, fileHeaders=None, workers=None, chunkSize=32 )
+
+    Module     : concurrent.futures
+                 SACTrace (obspy.io.sac)
+
+    Description: to read, change and rewrite the headers of many sac files over
+                 a pool of worker threads.
+
+    Parameters : files, list of str
+                 headers, dict (sac headers set in every file)
+                 fileHeaders, dict of file -> dict (sac headers of one file)
+                 workers, int (default os.cpu_count(), 1 patches in this process)
+                 chunkSize, int (files sent to a worker at once)
+
+    Return     : the patched file names, sorted
+
+    Examples of sage:
+        >> patchHeaders(glob.glob('*TW*'), {'evla': 23.5, 'evlo': 121.4}, workers=8)
+    """
+    items = [(file, {**(headers or {}), **(fileHeaders or {}).get(file, {})}) for file in files]
+    return _dispatch(_patchChunk, items, workers, chunkSize)
@@ -0,0 +1,171 @@
+import numpy as np
+import os
+import pandas as pd
+import threading
+from scipy.spatial import cKDTree
+
+
+EARTH_RADIUS = 6371.0
+
+_catalogs = {}
+_catalogsLock = threading.Lock()
+
+
+def _unitVectors(latitude, longitude):
+    lat = np.radians(np.asarray(latitude, dtype=np.float64))
+    lon = np.radians(np.asarray(longitude, dtype=np.float64))
+    return np.column_stack([np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)])
+
+
+def distanceAzimuth(latitude, longitude, staLatitude, staLongitude):
+    """
+    function distanceAzimuth( latitude, longitude, staLatitude, staLongitude )
+
+    Module     : np (numpy)
+
+    Description: to get the great circle distance and the azimuth from a point
+                 (e.g. the epicenter) to many stations at once.
+
+    Parameters : latitude, longitude, float (degree)
+                 staLatitude, staLongitude, array-like (degree)
+
+    Return     : distance, np.ndarray (km)
+                 azimuth, np.ndarray (degree clockwise from north, 0-360)
+
+    Examples of sage:
+        >> distance, azimuth = distanceAzimuth(23.16, 121.39, df['staLatitude'], df['staLongitude'])
+    """
+    lat1, lon1 = np.radians(latitude), np.radians(longitude)
+    lat2 = np.radians(np.asarray(staLatitude, dtype=np.float64))
+    dlon = np.radians(np.asarray(staLongitude, dtype=np.float64)) - lon1
+    haversine = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin(dlon / 2) ** 2
+    distance = 2 * EARTH_RADIUS * np.arcsin(np.sqrt(np.clip(haversine, 0, 1)))
+    azimuth = np.degrees(np.arctan2(np.sin(dlon) * np.cos(lat2),
+                                    np.cos(lat1) * np.sin(lat2) - np.sin(lat1) * np.cos(lat2) * np.cos(dlon)))
+    return distance, azimuth % 360
+
+
+class StationCatalog():
+    """
+    class StationCatalog
+
+    Module     : np (numpy)
+                 scipy.spatial (cKDTree)
+
+    Description: the P-alert stations of stalist.txt as coordinate arrays with a
+                 name index and a KD-tree of their positions on the unit sphere,
+                 for vectorized distances and nearest station joins.
+
+    Examples of sage:
+        >> catalog = getCatalog('/home/palert/data/stalist.txt')
+        >> distance, azimuth = catalog.distanceAzimuth(23.16, 121.39)
+        >> matches = catalog.matchCwb(library.parseCwbXml('CWB-EQ110095-2021-0915-185053.xml'))
+    """
+    def __init__(self, names, latitude, longitude):
+        self.names = np.asarray(names, dtype=object)
+        self.latitude = np.asarray(latitude, dtype=np.float64)
+        self.longitude = np.asarray(longitude, dtype=np.float64)
+        self.index = {name: i for i, name in enumerate(self.names)}
+        self.tree = cKDTree(_unitVectors(self.latitude, self.longitude))
+
+    @classmethod
+    def read(cls, path):
+        # stalist.txt: name latitude longitude, separated by one space
+        df = pd.read_csv(path, sep=" ", header=None, usecols=[0, 1, 2])
+        return cls(df[0].astype(str), df[1], df[2])
+
+    def __len__(self):
+        return len(self.names)
+
+    def to_dataframe(self):
+        return pd.DataFrame({'staName': self.names, 'staLatitude': self.latitude, 'staLongitude': self.longitude})
+
+    def rows(self, staNames):
+        # row of each name, -1 for names not in the catalog
+        return np.array([self.index.get(name, -1) for name in staNames], dtype=np.int64)
+
+    def distanceAzimuth(self, latitude, longitude):
+        return distanceAzimuth(latitude, longitude, self.latitude, self.longitude)
+
+    def nearest(self, latitude, longitude, maxDistance=np.inf):
+        # the closest station of every point within maxDistance km: row (-1 if
+        # none) and distance in km (inf if none)
+        points = _unitVectors(np.atleast_1d(latitude), np.atleast_1d(longitude))
+        chord = 2 * np.sin(min(maxDistance / EARTH_RADIUS, np.pi) / 2)
+        chordDistance, rows = self.tree.query(points, distance_upper_bound=chord + 1e-12)
+        found = np.isfinite(chordDistance)
+        distance = np.full(len(points), np.inf)
+        distance[found] = 2 * EARTH_RADIUS * np.arcsin(np.clip(chordDistance[found] / 2, 0, 1))
+        return np.where(found, rows, -1), distance
+
+    def matchCwb(self, event, maxDistance=5.0):
+        """
+        function matchCwb( event, maxDistance=5.0 )
+
+        Description: to join the eqStation rows of a CWB report to the nearest
+                     P-alert station within maxDistance km.
+
+        Parameters : event, library.CwbEvent
+                     maxDistance, float (km)
+
+        Return     : the station dataframe of the report with staName and
+                     staDistance (km) of the matched P-alert station, NaN if none
+
+        Examples of sage:
+            >> print(catalog.matchCwb(event)[['stationCode', 'staName', 'staDistance']])
+        """
+        df = event.to_dataframe()
+        rows, distance = self.nearest(df['stationLat'].to_numpy(), df['stationLon'].to_numpy(), maxDistance)
+        found = rows >= 0
+        df['staName'] = np.where(found, self.names[np.where(found, rows, 0)], None)
+        df['staDistance'] = np.where(found, distance, np.nan)
+        return df
+
+
+def getCatalog(path):
+    """
+    function getCatalog( path )
+
+    Description: to get the StationCatalog of a station list, read again only
+                 when the file has changed.
+
+    Parameters : path, str (stalist.txt)
+
+    Return     : StationCatalog
+
+    Examples of sage:
+        >> catalog = getCatalog('/home/palert/data/stalist.txt')
+    """
+    modified = os.stat(path).st_mtime_ns
+    with _catalogsLock:
+        cached = _catalogs.get(path)
+        if cached is None or cached[0] != modified:
+            cached = _catalogs[path] = (modified, StationCatalog.read(path))
+        return cached[1]
+
+
+def comparePGAs(event, df, catalog, maxDistance=5.0):
+    """
+    function comparePGAs( event, df, catalog, maxDistance=5.0 )
+
+    Description: to put the PGA of every CWB station of a report next to the
+                 PGA of the nearest P-alert station.
+
+    Parameters : event, library.CwbEvent
+                 df, pd.DataFrame (staName and the PGA columns, e.g. Earthquake.df)
+                 catalog, StationCatalog
+                 maxDistance, float (km)
+
+    Return     : the matched rows with stationPGAmax (CWB), PGAsMaxInENZ
+                 (P-alert) and their ratio
+
+    Examples of sage:
+        >> print(comparePGAs(event, eq.df, getCatalog('/home/palert/data/stalist.txt')))
+    """
+    matches = catalog.matchCwb(event, maxDistance)
+    matches = matches[matches['staName'].notna()]
+    pgas = df[['staName', 'PGAsMaxInENZ', 'intensity']].rename(columns={'intensity': 'staIntensity'})
+    matches = matches.merge(pgas, on='staName', how='inner')
+    with np.errstate(divide='ignore', invalid='ignore'):
+        matches['PGAratio'] = matches['PGAsMaxInENZ'] / matches['stationPGAmax']
+    return matches
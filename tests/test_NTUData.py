@@ -0,0 +1,77 @@
+# NTUData.Earthquake against the mock CWB and NTU ftp servers: the finished
+# stages recorded in the event store, and the folders left on disk
+#
+# usage: python -m pytest tests
+
+import glob
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'benchmarks'))
+import backfill
+import eventStore
+import mockServices
+import NTUData
+import ntuArchive
+from obspy import UTCDateTime, read
+
+
+@pytest.fixture
+def services(tmp_path, monkeypatch):
+    event = mockServices.SyntheticEvent(10, UTCDateTime(2022, 5, 1, 12), eqNo=510001, seconds=240)
+    mockServices.ensureArchive(event, str(tmp_path / 'ftp'))
+    ftp = mockServices.FtpServer(str(tmp_path / 'ftp'))
+    cwb = mockServices.CwbServer()
+    cwb.addEvent(event, 5)
+    monkeypatch.setattr(ntuArchive, '_defaultPool', ntuArchive.FtpPool('127.0.0.1', ftp.port, timeout=5))
+    monkeypatch.setattr(ntuArchive, '_defaultIndexes', {})
+    for folder in ['data', 'web']:
+        (tmp_path / folder).mkdir()
+    (tmp_path / 'data' / 'stalist.txt').write_text(event.stalist())
+    yield event, cwb.reportUrl(event), str(tmp_path / 'data'), str(tmp_path / 'web')
+    ntuArchive.getPool().close()
+    ftp.close()
+    cwb.close()
+
+
+def stations(folder):
+    return sorted({os.path.basename(file).split('.')[0] for file in glob.glob(f'{folder}/*TW*')})
+
+
+def test_stages_of_both_windows(services, tmp_path):
+    event, url, dataDir, webDir = services
+    store = eventStore.EventStore(str(tmp_path / 'events.db'))
+    earthquake = NTUData.Earthquake(url, store, dataDir, webDir)
+    earthquake.downloadData(streaming=True, inMemory=True)
+    backfill.processEvent(earthquake)
+    stages = store.finishedStages(510001)
+    assert 'processData[-120,480]' in stages
+    assert 'processData[-20,100]' in stages
+    assert 'processData' not in stages
+
+
+def test_on_disk_denied_stations(services):
+    # the raw files of denied stations are not left among the cut traces
+    event, url, dataDir, webDir = services
+    earthquake = NTUData.Earthquake(url, None, dataDir, webDir, denyStations=['S0001', 'S0002'])
+    earthquake.downloadData(streaming=True, inMemory=False)
+    expected = [sta for sta in event.stations if sta not in ['S0001', 'S0002']]
+    assert stations(f'{earthquake.dir}/{earthquake.folder2minAgo}') == expected
+    backfill.processEvent(earthquake)
+    for folder in [earthquake.folder2minAgo, earthquake.folder20secAgo]:
+        assert stations(f'{earthquake.dir}/{folder}') == expected
+
+
+def test_reprocess_downloaded_event(services):
+    # a later run finds the traces of a streamed download in folder2minAgo only
+    event, url, dataDir, webDir = services
+    NTUData.Earthquake(url, None, dataDir, webDir).downloadData(streaming=True, inMemory=False)
+    earthquake = NTUData.Earthquake(url, None, dataDir, webDir)
+    backfill.processEvent(earthquake)
+    for folder in [earthquake.folder2minAgo, earthquake.folder20secAgo]:
+        assert stations(f'{earthquake.dir}/{folder}') == event.stations
+    cut = read(f'{earthquake.dir}/{earthquake.folder20secAgo}/S0000.HLZ.TW.--')[0]
+    assert cut.stats.endtime - cut.stats.starttime == pytest.approx(120, abs=0.02)
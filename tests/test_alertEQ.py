@@ -0,0 +1,108 @@
+# alertEQ.poll against the CWB stand-in of benchmarks/mockServices.py
+#
+# usage: python -m pytest tests
+
+import glob
+import os
+import sqlite3
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'benchmarks'))
+import alertEQ
+import eventStore
+import mockServices
+import reportArchive
+from obspy import UTCDateTime
+
+
+@pytest.fixture
+def cwb():
+    server = mockServices.CwbServer()
+    yield server
+    server.close()
+
+
+@pytest.fixture
+def archive(tmp_path, monkeypatch):
+    # processNewEvents archives into the default ReportArchive
+    monkeypatch.chdir(tmp_path)
+    archive = reportArchive.ReportArchive(str(tmp_path / 'reports'))
+    monkeypatch.setattr(reportArchive, 'ReportArchive', lambda: archive)
+    return archive
+
+
+def test_revised_report(cwb, archive, tmp_path):
+    store = eventStore.EventStore(str(tmp_path / 'events.db'))
+    validators, seenMembers = {}, set()
+    event = mockServices.SyntheticEvent(10, UTCDateTime(2022, 3, 1, 12), eqNo=111001)
+    cwb.addEvent(event, 5)
+    cwb.addEvent(mockServices.SyntheticEvent(10, UTCDateTime(2022, 3, 2, 12), eqNo=111002), 5)
+
+    assert len(alertEQ.poll(None, cwb.feedUrl(), validators, seenMembers, store)) == 2
+    assert store.events(status='processed')['eqNo'].tolist() == [111001, 111002]
+    files = glob.glob(f'{archive.root}/events/*/*.parquet')
+    assert alertEQ.poll(None, cwb.feedUrl(), validators, seenMembers, store) == []
+
+    # the same report with a revised magnitude: archived again, not processed again
+    event.magnitude = round(event.magnitude + 0.5, 1)
+    cwb.addEvent(event, 5)
+    events = alertEQ.poll(None, cwb.feedUrl(), validators, seenMembers, store)
+    assert [e.eqNo for e in events] == [111001]
+    assert archive.events(minMagnitude=event.magnitude)['eqNo'].tolist() == [111001]
+    assert len(archive.events()) == 2
+
+    # a new poll process (cron) does not archive it again
+    assert alertEQ.poll(None, cwb.feedUrl(), {}, set(), store) == []
+    assert len(glob.glob(f'{archive.root}/events/*/*.parquet')) == len(files) + 1
+
+
+def test_compacted_by_the_poller(cwb, archive, tmp_path):
+    store = eventStore.EventStore(str(tmp_path / 'events.db'))
+    validators, seenMembers = {}, set()
+    for k in range(reportArchive.COMPACT_PARTS + 2):
+        cwb.addEvent(mockServices.SyntheticEvent(10, UTCDateTime(2022, 3, 1 + k), eqNo=111001 + k), 5)
+        alertEQ.poll(None, cwb.feedUrl(), validators, seenMembers, store)
+    assert len(glob.glob(f'{archive.root}/events/month=2022-03/*.parquet')) < reportArchive.COMPACT_PARTS
+    assert len(archive.events()) == reportArchive.COMPACT_PARTS + 2
+
+
+class LockedOnce(eventStore.EventStore):
+    # the first write finds the database locked, as while a backfill writes
+    def __init__(self, path):
+        super().__init__(path)
+        self.locked = True
+
+    def recordEvent(self, event, status='received'):
+        if self.locked:
+            self.locked = False
+            raise sqlite3.OperationalError('database is locked')
+        super().recordEvent(event, status)
+
+
+class Stop(BaseException):
+    pass
+
+
+def test_watch_survives_a_failed_poll(cwb, archive, tmp_path, monkeypatch):
+    store = LockedOnce(str(tmp_path / 'events.db'))
+    cwb.addEvent(mockServices.SyntheticEvent(10, UTCDateTime(2022, 3, 1, 12), eqNo=111001), 5)
+    monkeypatch.setattr(eventStore, 'EventStore', lambda: store)
+    monkeypatch.setattr(alertEQ, 'opendataUrl', lambda api: cwb.feedUrl())
+    polls = []
+    realPoll = alertEQ.poll
+
+    def poll(*args):
+        if len(polls) == 3:
+            raise Stop()
+        try:
+            return realPoll(*args)
+        finally:
+            polls.append(store.events(status='processed')['eqNo'].tolist())
+
+    monkeypatch.setattr(alertEQ, 'poll', poll)
+    with pytest.raises(Stop):
+        alertEQ.watch('key', 0)
+    assert polls == [[], [111001], [111001]]
@@ -0,0 +1,91 @@
+# backfill of several synthetic events against the mock CWB and NTU ftp servers
+#
+# usage: python -m pytest tests
+
+import functools
+import glob
+import json
+import os
+import sys
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'benchmarks'))
+import asyncFetch
+import backfill
+import metrics
+import mockServices
+import ntuArchive
+from obspy import UTCDateTime
+
+
+@pytest.fixture
+def services(tmp_path, monkeypatch):
+    events = [mockServices.SyntheticEvent(10, UTCDateTime(2022, 5, 1 + k, 12), eqNo=510001 + k, seconds=240)
+              for k in range(4)]
+    for event in events:
+        mockServices.ensureArchive(event, str(tmp_path / 'ftp'))
+    ftp = mockServices.FtpServer(str(tmp_path / 'ftp'))
+    cwb = mockServices.CwbServer()
+    for event in events:
+        cwb.addEvent(event, 5)
+    monkeypatch.setattr(ntuArchive, '_defaultPool', ntuArchive.FtpPool('127.0.0.1', ftp.port, timeout=5))
+    monkeypatch.setattr(ntuArchive, '_defaultIndexes', {})
+    monkeypatch.setattr(asyncFetch, 'Fetcher', functools.partial(
+        asyncFetch.Fetcher, pool=ntuArchive.FtpPool('127.0.0.1', ftp.port, size=4, timeout=5)))
+    for folder in ['data', 'web']:
+        (tmp_path / folder).mkdir()
+    (tmp_path / 'data' / 'stalist.txt').write_text(events[0].stalist())
+    yield [cwb.reportUrl(event) for event in events], str(tmp_path / 'data'), str(tmp_path / 'web'), ftp, cwb
+    ntuArchive.getPool().close()
+    ftp.close()
+    cwb.close()
+
+
+def test_backfill(services, tmp_path, monkeypatch):
+    # the worker processes record their stages in the json lines of this one
+    urls, dataDir, webDir, ftp, cwb = services
+    monkeypatch.setitem(metrics._config, 'jsonPath', str(tmp_path / 'metrics.jsonl'))
+    results = backfill.backfill(urls, ioWorkers=2, cpuWorkers=2, queueSize=1, dataDir=dataDir, webDir=webDir,
+                                nativeGrid=True, fetchConcurrency=4)
+    assert results == dict.fromkeys(urls, 'done')
+    assert len(glob.glob(f'{dataDir}/SAC/202205/*/*PGAs.txt')) == 4
+    assert glob.glob(f'{dataDir}/SAC/202205/*.tar.bz2') == []
+    with open(tmp_path / 'metrics.jsonl') as f:
+        spans = [json.loads(line)['span'] for line in f]
+    assert spans.count('processData') == 8
+    assert spans.count('contourMulti') == 4
+
+
+def test_downloads_bounded(services, monkeypatch):
+    # a slow fetch stage: the downloads wait for it instead of filling the disk
+    urls, dataDir, webDir, ftp, cwb = services
+    onDisk = []
+    fetchEvent = backfill.fetchEvent
+
+    def slowFetchEvent(*args):
+        time.sleep(0.5)
+        onDisk.append(len(glob.glob(f'{dataDir}/SAC/202205/*.tar.bz2*')))
+        return fetchEvent(*args)
+
+    monkeypatch.setattr(backfill, 'fetchEvent', slowFetchEvent)
+    results = backfill.backfill(urls, ioWorkers=1, cpuWorkers=1, queueSize=1, dataDir=dataDir, webDir=webDir,
+                                nativeGrid=True, fetchConcurrency=1)
+    assert results == dict.fromkeys(urls, 'done')
+    assert len(onDisk) == 4
+    assert max(onDisk) <= 2
+
+
+def test_fetch_one_event(services):
+    # palert.py process: the report page and the archive are retried, the
+    # archive resumed, like in a backfill
+    urls, dataDir, webDir, ftp, cwb = services
+    cwb.failures = 2
+    ftp.faults = [('drop', 50000)]
+    event = backfill.fetchEvent(urls[0], None, dataDir, webDir)
+    assert len(event.rawStream) == 30
+    assert ftp.retrieved == 2
+    assert cwb.failures == 0
+    assert glob.glob(f'{dataDir}/SAC/202205/*.tar.bz2*') == []
@@ -0,0 +1,53 @@
+# IdwGrid against a direct inverse distance weighting of the stations with a value
+#
+# usage: python -m pytest tests
+
+import os
+import sys
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import intensityGrid
+
+REGION = (120.0, 121.0, 23.0, 24.0)
+
+
+def direct(grid, values):
+    # the neighbors nearest stations with a value, within radius, of every node
+    scale = np.cos(np.radians((grid.region[2] + grid.region[3]) / 2))
+    gridLon, gridLat = np.meshgrid(grid.longitudes, grid.latitudes)
+    known = np.isfinite(values)
+    tree = cKDTree(np.column_stack([grid.longitude[known] * scale, grid.latitude[known]]))
+    distance, index = tree.query(np.column_stack([gridLon.ravel() * scale, gridLat.ravel()]), k=grid.neighbors,
+                                 distance_upper_bound=grid.radius)
+    weights = np.where(np.isfinite(distance), 1 / np.maximum(distance, 1e-6) ** grid.power, 0)
+    nearest = values[known][np.minimum(index, known.sum() - 1)]
+    with np.errstate(invalid='ignore'):
+        field = (weights * nearest).sum(axis=1) / weights.sum(axis=1)
+    return field.reshape(len(grid.latitudes), len(grid.longitudes))
+
+
+def test_nearest_stations_without_value():
+    rng = np.random.default_rng(0)
+    latitude, longitude = rng.uniform(23.0, 24.0, 300), rng.uniform(120.0, 121.0, 300)
+    grid = intensityGrid.IdwGrid(latitude, longitude, region=REGION, spacing=0.05, radius=0.3, candidates=16)
+    values = rng.uniform(0, 6, (300, 4))
+    # from most stations without a value (the first accumulated frames) to none
+    for frame, missing in enumerate([0.95, 0.8, 0.3, 0]):
+        values[rng.random(300) < missing, frame] = np.nan
+    fields = grid.interpolate(values)
+    for frame in range(values.shape[1]):
+        expected = direct(grid, values[:, frame])
+        np.testing.assert_array_equal(np.isnan(fields[frame]), np.isnan(expected))
+        np.testing.assert_allclose(fields[frame], expected)
+        np.testing.assert_allclose(grid.interpolate(values[:, frame]), expected)
+    assert np.isfinite(fields[0]).any()
+
+
+def test_far_from_every_station():
+    grid = intensityGrid.IdwGrid([23.5], [120.5], region=REGION, spacing=0.1, radius=0.2)
+    field = grid.interpolate(np.array([3.0]))
+    assert np.isclose(np.nanmax(field), 3.0) and np.isnan(field[0, 0])
+    assert np.isnan(grid.interpolate(np.array([np.nan]))).all()
@@ -0,0 +1,95 @@
+# library.parseCwbXml against the three-pass parsers it replaced
+#
+# usage: python -m pytest tests
+
+import os
+import sys
+import xml.etree.ElementTree as ET
+
+import pandas as pd
+import pytest
+from obspy.core import UTCDateTime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'benchmarks'))
+import eventStore
+import library
+import mockServices
+
+STATION_PATHS = [('stationCode', 'd:stationCode', str), ('stationLon', 'd:stationLon', float),
+                 ('stationLat', 'd:stationLat', float), ('stationDist', 'd:distance', float),
+                 ('stationAz', 'd:azimuth', float), ('stationIntensity', 'd:stationIntensity', int),
+                 ('stationPGAz', 'd:pga/d:vComponent', float), ('stationPGAns', 'd:pga/d:nsComponent', float),
+                 ('stationPGAew', 'd:pga/d:ewComponent', float)]
+
+
+def baselineStationInfo(xmlfile):
+    # getCwbStationInfo before parseCwbXml: one find per field of every eqStation
+    root = ET.parse(xmlfile).getroot()
+    ns = {'d': root.tag.split('}')[0].strip('{')}
+    data = {name: [] for name, path, cast in STATION_PATHS}
+    for station in root.findall('d:dataset/d:earthquake/d:intensity/d:shakingArea/d:eqStation', ns):
+        for name, path, cast in STATION_PATHS:
+            child = station.find(path, ns)
+            data[name].append(None if child is None else cast(child.text))
+    df = pd.DataFrame(data)
+    df['stationPGAmax'] = df[['stationPGAz', 'stationPGAns', 'stationPGAew']].max(axis=1)
+    return df
+
+
+def baselineEqParameters(xmlfile):
+    root = ET.parse(xmlfile).getroot()
+    ns = {'d': root.tag.split('}')[0].strip('{')}
+    info = root.find('d:dataset/d:earthquake/d:earthquakeInfo', ns)
+    return {'originTImeUTC': UTCDateTime(info.find('d:originTime', ns).text),
+            'longitude': float(info.find('d:epicenter/d:epicenterLon', ns).text),
+            'latitude': float(info.find('d:epicenter/d:epicenterLat', ns).text),
+            'depth': float(info.find('d:depth', ns).text),
+            'magnitude': float(info.find('d:magnitude/d:magnitudeValue', ns).text)}
+
+
+@pytest.fixture
+def xmlfiles(tmp_path):
+    event = mockServices.SyntheticEvent(40, UTCDateTime(2021, 9, 15, 10, 50, 53), eqNo=110095)
+    xml = mockServices.cwbXml(event, cwbStations=20)
+    complete = tmp_path / 'complete.xml'
+    complete.write_text(xml)
+    # the second station has no intensity, the fifth no vertical PGA
+    stations = xml.split('<eqStation>')
+    stations[2] = stations[2].replace(stations[2][stations[2].index('<stationIntensity>'):stations[2].index('</eqStation>')], '')
+    stations[5] = stations[5].replace(stations[5][stations[5].index('<vComponent>'):stations[5].index('</pga>')], '')
+    incomplete = tmp_path / 'incomplete.xml'
+    incomplete.write_text('<eqStation>'.join(stations))
+    return str(complete), str(incomplete)
+
+
+def test_station_info(xmlfiles):
+    complete, incomplete = xmlfiles
+    df = library.getCwbStationInfo(complete)
+    assert df['stationIntensity'].dtype == 'Int64'
+    pd.testing.assert_frame_equal(df, baselineStationInfo(complete), check_dtype=False)
+    assert (df['stationIntensity'] == baselineStationInfo(complete)['stationIntensity']).all()
+
+
+def test_station_info_missing_values(xmlfiles):
+    complete, incomplete = xmlfiles
+    df, baseline = library.getCwbStationInfo(incomplete), baselineStationInfo(incomplete)
+    assert len(df) == len(baseline) == 20
+    assert df['stationIntensity'].isna().tolist() == baseline['stationIntensity'].isna().tolist() == [i == 1 for i in range(20)]
+    assert df['stationIntensity'].dropna().tolist() == baseline['stationIntensity'].dropna().astype(int).tolist()
+    pd.testing.assert_frame_equal(df.drop(columns='stationIntensity'), baseline.drop(columns='stationIntensity'))
+
+
+def test_eq_parameters(xmlfiles):
+    complete, incomplete = xmlfiles
+    parameters = {}
+    library.getEqParameters(parameters, complete)
+    assert parameters == baselineEqParameters(complete)
+
+
+def test_event_store_intensity(xmlfiles, tmp_path):
+    complete, incomplete = xmlfiles
+    store = eventStore.EventStore(str(tmp_path / 'events.db'))
+    store.recordEvent(library.parseCwbXml(incomplete))
+    stations = store.stations(110095)
+    assert stations['stationIntensity'].isna().tolist() == [i == 1 for i in range(20)]
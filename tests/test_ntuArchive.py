@@ -0,0 +1,141 @@
+# ntuArchive: the streamed archives, against stand-ins of the NTU ftp server
+#
+# usage: python -m pytest tests
+
+import contextlib
+import io
+import json
+import os
+import sys
+import tarfile
+import threading
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'benchmarks'))
+import ntuArchive
+from mockServices import FtpServer
+from obspy import UTCDateTime
+
+ARCHIVES = ['20220107_211019_MAN.tar.bz2', '20220107_211019_AUTO.tar.bz2', '20220115_083000_MAN.tar.bz2']
+# what else turns up in an events/ folder of the ftp server
+STRAYS = ['README.txt', '20220107_211019_MAN.tar.bz2.part', 'tmp.tar.bz2', '2022017_21101_MAN.tar.bz2',
+          '20220230_120000_MAN.tar.bz2', '20220107_211019_MAN.tar.bz2 (1).tar.bz2']
+
+
+def tarBz2(members):
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode='w:bz2') as tar:
+        for name, content in members.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(content)
+            tar.addfile(info, io.BytesIO(content))
+    return buffer.getvalue()
+
+
+class ChunkedFtp():
+    # retrbinary sends the archive, then `trailing` chunks once the reader has it
+    def __init__(self, archive, trailing=0):
+        self.archive = archive
+        self.trailing = trailing
+
+    def retrbinary(self, command, callback):
+        callback(self.archive)
+        time.sleep(0.1)
+        for k in range(self.trailing):
+            callback(b'\0' * 20000)
+
+
+def test_iterArchive():
+    members = {f'TW.W{k:03}.HLE': os.urandom(1000) for k in range(3)}
+    assert dict(ntuArchive.iterArchive(ChunkedFtp(tarBz2(members)), 'event.tar.bz2')) == members
+
+
+@pytest.mark.parametrize('trailing', [63, 64, 65, 66])
+def test_iterArchive_consumer_failing(trailing):
+    # the transfer ends while the queue of chunks is full, then the reader fails
+    ftp = ChunkedFtp(tarBz2({'TW.W001.HLE': bytes(1000)}), trailing)
+    errors = []
+
+    def consume():
+        try:
+            for name, content in ntuArchive.iterArchive(ftp, 'event.tar.bz2'):
+                time.sleep(0.3)
+                raise RuntimeError('the consumer failed')
+        except RuntimeError as error:
+            errors.append(error)
+
+    thread = threading.Thread(target=consume, daemon=True)
+    thread.start()
+    thread.join(3 * ntuArchive.JOIN_TIMEOUT)
+    assert not thread.is_alive()
+    assert len(errors) == 1
+
+
+@pytest.fixture
+def ftp(tmp_path):
+    folder = tmp_path / 'ftp' / 'events' / '202201'
+    folder.mkdir(parents=True)
+    for name in ARCHIVES + STRAYS:
+        (folder / name).write_bytes(b'')
+    server = FtpServer(tmp_path / 'ftp')
+    pool = ntuArchive.FtpPool('127.0.0.1', server.port, timeout=5)
+    yield pool
+    pool.close()
+    server.close()
+
+
+def test_index_skips_strays(ftp):
+    index = ntuArchive.ArchiveIndex(ftp)
+    assert index.names('202201') == sorted(ARCHIVES)
+    assert index.nearest(UTCDateTime('2022-01-07T21:10:20'), tolerance=1) == '20220107_211019_MAN'
+    assert index.nearest(UTCDateTime('2022-01-07T21:10:19'), kind='_AUTO') == '20220107_211019_AUTO'
+    assert index.nearest(UTCDateTime('2022-01-15T08:30:00')) == '20220115_083000_MAN'
+    assert index.nearest(UTCDateTime('2022-01-20T00:00:00')) is None
+
+
+def test_index_cache_with_strays(ftp, tmp_path):
+    # a cache saved before the names were checked still loads
+    cachePath = tmp_path / 'index.json'
+    cachePath.write_text(json.dumps({'202201': {'fetched': time.time(), 'names': sorted(ARCHIVES + STRAYS)}}))
+    index = ntuArchive.ArchiveIndex(ftp, str(cachePath))
+    assert index.names('202201') == sorted(ARCHIVES)
+    assert index.nearest(UTCDateTime('2022-01-15T08:30:01')) == '20220115_083000_MAN'
+
+
+class AlternatingPool():
+    # every listing of the month is the other of two, as if archives came and went
+    def __init__(self, listings):
+        self.listings = listings
+        self.n = 0
+
+    @contextlib.contextmanager
+    def connection(self):
+        yield self
+
+    def nlst(self, folder):
+        self.n += 1
+        return [f'{folder}/{name}' for name in self.listings[self.n % 2]]
+
+
+def test_nearest_while_refreshing():
+    # the names and times of a lookup come from the same listing
+    early = [f'20220107_{h:02d}0000_MAN.tar.bz2' for h in range(12)]
+    index = ntuArchive.ArchiveIndex(AlternatingPool([early + ['20220115_083000_MAN.tar.bz2'],
+                                                     ['20220115_083000_MAN.tar.bz2']]), maxAge=0)
+    stop = threading.Event()
+
+    def refresh():
+        while not stop.is_set():
+            index.refresh('202201')
+
+    thread = threading.Thread(target=refresh, daemon=True)
+    thread.start()
+    try:
+        for k in range(2000):
+            assert index.nearest(UTCDateTime('2022-01-15T08:30:00')) == '20220115_083000_MAN'
+    finally:
+        stop.set()
+        thread.join()
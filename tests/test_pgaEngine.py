@@ -0,0 +1,100 @@
+# pgaEngine on small streams whose PGAs are worked out by hand
+#
+# usage: python -m pytest tests
+
+import os
+import sys
+
+import numpy as np
+import pytest
+from obspy import Stream, Trace, UTCDateTime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import pgaEngine
+
+START = UTCDateTime(2022, 1, 7, 21, 11, 0)
+DELTA = 0.01
+
+
+def trace(station, component, samples, offset=0):
+    return Trace(np.array(samples, dtype=np.float32),
+                 header={'network': 'TW', 'station': station, 'location': '--', 'channel': f'HL{component}',
+                         'starttime': START + offset * DELTA, 'delta': DELTA})
+
+
+@pytest.fixture
+def stream():
+    # A001: |E|, |N|, |Z| peak at 3, 4, 12; the ENZ resultant of the samples is
+    #       1, 5, 12, 2 and the EN one 1, 5, 0, 2
+    # A002: no Z trace, and its N trace starts two samples late
+    # A003: only zeros
+    # A004: not asked for
+    return Stream([trace('A001', 'E', [1, -3, 0, 0]), trace('A001', 'N', [0, 4, 0, 2]), trace('A001', 'Z', [0, 0, 12, 0]),
+                   trace('A002', 'E', [0, 0, 0, 0]), trace('A002', 'N', [6, -8], offset=2),
+                   trace('A003', 'E', [0, 0, 0, 0]), trace('A003', 'N', [0, 0, 0, 0]), trace('A003', 'Z', [0, 0, 0, 0]),
+                   trace('A004', 'Z', [100, 0, 0, 0])])
+
+
+def test_streamToArray(stream):
+    data, starttime, delta = pgaEngine.streamToArray(stream, ['A001', 'A002', 'A003', 'A005'], demean=False)
+    assert data.shape == (4, 3, 4)
+    assert starttime == START
+    assert delta == pytest.approx(DELTA)
+    assert data[1].tolist() == [[0, 0, 0, 0], [0, 0, 6, -8], [0, 0, 0, 0]]
+    assert not data[3].any()
+    demeaned = pgaEngine.streamToArray(stream, ['A001'])[0]
+    assert np.allclose(demeaned[0, 2], [-3, -3, 9, -3])
+
+
+def test_pgaToIntensity():
+    assert np.allclose(pgaEngine.pgaToIntensity([0., 8., 80., 0.1]), [0., 2 * np.log10(8) + 0.7, 2 * np.log10(80) + 0.7, 0.])
+
+
+def test_getPGAs(stream):
+    df = pgaEngine.getPGAs(stream, ['A001', 'A002', 'A003', 'A005'], demean=False).set_index('staName')
+    assert df.loc['A001', pgaEngine.PGA_COLUMNS].tolist() == pytest.approx([12, 2 * np.log10(12) + 0.7, 12, 5], abs=5e-3)
+    assert df.loc['A002', pgaEngine.PGA_COLUMNS].tolist() == pytest.approx([8, 2 * np.log10(8) + 0.7, 8, 8], abs=5e-3)
+    # no motion (A003) and no traces at all (A005) are both zero
+    assert df.loc['A003', pgaEngine.PGA_COLUMNS].tolist() == [0, 0, 0, 0]
+    assert df.loc['A005', pgaEngine.PGA_COLUMNS].tolist() == [0, 0, 0, 0]
+    assert 'A004' not in df.index
+
+
+def test_computePGAs_chunks(stream):
+    data = pgaEngine.streamToArray(stream, ['A001', 'A002', 'A003'])[0]
+    assert np.array_equal(pgaEngine.computePGAs(data, chunkSize=1), pgaEngine.computePGAs(data))
+
+
+def test_checkParity(stream):
+    df = pgaEngine.getPGAs(stream, ['A001', 'A002', 'A003'], demean=False)
+    reference = df.copy()
+    assert pgaEngine.checkParity(df, reference).empty
+    reference.loc[reference['staName'] == 'A002', 'PGAsResultantOfEN'] = 9.
+    mismatch = pgaEngine.checkParity(df, reference)
+    assert mismatch['staName'].tolist() == ['A002']
+    assert mismatch.loc[0, 'PGAsResultantOfENRdsac2'] == 9.
+
+
+@pytest.mark.parametrize('windowLength', [3, 1])
+@pytest.mark.parametrize('windowOffset', [-1.5, 0, 2.004])
+def test_accumPGAs(windowLength, windowOffset):
+    # every frame is computePGAs of the cut from windowStart to its boundary,
+    # inclusive, and zeros for a boundary before the data
+    rng = np.random.default_rng(0)
+    data = rng.normal(0, 1, (5, 3, 1000)) * rng.uniform(1, 50, (5, 1, 1))
+    windowStart = START + windowOffset
+    endtimes, pgas = pgaEngine.accumPGAs(data, START, DELTA, windowStart, windowLength, windowCount=6, chunkSize=2)
+    assert endtimes == [windowStart + windowLength * i for i in range(1, 7)]
+    first = max(int(round((windowStart - START) / DELTA)), 0)
+    for endtime, frame in zip(endtimes, pgas):
+        last = int(round((endtime - START) / DELTA))
+        assert np.allclose(frame, pgaEngine.computePGAs(data[..., first:max(last + 1, first)]))
+
+
+@pytest.mark.parametrize('windowOffset', [10, 12.5])
+def test_accumPGAs_after_the_data(windowOffset):
+    data = np.ones((2, 3, 1000))
+    endtimes, pgas = pgaEngine.accumPGAs(data, START, DELTA, START + windowOffset, windowCount=4)
+    assert len(endtimes) == 4
+    assert pgas.shape == (4, 2, 4)
+    assert not pgas.any()
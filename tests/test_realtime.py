@@ -0,0 +1,66 @@
+# RealtimePGA fed as the watched folder and the real-time feed deliver packets:
+# whole files longer than the buffer, and components that arrive apart
+#
+# usage: python -m pytest tests
+
+import os
+import sys
+
+import numpy as np
+from obspy import Stream, Trace, UTCDateTime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import realtime
+
+START = UTCDateTime(2022, 1, 1, 12)
+DELTA = 0.01
+OFFSET = 100
+
+
+def trace(component, start, seconds, spikeAt=None, spike=400):
+    # a flat record with a DC offset and one spike spikeAt seconds after START
+    data = np.full(int(round(seconds / DELTA)), OFFSET, dtype=np.float32)
+    if spikeAt is not None:
+        data[int(round((spikeAt - start) / DELTA))] += spike
+    return Trace(data, {'network': 'TW', 'station': 'W21B', 'channel': f'HL{component}',
+                        'starttime': START + start, 'delta': DELTA})
+
+
+def frames(packets):
+    engine = realtime.RealtimePGA(['W21B'], START, DELTA)
+    result = []
+    for packet in packets:
+        engine.feed(packet)
+        result += engine.ready()
+    result += engine.flush()
+    return np.array([pgas[0] for i, endtime, pgas in result])
+
+
+def test_trace_longer_than_the_buffer():
+    # one 120 s file, four times the 30 s buffer
+    pgas = frames([Stream([trace('E', 0, 121, spikeAt=59.5), trace('N', 0, 121), trace('Z', 0, 121)])])
+    assert len(pgas) == 40
+    np.testing.assert_allclose(pgas[:19, 0], 0, atol=1e-3)
+    np.testing.assert_allclose(pgas[19:, 0], 400, rtol=1e-3)
+    np.testing.assert_allclose(pgas[19:, 3], 400, rtol=1e-3)
+
+
+def test_components_arriving_apart():
+    # E alone for 6 s, past the 5 s baseline window, then E, N and Z a second at a time
+    packets = [[trace('E', t, 1)] for t in range(6)]
+    packets += [[trace('E', t, 1), trace('N', t, 1, spikeAt=30.5 if t == 30 else None), trace('Z', t, 1)]
+                for t in range(6, 121)]
+    pgas = frames(packets)
+    assert len(pgas) == 40
+    # no offset left in N and Z
+    np.testing.assert_allclose(pgas[:10], 0, atol=1e-3)
+    np.testing.assert_allclose(pgas[10:, [0, 2, 3]], 400, rtol=1e-3)
+
+
+def test_component_delivered_late():
+    # N and Z of the first 6 s come after E, in a separate call
+    packets = [[trace('E', 0, 6)], [trace('N', 0, 6, spikeAt=5.5), trace('Z', 0, 6)]]
+    packets += [[trace(component, t, 1) for component in 'ENZ'] for t in range(6, 121)]
+    pgas = frames(packets)
+    np.testing.assert_allclose(pgas[0], 0, atol=1e-3)
+    np.testing.assert_allclose(pgas[1:, 3], 400, rtol=1e-3)
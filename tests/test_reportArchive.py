@@ -0,0 +1,56 @@
+# ReportArchive: revisions, queries and compaction of the month partitions
+#
+# usage: python -m pytest tests
+
+import glob
+import io
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'benchmarks'))
+import library
+import mockServices
+import reportArchive
+from obspy import UTCDateTime
+
+
+def report(eqNo, originTime, magnitude):
+    event = mockServices.SyntheticEvent(10, originTime, eqNo=eqNo)
+    event.magnitude = magnitude
+    return library.parseCwbXml(io.StringIO(mockServices.cwbXml(event, 5)))
+
+
+def parts(root, table='events'):
+    return sorted(glob.glob(f'{root}/{table}/month=*/part-*.parquet'))
+
+
+def test_latest_revision(tmp_path):
+    archive = reportArchive.ReportArchive(str(tmp_path))
+    archive.append([report(111001, UTCDateTime(2021, 10, 1, 0, 0, 5), 5.5), report(111002, UTCDateTime(2021, 10, 3), 4.1)])
+    # revised: smaller, and its origin time moved into the month before
+    archive.append([report(111001, UTCDateTime(2021, 9, 30, 23, 59, 55), 4.8)])
+    archive.append([report(111003, UTCDateTime(2022, 1, 5), 6.0)])
+
+    assert archive.events()['eqNo'].tolist() == [111001, 111002, 111003]
+    assert archive.events(minMagnitude=5)['eqNo'].tolist() == [111003]
+    # the old revision matches the time range, the latest is in the month before
+    assert archive.events(UTCDateTime(2021, 10, 1), UTCDateTime(2021, 10, 2)).empty
+    assert archive.events(UTCDateTime(2021, 9, 30), UTCDateTime(2021, 10, 31))['eqNo'].tolist() == [111001, 111002]
+    stations = archive.stations(UTCDateTime(2021, 9, 1), UTCDateTime(2021, 9, 30, 23, 59, 59))
+    assert set(stations['eqNo']) == {111001} and len(stations) == 5
+
+
+def test_compact(tmp_path):
+    archive = reportArchive.ReportArchive(str(tmp_path))
+    for k in range(3):
+        archive.append([report(111001 + k, UTCDateTime(2021, 9, 1 + k), 4.0 + k)])
+    archive.append([report(111004, UTCDateTime(2021, 10, 1), 5.0)])
+    archive.append([report(111001, UTCDateTime(2021, 9, 1), 6.5)])
+    before = archive.stations()
+
+    assert archive.compact(['2021-09'], minParts=5) == []
+    assert archive.compact(['2021-09', '2021-10'], minParts=4) == ['2021-09']
+    assert len(parts(tmp_path)) == 2 and len(parts(tmp_path, 'stations')) == 2
+    assert archive.stations().equals(before)
+    assert archive.events(minMagnitude=6.5)['eqNo'].tolist() == [111001]
@@ -0,0 +1,34 @@
+# sacWriter writes and patches the same files whatever the number of worker
+# threads
+#
+# usage: python -m pytest tests
+
+import os
+import sys
+
+import numpy as np
+import pytest
+from obspy.io.sac import SACTrace
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'benchmarks'))
+import sacWriter
+from benchSacWrite import syntheticStream
+
+
+@pytest.mark.parametrize('workers', [1, 4])
+def test_writeTraces(tmp_path, workers):
+    st = syntheticStream(20, 2)
+    stationHeaders = {f'S{i:03d}': {'stla': 23.0 + i, 'stlo': 121.0} for i in range(20)}
+    files = sacWriter.writeTraces(st, str(tmp_path), {'mag': 5.9}, stationHeaders, workers, chunkSize=8)
+    assert files == sorted(sacWriter.traceFilename(tr, str(tmp_path)) for tr in st)
+    for tr in st:
+        sac = SACTrace.read(sacWriter.traceFilename(tr, str(tmp_path)))
+        assert np.array_equal(sac.data, tr.data)
+        assert sac.mag == pytest.approx(5.9)
+        assert sac.stla == pytest.approx(stationHeaders[tr.stats.station]['stla'])
+
+    fileHeaders = {files[0]: {'evdp': 12.0}}
+    assert sacWriter.patchHeaders(files, {'mag': 6.1}, fileHeaders, workers, chunkSize=8) == files
+    assert SACTrace.read(files[0]).evdp == pytest.approx(12.0)
+    assert all(SACTrace.read(file).mag == pytest.approx(6.1) for file in files)
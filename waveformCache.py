@@ -0,0 +1,80 @@
+import json
+import numpy as np
+import os
+from obspy import UTCDateTime
+import pgaEngine
+
+
+class WaveformCache():
+    """
+    class WaveformCache
+
+    Module     : np (numpy)
+                 json
+
+    Description: the synced traces of a event as one stations x E/N/Z x samples
+                 float32 array in a memory-mapped .npy, with the station/channel
+                 index and the timing in a .json beside it. Time windows are
+                 slices of the memory map, so nothing is copied or re-read from
+                 the sac files.
+
+    Examples of sage:
+        >> cache = WaveformCache.create('/home/palert/data/SAC/202201/20220107_211139_MAN/waveforms', st)
+        >> cache = WaveformCache('/home/palert/data/SAC/202201/20220107_211139_MAN/waveforms')
+        >> data, starttime, delta = cache.select(['A001', 'A002'], originTime - 20, originTime + 100)
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(f'{path}.json') as f:
+            index = json.load(f)
+        self.stations = index['stations']
+        self.channels = index['channels']
+        self.starttime = UTCDateTime(index['starttime']) if index['starttime'] else None
+        self.delta = index['delta']
+        self.data = np.load(f'{path}.npy', mmap_mode='r')
+        self.__rows = {sta: i for i, sta in enumerate(self.stations)}
+
+    @classmethod
+    def create(cls, path, st, stations=None):
+        # stations defaults to every station of st, sorted
+        stations = sorted({tr.stats.station for tr in st}) if stations is None else list(stations)
+        channels = {}
+        for tr in st:
+            channels.setdefault(tr.stats.station, {})[tr.stats.channel[-1]] = \
+                f'{tr.stats.network}.{tr.stats.station}.{tr.stats.location}.{tr.stats.channel}'
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        mapped = lambda shape, dtype: np.lib.format.open_memmap(f'{path}.npy', mode='w+', dtype=dtype, shape=shape)
+        data, starttime, delta = pgaEngine.streamToArray(st, stations, demean=False, allocate=mapped)
+        data.flush()
+        del data
+        with open(f'{path}.json', 'w') as f:
+            json.dump({'stations': stations,
+                       'components': list(pgaEngine.COMPONENTS),
+                       'channels': [[channels.get(sta, {}).get(comp) for comp in pgaEngine.COMPONENTS] for sta in stations],
+                       'starttime': str(starttime) if starttime is not None else None,
+                       'delta': delta}, f)
+        return cls(path)
+
+    @staticmethod
+    def exists(path):
+        return os.path.exists(f'{path}.npy') and os.path.exists(f'{path}.json')
+
+    def window(self, starttime=None, endtime=None):
+        # a view of the memory map, both ends included as in Trace.trim
+        if self.starttime is None:
+            return self.data, self.starttime
+        first = 0 if starttime is None else max(int(round((starttime - self.starttime) / self.delta)), 0)
+        last = self.data.shape[-1] if endtime is None else max(int(round((endtime - self.starttime) / self.delta)) + 1, first)
+        return self.data[:, :, first:last], self.starttime + first * self.delta
+
+    def select(self, staNames, starttime=None, endtime=None, demean=True):
+        # the rows of staNames in that order (zero if a station is missing),
+        # the same layout as pgaEngine.streamToArray
+        window, windowStart = self.window(starttime, endtime)
+        rows = np.array([self.__rows.get(sta, -1) for sta in staNames], dtype=np.int64)
+        data = np.zeros((len(rows),) + window.shape[1:], dtype=np.float32)
+        found = rows >= 0
+        data[found] = window[rows[found]]
+        if demean and data.shape[-1]:
+            data -= data.mean(axis=2, keepdims=True)
+        return data, windowStart, self.delta